@@ -6,21 +6,31 @@ if OPTIONS["show_gui"]:
     # Only try loading pygame if needed
     os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = "hide"
     import pygame
-if OPTIONS["multiproc"]:
+if OPTIONS["multiproc"] or OPTIONS["edge_procs"] > 1:
     # Only need to bring in multiprocessing if needed
     import multiprocessing
-from collections import deque, defaultdict
+from array import array
+from collections import deque, defaultdict, OrderedDict
+from queue import Empty, Queue
 from datetime import datetime
 from PIL import Image
 import numpy as np
 import heapq
+import frame_dupes
+import itertools
+import job_index
 import json
 import math
 import subprocess
+import threading
 import time
 import mandelbrot_native_helper
+import palette
 import pickle
+import trail_file
+import struct
 import sys
+import zlib
 if sys.version_info >= (3, 11): from datetime import UTC
 else: import datetime as datetime_fix; UTC=datetime_fix.timezone.utc
 
@@ -105,21 +115,7 @@ def draw_mand(alias, size, center_x, center_y, julia=None, max_iters=50, max_ski
                                     final_smoothed = worker.escaped_at + 1 - nu
 
                                 # Pick a color along a simple palette
-                                rgb = ((worker.escaped_at + 1 - nu) / max_iters)
-                                rgb = max(0, min(1, rgb)) * 4
-                                colors = [
-                                    (0, 0, 100),
-                                    (255, 255, 255),
-                                    (255, 180, 0),
-                                    (100, 0, 0),
-                                    (100, 0, 0),
-                                ]
-                                
-                                rgb = (
-                                    int(colors[int(rgb)][0] * (1 - (rgb - int(rgb))) + colors[int(rgb) + 1][0] * (rgb - int(rgb))),
-                                    int(colors[int(rgb)][1] * (1 - (rgb - int(rgb))) + colors[int(rgb) + 1][1] * (rgb - int(rgb))),
-                                    int(colors[int(rgb)][2] * (1 - (rgb - int(rgb))) + colors[int(rgb) + 1][2] * (rgb - int(rgb))),
-                                )
+                                rgb = palette.smoothed_color(worker.escaped_at + 1 - nu, max_iters)
                             
                             all_rgb[0] += rgb[0]
                             all_rgb[1] += rgb[1]
@@ -141,9 +137,64 @@ def draw_mand(alias, size, center_x, center_y, julia=None, max_iters=50, max_ski
     yield {"type": "msg", "msg": "Done Drawing"}
     yield None
 
+# The passes used to draw a fractal, each one fills in more detail
+_MAND_PASSES = [32, 16, 8, 4, 2, 1]
+
+def calc_mand_pass(skip, alias, size, center_x, center_y, julia=None, max_iters=50, threads=0):
+    # Calculate every skip-th pixel of a fractal in one native call, returns arrays of the
+    # color for each pixel, along with the escape and smoothed value of the first alias point,
+    # which are -1 and NaN for points inside the set
+    jx, jy = (0.0, 0.0) if julia is None else julia
+    escaped, smoothed = mandelbrot_native_helper.render_grid(
+        -center_x, -center_y, size, _width, _height, alias, 
+        julia is not None, jx, jy, max_iters, threads, skip,
+    )
+    rows, cols = escaped.shape[0] // alias, escaped.shape[1] // alias
+    escaped = escaped.reshape(rows, alias, cols, alias)
+    smoothed = smoothed.reshape(rows, alias, cols, alias)
+
+    # Pick a color along a simple palette, anything inside the set gets a default color
+    rgb = palette.smoothed_colors(smoothed, max_iters)
+
+    # Smooth out the multiple colors
+    rgb = (rgb.sum(axis=(1, 3)) / (alias * alias)).astype(np.uint8)
+    return rgb, escaped[:, 0, :, 0], smoothed[:, 0, :, 0]
+
+def draw_mand_frame(alias, size, center_x, center_y, julia=None, max_iters=50, max_skip=0):
+    # State machine to draw a Mandelbrot or Julia, same as draw_mand, but each pass is 
+    # calculated as a whole and sent to the caller as one event with arrays for the pass
+    yield {"type": "msg", "msg": f"Drawing fractal..."}
+    last_skip = None
+    for skip in _MAND_PASSES:
+        if skip < max_skip:
+            break
+        yield {"type": "msg", "msg": f"Working on pass {skip}...", "info": True}
+
+        rgb, escape, smoothed = calc_mand_pass(skip, alias, size, center_x, center_y, julia, max_iters)
+        # Only the pixels a previous pass didn't draw are new
+        new = np.ones(escape.shape, dtype=bool)
+        if last_skip is not None:
+            new[::last_skip // skip, ::last_skip // skip] = False
+        last_skip = skip
+
+        yield {
+            "type": "draw_mand_frame",
+            "skip": skip,
+            "new": new,
+            "rgb": rgb,
+            "escape": escape,
+            "smoothed": smoothed,
+        }
+
+    yield {"type": "msg", "msg": "Done Drawing"}
+    yield None
+
 def fill_pool(state):
     # State machine to show the "pool", mostly just used for some simple debugging
     yield {"type": "msg", "msg": "Finding Pool"}
+    if state.pool_mask is not None:
+        # The vectorized renderer tracks the pool as an array
+        state.pool.update(((x, y), state.pool_rgb[y, x].tolist()) for y, x in zip(*np.nonzero(state.pool_mask)))
     for y in range(_height):
         for x in range(_width):
             if (x, y) in state.pool:
@@ -163,15 +214,243 @@ def fill_pool(state):
     yield {"type": "msg", "msg": "Done With Pool"}
     yield None
 
+class TileCache:
+    # A bounded cache of in-set bits for points on the border scan lattice.  Points are grouped
+    # into square tiles, a whole tile is calculated in one batch on a miss and stored bit-packed,
+    # and the least recently used tiles are dropped when the cache is full
+    def __init__(self, pixel, max_iters, max_tiles, tile_bits=6):
+        self.pixel = pixel
+        self.max_iters = max_iters
+        self.max_tiles = max_tiles
+        self.tile_bits = tile_bits
+        self.tile_mask = (1 << tile_bits) - 1
+        self.tiles = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # Most lookups land in the same tile as the one before, so skip the dictionary for those
+        self._last_key = None
+        self._last_tile = None
+
+        # Offsets of every point in a tile, row by row, reused for each tile
+        offsets = np.arange(1 << tile_bits, dtype=np.int64)
+        self._offset_x = np.tile(offsets, 1 << tile_bits)
+        self._offset_y = np.repeat(offsets, 1 << tile_bits)
+        self._in_set = np.zeros(1 << (tile_bits * 2), dtype=np.int32)
+
+    def __len__(self):
+        return len(self.tiles)
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return 0 if total == 0 else self.hits / total
+
+    def in_set(self, x, y):
+        # Returns True if this lattice point is in the set at max_iters + 1 iterations
+        key = (x >> self.tile_bits, y >> self.tile_bits)
+        if key == self._last_key:
+            self.hits += 1
+            tile = self._last_tile
+        else:
+            tile = self._get_tile(key)
+        at = ((y & self.tile_mask) << self.tile_bits) | (x & self.tile_mask)
+        return (tile[at >> 3] >> (7 - (at & 7))) & 1 == 1
+
+    def _get_tile(self, key):
+        tile = self.tiles.get(key)
+        if tile is None:
+            self.misses += 1
+            tile = self._calc_tile(*key)
+            self.tiles[key] = tile
+            if len(self.tiles) > self.max_tiles:
+                self.tiles.popitem(last=False)
+        else:
+            self.hits += 1
+            self.tiles.move_to_end(key)
+        self._last_key, self._last_tile = key, tile
+        return tile
+
+    def _calc_tile(self, tile_x, tile_y):
+        # Calculate all of the points in one tile, same math as MandelEngine.get_iter_level
+        xs = ((tile_x << self.tile_bits) + self._offset_x) / self.pixel
+        ys = ((tile_y << self.tile_bits) + self._offset_y) / self.pixel
+        mandelbrot_native_helper.calc_batch(xs, ys, False, 0.0, 0.0, self.max_iters + 1, self._in_set, None, None)
+        return np.packbits(self._in_set != 0).tobytes()
+
+class PathStore:
+    # The A* frontier and path history for find_edge.  Every node pushed is stored once in
+    # typed arrays (lattice x, lattice y, parent index), so each node costs a fixed number of
+    # bytes, and the heap only holds one packed int per entry: cost, x, y and the node index.
+    # The heap order is the same as sorting by (cost, x, y), which is what find_edge relied on
+    NODE_BITS = 40
+
+    def __init__(self, pixel):
+        # Border points are always well inside +/- 4 units, so this is room for any lattice point
+        self.offset = int(pixel * 4)
+        self.span = self.offset * 2 + 1
+        self.node_mask = (1 << self.NODE_BITS) - 1
+        self.xs = array("q")
+        self.ys = array("q")
+        self.parents = array("q")
+        self.heap = []
+        self.peak_nodes = 0
+
+    def __len__(self):
+        return len(self.heap)
+
+    def node_count(self):
+        return len(self.xs)
+
+    def peak_bytes(self):
+        # Peak size of the node arrays, not counting the heap
+        return self.peak_nodes * (self.xs.itemsize + self.ys.itemsize + self.parents.itemsize)
+
+    def reset(self, x, y):
+        # Drop every node, and start over with a single root node, returns the root's index
+        self.xs = array("q", [x])
+        self.ys = array("q", [y])
+        self.parents = array("q", [-1])
+        return 0
+
+    def push(self, cost, x, y, parent):
+        node = len(self.xs)
+        self.xs.append(x)
+        self.ys.append(y)
+        self.parents.append(parent)
+        if node >= self.peak_nodes:
+            self.peak_nodes = node + 1
+        key = (cost * self.span + (x + self.offset)) * self.span + (y + self.offset)
+        heapq.heappush(self.heap, (key << self.NODE_BITS) | node)
+
+    def pop(self):
+        # Returns the cheapest node as (cost, x, y, node index)
+        item = heapq.heappop(self.heap)
+        node = item & self.node_mask
+        cost = (item >> self.NODE_BITS) // (self.span * self.span)
+        return cost, self.xs[node], self.ys[node], node
+
+    def path(self, node):
+        # All of the points from the root to the given node, in order
+        nodes = array("q")
+        while node != -1:
+            nodes.append(node)
+            node = self.parents[node]
+        return [(self.xs[i], self.ys[i]) for i in reversed(nodes)]
+
+def peak_memory():
+    # Peak resident memory of this process in bytes, or None if the platform can't tell us
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports this in kilobytes, macOS in bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+class ScanCheckpoint:
+    # Checkpoints for a long find_edge scan, so it can be picked back up with RESUME_TRAIL.
+    # The file is a series of records, each appended and synced in one write.  A record holds
+    # the trail points found since the record before it, along with the rest of the scan state.
+    # A record that was only partly written when the process died fails its checksum, and is
+    # cut off the end of the file when the scan resumes.  Every so often the file is rewritten
+    # as one record, so the old copies of the seen sets don't pile up
+    MAGIC = b"EJCK"
+    # Magic, size of the payload, crc32 of the payload
+    HEADER = struct.Struct("<4sII")
+    # pixel, border_iter, precise_point, frame_spacing, target x, y, cost, current x, y,
+    # cost_check, unleash, has final_head, final_head x, y, count of trail points, seen_cur, seen_prev
+    STATE = struct.Struct("<qq?dqqqqqq??qqqqq")
+    MAX_RECORDS = 16
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.trail_len = 0
+        self.records = 0
+
+    def load(self):
+        # Returns the state from the last good record, with the full trail, or None if there's nothing to resume
+        if not os.path.isfile(self.fn):
+            return None
+        state, trail, good = None, [], 0
+        with open(self.fn, "rb") as f:
+            data = f.read()
+        while good + self.HEADER.size <= len(data):
+            magic, size, crc = self.HEADER.unpack_from(data, good)
+            payload = data[good + self.HEADER.size:good + self.HEADER.size + size]
+            if magic != self.MAGIC or len(payload) != size or zlib.crc32(payload) != crc:
+                break
+            state, new_points = self._decode(payload)
+            trail.extend(new_points)
+            good += self.HEADER.size + size
+            self.records += 1
+        if good < len(data):
+            # Drop the torn record so the records we add after this follow a good one
+            with open(self.fn, "r+b") as f:
+                f.truncate(good)
+        if state is None:
+            return None
+        state["trail"] = trail
+        self.trail_len = len(trail)
+        return state
+
+    def _decode(self, payload):
+        fields = self.STATE.unpack_from(payload, 0)
+        names = [
+            "pixel", "border_iter", "precise_point", "frame_spacing", "tx", "ty", "cost", "x", "y",
+            "cost_check", "unleash", "has_head", "head_x", "head_y", "trail_count", "seen_cur_count", "seen_prev_count",
+        ]
+        state = dict(zip(names, fields))
+        at = self.STATE.size
+        points = array("d")
+        points.frombytes(payload[at:at + state["trail_count"] * 16])
+        at += state["trail_count"] * 16
+        seen = []
+        for count in [state["seen_cur_count"], state["seen_prev_count"]]:
+            values = array("q")
+            values.frombytes(payload[at:at + count * 8])
+            at += count * 8
+            seen.append(set(values))
+        state["seen_cur"], state["seen_prev"] = seen
+        state["final_head"] = (state["head_x"], state["head_y"]) if state["has_head"] else None
+        return state, list(zip(points[0::2], points[1::2]))
+
+    def append(self, pixel, border_iter, precise_point, target, cost, x, y, cost_check, unleash, final_head, final_trail, bits):
+        # Add one record with everything needed to restart the scan from the point (x, y)
+        rewrite = self.records >= self.MAX_RECORDS
+        if rewrite:
+            self.trail_len = 0
+        new_points = array("d")
+        for pt in itertools.islice(final_trail, self.trail_len, None):
+            new_points.extend(pt)
+        seen_cur, seen_prev = array("q", bits.seen_cur), array("q", bits.seen_prev)
+        head_x, head_y = (0, 0) if final_head is None else final_head
+        payload = self.STATE.pack(
+            pixel, border_iter, precise_point, OPTIONS["frame_spacing"], target[0], target[1], cost, x, y,
+            cost_check, unleash, final_head is not None, head_x, head_y, len(new_points) // 2, len(seen_cur), len(seen_prev),
+        ) + new_points.tobytes() + seen_cur.tobytes() + seen_prev.tobytes()
+        with open(self.fn + ".tmp" if rewrite else self.fn, "wb" if rewrite else "ab") as f:
+            f.write(self.HEADER.pack(self.MAGIC, len(payload), zlib.crc32(payload)) + payload)
+            f.flush()
+            os.fsync(f.fileno())
+        if rewrite:
+            os.replace(self.fn + ".tmp", self.fn)
+            self.records = 0
+        self.trail_len += len(new_points) // 2
+        self.records += 1
+
 class MandelEngine:
     # A class that can answer the question for a high-resolution fractal:  
     #       Is this point inside a Mandelbrot set?
-    # It uses a simple cache to store results of the seen check
-    def __init__(self, max_iters):
-        self.pixel = OPTIONS["scan_size"]
+    # It uses a simple cache to store results of the seen check, and a tile cache
+    # for the results of the border check
+    def __init__(self, max_iters, pixel=None):
+        self.pixel = OPTIONS["scan_size"] if pixel is None else pixel
         self.max_iters = max_iters
+        self.tiles = None
+        if OPTIONS["border_cache_tiles"] > 0:
+            self.tiles = TileCache(self.pixel, max_iters, OPTIONS["border_cache_tiles"])
         self.escaped_at = None
         self.final_dist = None
+        self.period = None
         self.cache_bit = False
         self.cache_set = False
 
@@ -179,22 +458,26 @@ class MandelEngine:
         self.seen_prev = set()
         self.seen_cur_size = 0
 
-    def calc_mand(self, x, y, julia=None):
+    def calc_mand(self, x, y, julia=None, report_period=False):
         # Helper to calculate a mandelbrot pixel, does not interact with the cache at all
-        if julia is None:
-            in_set, self.escaped_at, self.final_dist = mandelbrot_native_helper.calc(x, y, False, 0.0, 0.0, self.max_iters)
+        # If report_period is set, self.period is the length of any cycle the orbit fell into
+        jx, jy = (0.0, 0.0) if julia is None else julia
+        if report_period:
+            in_set, self.escaped_at, self.final_dist, self.period = mandelbrot_native_helper.calc(x, y, julia is not None, jx, jy, self.max_iters, True)
         else:
-            in_set, self.escaped_at, self.final_dist = mandelbrot_native_helper.calc(x, y, True, julia[0], julia[1], self.max_iters)
+            in_set, self.escaped_at, self.final_dist = mandelbrot_native_helper.calc(x, y, julia is not None, jx, jy, self.max_iters)
         return in_set == 1
 
     def calc_mand_python(self, x, y, julia=None):
         # Calculate one point, doesn't use cache, points should be in natural coords
         # Returns True if the point is in the set, False otherwise.  On False
         # self.escaped_at is the escaped iteration, and self.final_dist is the final
-        # escape distance.
+        # escape distance.  On True, self.period is the length of the cycle the orbit
+        # fell into, if one was found.
 
         self.escaped_at = None
         self.final_dist = None
+        self.period = None
 
         if julia is None:
             p = math.sqrt(((x - 1/4) ** 2) + (y*y))
@@ -206,7 +489,8 @@ class MandelEngine:
                 return True
 
         u, v = (x, y) if julia is None else julia
-        cycle = [None] * 500
+        # Brent's cycle detection, compare against a saved point that moves out at powers of two
+        check_x, check_y, check_at, check_len = x, y, -1, 1
         for i in range(self.max_iters):
             x, y = x * x - y * y + u, 2 * x * y + v
             dist = x * x + y * y
@@ -216,6 +500,14 @@ class MandelEngine:
                 self.final_dist = dist
                 return False
 
+            if x == check_x and y == check_y:
+                # The orbit repeated exactly, so it will never escape
+                self.period = i - check_at
+                return True
+            if i - check_at == check_len:
+                check_x, check_y, check_at = x, y, i
+                check_len *= 2
+
         return True
 
     def get_iter_level(self, x, y, pixel=None):
@@ -228,6 +520,12 @@ class MandelEngine:
         else:
             return escaped_at
 
+    def in_set(self, x, y):
+        # Same as get_iter_level(x, y) > self.max_iters, but uses the tile cache if it's on
+        if self.tiles is None:
+            return self.get_iter_level(x, y) > self.max_iters
+        return self.tiles.in_set(x, y)
+
     def seen_clean(self):
         # It's safe to remove some history, so do so if we need to
         if self.seen_cur_size >= 100_000:
@@ -247,17 +545,17 @@ class MandelEngine:
     def is_border(self, x, y):
         # Return True if this point is a "border", in other words, it is a point
         # along target iteration, and touches a point that has a higher iteration
-        if self.get_iter_level(x, y) > self.max_iters:
+        if self.in_set(x, y):
             return False, 0, 0
         
-        if self.get_iter_level(x - 1, y - 1) > self.max_iters: return True, -1, -1
-        if self.get_iter_level(x + 1, y - 1) > self.max_iters: return True, 1, -1
-        if self.get_iter_level(x + 1, y + 1) > self.max_iters: return True, 1, 1
-        if self.get_iter_level(x - 1, y + 1) > self.max_iters: return True, -1, 1
-        if self.get_iter_level(x, y - 1) > self.max_iters: return True, 0, -1
-        if self.get_iter_level(x + 1, y) > self.max_iters: return True, 1, 0
-        if self.get_iter_level(x, y + 1) > self.max_iters: return True, 0, 1
-        if self.get_iter_level(x - 1, y) > self.max_iters: return True, -1, 0
+        if self.in_set(x - 1, y - 1): return True, -1, -1
+        if self.in_set(x + 1, y - 1): return True, 1, -1
+        if self.in_set(x + 1, y + 1): return True, 1, 1
+        if self.in_set(x - 1, y + 1): return True, -1, 1
+        if self.in_set(x, y - 1): return True, 0, -1
+        if self.in_set(x + 1, y): return True, 1, 0
+        if self.in_set(x, y + 1): return True, 0, 1
+        if self.in_set(x - 1, y): return True, -1, 0
         
         return False, 0, 0
 
@@ -265,29 +563,100 @@ def show_msg(value):
     # Simple helper to show a message with a timestamp
     print(datetime.now(UTC).replace(tzinfo=None).strftime("%d %H:%M:%S: ") + value)
 
+class BorderPercs:
+    # The table of border percentages from a previous run, stored as a KD-tree so the
+    # nearest point to a location can be found without looking at every row.  The tree is
+    # implicit, each range of the order array is split on its middle item, alternating
+    # between x and y with each level
+    LEAF_SIZE = 8
+
+    def __init__(self, fn="border_percs.txt"):
+        self.rows = np.loadtxt(fn, delimiter=",", ndmin=2)
+        self.percs = self.rows[:, 0]
+        # Plain lists, since the lookups are done one item at a time
+        self.xs = self.rows[:, 1].tolist()
+        self.ys = self.rows[:, 2].tolist()
+        order = np.arange(len(self.rows))
+        self._build(order, 0, len(order), 0)
+        self.order = order.tolist()
+
+    def _build(self, order, lo, hi, depth):
+        if hi - lo <= self.LEAF_SIZE:
+            return
+        values = self.rows[order[lo:hi], 1 + (depth % 2)]
+        order[lo:hi] = order[lo:hi][np.argsort(values, kind="stable")]
+        mid = (lo + hi) // 2
+        self._build(order, lo, mid, depth + 1)
+        self._build(order, mid + 1, hi, depth + 1)
+
+    def nearest(self, x, y):
+        # Returns the index of the row closest to (x, y), the first one in the file on a tie
+        best = [None, math.inf]
+        self._search(x, y, 0, len(self.order), 0, best)
+        return best[0]
+
+    def _search(self, x, y, lo, hi, depth, best):
+        if hi - lo <= self.LEAF_SIZE:
+            todo = range(lo, hi)
+        else:
+            mid = (lo + hi) // 2
+            todo = [mid]
+        for at in todo:
+            i = self.order[at]
+            dist = math.sqrt(((x - self.xs[i]) ** 2) + ((y - self.ys[i]) ** 2))
+            if dist < best[1] or (dist == best[1] and i < best[0]):
+                best[0], best[1] = i, dist
+        if hi - lo <= self.LEAF_SIZE:
+            return
+        i = self.order[mid]
+        diff = (x - self.xs[i]) if depth % 2 == 0 else (y - self.ys[i])
+        near, far = ((lo, mid), (mid + 1, hi)) if diff < 0 else ((mid + 1, hi), (lo, mid))
+        self._search(x, y, near[0], near[1], depth + 1, best)
+        # Points on the far side are at least abs(diff) away, and a tie still counts
+        if abs(diff) <= best[1]:
+            self._search(x, y, far[0], far[1], depth + 1, best)
+
+    def perc(self, x, y):
+        return float(self.percs[self.nearest(x, y)])
+
+_border_percs = None
+
+def get_border_percs():
+    global _border_percs
+    if _border_percs is None:
+        _border_percs = BorderPercs()
+    return _border_percs
+
 def get_border_perc(x, y):
     # Determine how far along the border we are from a previous run
-    best, best_dist = None, None
-    with open("border_percs.txt", "rt") as f:
-        for row in f:
-            row = row.strip().split(",")
-            dist = math.sqrt(((x - float(row[1])) ** 2) + ((y - float(row[2])) ** 2))
-            if best is None or dist < best_dist:
-                best = float(row[0])
-                best_dist = dist
-    return best
+    return get_border_percs().perc(x, y)
 
 def find_mid_point(source_x, source_y, border_iter, pixel):
+    # Single point version of find_mid_points
+    return find_mid_points([(source_x, source_y)], border_iter, pixel)[0]
+
+def find_mid_points(points, border_iter, pixel):
+    # Walk each point towards the spot closest to the target iteration, returns
+    # a list of (x, y), or None where a point didn't end up close enough.  Every point
+    # takes the same steps, so each probe is one batch call for all of the points
     target_iter, target_dist = border_iter - 1, border_iter * border_iter
     if border_iter < 50:
         target_dist = 0
 
+    count = len(points)
+    in_set = np.empty(count, dtype=np.int32)
+    escaped_at = np.empty(count, dtype=np.int32)
+    final_dist = np.empty(count, dtype=np.float64)
+
+    def probe(tx, ty):
+        mandelbrot_native_helper.calc_batch(tx, ty, False, 0.0, 0.0, border_iter + 10, in_set, escaped_at, final_dist)
+        inside = in_set == 1
+        return np.where(inside, border_iter + 10_000, escaped_at), np.where(inside, 0.0, final_dist)
+
     scale = pixel
-    in_set, escaped_at, final_dist = mandelbrot_native_helper.calc(source_x, source_y, False, 0.0, 0.0, border_iter + 10)
-    if in_set == 1:
-        best_iter, best_dist, x, y = border_iter + 10_000, 0, source_x, source_y
-    else:
-        best_iter, best_dist, x, y = escaped_at, final_dist, source_x, source_y
+    x = np.array([pt[0] for pt in points], dtype=np.float64)
+    y = np.array([pt[1] for pt in points], dtype=np.float64)
+    best_iter, best_dist = probe(x, y)
 
     while 1e-15 < 1/scale:
         for dx, dy in [(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)]:
@@ -296,25 +665,334 @@ def find_mid_point(source_x, source_y, border_iter, pixel):
                 ox, oy = ox + dx, oy + dy
                 tx = x + ox / scale
                 ty = y + oy / scale
-                in_set, escaped_at, final_dist = mandelbrot_native_helper.calc(tx, ty, False, 0.0, 0.0, border_iter + 10)
-                if in_set == 1:
-                    escaped_at, final_dist = border_iter + 10_000, 0
-                better = False
-                if abs(target_iter - best_iter) > abs(target_iter - escaped_at):
-                    better = True
-                elif abs(target_iter - best_iter) == abs(target_iter - escaped_at):
-                    if abs(target_dist - best_dist) > abs(target_dist - final_dist):
-                        better = True
-                if better:
-                    best_iter, best_dist, x, y = escaped_at, final_dist, tx, ty
+                test_iter, test_dist = probe(tx, ty)
+                best_off, test_off = np.abs(target_iter - best_iter), np.abs(target_iter - test_iter)
+                better = (best_off > test_off) | ((best_off == test_off) & (np.abs(target_dist - best_dist) > np.abs(target_dist - test_dist)))
+                best_iter = np.where(better, test_iter, best_iter)
+                best_dist = np.where(better, test_dist, best_dist)
+                x = np.where(better, tx, x)
+                y = np.where(better, ty, y)
         scale *= 2
     if border_iter < 50:
-        return x, y
-    if best_iter == target_iter:
-        if abs(best_dist - target_dist) < 1e3:
+        good = np.ones(count, dtype=bool)
+    else:
+        good = (best_iter == target_iter) & (np.abs(best_dist - target_dist) < 1e3)
+    return [(float(x[i]), float(y[i])) if good[i] else None for i in range(count)]
+
+def find_first_border(bits):
+    # Start scanning in the center of the Mandelbrot, and walk right till we hit the border
+    x, y = 0, 0
+    while True:
+        is_border, _, _ = bits.is_border(x, y)
+        if is_border:
             return x, y
+        if bits.get_iter_level(x, y) < bits.max_iters:
+            raise Exception("Unable to find first border point!")
+        x += 1
+
+def space_trail(path, head, pixel, border_iter, precise_point, batch_size=256, mid_points=find_mid_points):
+    # Drop points along a path so we don't end up rendering millions of items, yields
+    # (lattice point, trail point) for each point kept, head is the last point kept before this path.
+    # mid_points is called in place of find_mid_points to refine each batch
+    spacing = OPTIONS["frame_spacing"]
+    if not precise_point:
+        for cur in path:
+            if head is None or math.sqrt(((head[0] - cur[0]) ** 2) + ((head[1] - cur[1]) ** 2)) / pixel >= spacing:
+                yield cur, (cur[0] / pixel, cur[1] / pixel)
+                head = cur
+        return
+
+    # A point that can't be refined doesn't move the head, so pick a batch of points as if they'll
+    # all refine, refine them together, and if one fails, pick again starting after that one.
+    # Picks made again often land on points already refined, so those aren't refined twice
+    at, refined = 0, {}
+    while at < len(path):
+        picks, pick_head = [], head
+        while at < len(path) and len(picks) < batch_size:
+            cur = path[at]
+            if pick_head is None or math.sqrt(((pick_head[0] - cur[0]) ** 2) + ((pick_head[1] - cur[1]) ** 2)) / pixel >= spacing:
+                picks.append(at)
+                pick_head = cur
+            at += 1
+        if len(picks) == 0:
+            break
+        todo = [i for i in picks if i not in refined]
+        if len(todo) > 0:
+            refined.update(zip(todo, mid_points([(path[i][0] / pixel, path[i][1] / pixel) for i in todo], border_iter, pixel)))
+        for i in picks:
+            nearest = refined.pop(i)
+            if nearest is None:
+                at = i + 1
+                break
+            yield path[i], nearest
+            head = path[i]
+
+def save_trail(trail):
+    # Keep the trail around, and save it if asked, using the columnar format for .trail files
+    OPTIONS["saved_trail"] = trail
+    if "SAVE_TRAIL" in os.environ:
+        fn = os.environ["SAVE_TRAIL"]
+        if fn.endswith(".trail"):
+            trail_file.write_trail(fn, trail, OPTIONS["border_iter"], OPTIONS["scan_size"], OPTIONS["frame_spacing"])
+        else:
+            with open(fn, "wb") as f:
+                pickle.dump(OPTIONS["saved_trail"], f)
+
+# The border is traced in segments between anchors, border points close to rows of
+# border_percs.txt.  An anchor usually isn't on the shortest way around, since the border is a
+# band of points, and the path bends out of its way to reach it.  So only the middle of each
+# segment is kept, and this many steps of each end, in the same units as border_percs.txt, are
+# traced again, from the middle of one segment to the middle of the next.  How far the path
+# bends depends on the shape of the band, not the length of the segment, so this is a fixed size
+EDGE_SEAM_SIZE = 0.05
+# Segments are given this many A* nodes for each step of the border between their anchors,
+# a segment that needs more than that has an anchor the rest of the border doesn't connect to
+EDGE_NODES_PER_STEP = 32
+EDGE_MIN_NODES = 2_000
+# A segment's scan skips points closest to a row of border_percs.txt that's more than this
+# much of the segment behind its start, so it doesn't wander back over the segment before it
+EDGE_WALL_FRACTION = 0.05
+# Points are grouped into cells this size, in the same units as border_percs.txt, to find
+# the row they're closest to
+EDGE_ROW_CELL = 0.0025
+# An anchor is only used if the border around it reaches at least this far, in the same units,
+# otherwise it's on a small island the rest of the border doesn't touch
+EDGE_ISLAND_SIZE = 0.02
+
+_edge_engine = None
+_edge_rows = {}
+
+def init_edge_worker(pixel, border_iter):
+    # Pool initializer for find_edge_parallel, each worker keeps one engine for every job it
+    # runs, so the tile cache stays warm from one anchor or segment to the next
+    global _edge_engine, _edge_rows
+    _edge_engine = MandelEngine(max_iters=border_iter, pixel=pixel)
+    _edge_rows = {}
+
+def edge_engine(job):
+    # The worker's engine, made here if the pool didn't make one for this job's scan
+    if _edge_engine is None or (_edge_engine.pixel, _edge_engine.max_iters) != (job["pixel"], job["border_iter"]):
+        init_edge_worker(job["pixel"], job["border_iter"])
+    return _edge_engine
+
+def edge_row(pixel, x, y):
+    # The row of border_percs.txt closest to a lattice point, looked up once for each cell.  The
+    # last row is the same point as the first, so it's treated as the first
+    size = max(1, int(pixel * EDGE_ROW_CELL))
+    cell = (x // size, y // size)
+    row = _edge_rows.get(cell)
+    if row is None:
+        percs = get_border_percs()
+        row = percs.nearest((cell[0] + 0.5) * size / pixel, (cell[1] + 0.5) * size / pixel) % (len(percs.rows) - 1)
+        _edge_rows[cell] = row
+    return row
+
+def find_island(bits, x, y, reach):
+    # If the border points connected to this one all stay within reach of it, returns them,
+    # otherwise None.  The points furthest out are followed first, so it's quick to get out of
+    # reach when it can
+    todo, seen, island = [(0, x, y)], {(x, y)}, [(x, y)]
+    while len(todo) > 0:
+        _, cx, cy = heapq.heappop(todo)
+        for ox, oy in [[cx - 1, cy - 1], [cx + 1, cy - 1], [cx - 1, cy + 1], [cx + 1, cy + 1], [cx + 1, cy], [cx - 1, cy], [cx, cy + 1], [cx, cy - 1]]:
+            if (ox, oy) not in seen:
+                seen.add((ox, oy))
+                if bits.is_border(ox, oy)[0]:
+                    dist = max(abs(ox - x), abs(oy - y))
+                    if dist > reach:
+                        return None
+                    heapq.heappush(todo, (-dist, ox, oy))
+                    island.append((ox, oy))
+    return island
+
+def find_edge_anchor(job):
+    # Worker for find_edge_parallel, finds the closest border point on the scan lattice
+    # to a point from border_percs.txt, looking in rings of growing size around it, and
+    # passing over points on islands
+    pixel = job["pixel"]
+    bits = edge_engine(job)
+    cx, cy = round(job["x"] * pixel), round(job["y"] * pixel)
+    islands = set()
+    for r in range(job["radius"] + 1):
+        if r == 0:
+            ring = [(cx, cy)]
+        else:
+            ring = [(cx + d, cy + oy) for d in range(-r, r + 1) for oy in [-r, r]]
+            ring += [(cx + ox, cy + d) for d in range(-r + 1, r) for ox in [-r, r]]
+        found = sorted(((x - cx) ** 2 + (y - cy) ** 2, x, y) for x, y in ring if bits.is_border(x, y)[0])
+        for _, x, y in found:
+            if (x, y) not in islands:
+                island = find_island(bits, x, y, job["island"])
+                if island is None:
+                    return x, y
+                islands.update(island)
     return None
 
+def trace_edge_segment(job):
+    # Worker for find_edge_parallel, finds a shortest path along the border between two anchor
+    # points, like find_edge's scan does.  It's an A* scan, the queue is ordered by the steps so
+    # far plus the fewest steps that could be left to the end, which is never too many, so the
+    # first time the end comes off the queue, it's by a shortest path.  If the job has a wall_row,
+    # points closest to the half of border_percs.txt before that row are skipped.  Gives up if the
+    # scan runs out of points, or gets too large, which is what happens when an anchor is on an
+    # island the rest of the border doesn't touch.  Returns the lattice points of the path, as
+    # arrays of x and y, without the end point, since that's the start of the next segment
+    pixel = job["pixel"]
+    bits = edge_engine(job)
+    wall_row = job.get("wall_row")
+    loop = len(get_border_percs().rows) - 1
+    (x, y), (tx, ty) = job["start"], job["end"]
+    if (x, y) == (tx, ty):
+        return job["index"], (array("q"), array("q"))
+    todo = PathStore(pixel)
+    todo.push(max(abs(tx - x), abs(ty - y)), x, y, -1)
+    # The steps and node index of the best way found to each border point, and
+    # every point that's been checked and can't be used
+    seen = {(x, y): (0, 0)}
+    skip = set()
+    while len(todo) > 0 and todo.node_count() <= job["max_nodes"]:
+        _, x, y, node = todo.pop()
+        if (x, y) == (tx, ty):
+            path = todo.path(todo.parents[node])
+            return job["index"], (array("q", [pt[0] for pt in path]), array("q", [pt[1] for pt in path]))
+        steps, best_node = seen[(x, y)]
+        if node != best_node:
+            # A shorter way to this point was found after this one was queued
+            continue
+        for ox, oy in [[x - 1, y - 1], [x + 1, y - 1], [x - 1, y + 1], [x + 1, y + 1], [x + 1, y], [x - 1, y], [x, y + 1], [x, y - 1]]:
+            known = seen.get((ox, oy))
+            if known is not None:
+                if known[0] <= steps + 1:
+                    continue
+            elif (ox, oy) in skip:
+                continue
+            elif not bits.is_border(ox, oy)[0] or (wall_row is not None and (ox, oy) != (tx, ty) and (edge_row(pixel, ox, oy) - wall_row) % loop >= loop // 2):
+                skip.add((ox, oy))
+                continue
+            seen[(ox, oy)] = (steps + 1, todo.node_count())
+            todo.push(steps + 1 + max(abs(tx - ox), abs(ty - oy)), ox, oy, node)
+    return job["index"], None
+
+def find_edge_mid_points(job):
+    # Worker for find_edge_parallel, refines one chunk of a batch of trail points
+    return find_mid_points(job["points"], job["border_iter"], job["pixel"])
+
+def trace_edge_spans(pool, anchors, base, show_msg):
+    # Trace the border between each pair of anchors in the pool, anchors are (lattice point, how
+    # far along the border it is in lattice steps, row of border_percs.txt).  A segment that fails
+    # is traced again without its wall, and if it fails again, it's joined with a neighbor,
+    # dropping the anchor between them.  Yields GUI messages, and returns the segments in order
+    # as ((i, j), (xs, ys)), where i and j are indexes into anchors
+    loop = len(get_border_percs().rows) - 1
+    spans = [(i, i + 1) for i in range(len(anchors) - 1)]
+    traced, unwalled = {}, set()
+    while True:
+        jobs = []
+        for i, j in spans:
+            if (i, j) not in traced:
+                steps = anchors[j][1] - anchors[i][1]
+                job = dict(base, index=(i, j), start=anchors[i][0], end=anchors[j][0], max_nodes=max(EDGE_MIN_NODES, int(EDGE_NODES_PER_STEP * steps)))
+                if (i, j) not in unwalled:
+                    job["wall_row"] = (anchors[i][2] - int((anchors[j][2] - anchors[i][2]) * EDGE_WALL_FRACTION)) % loop
+                jobs.append(job)
+        if len(jobs) == 0:
+            break
+        failed = []
+        for index, trail in pool.imap_unordered(trace_edge_segment, jobs):
+            if trail is not None:
+                traced[index] = trail
+            elif index not in unwalled:
+                unwalled.add(index)
+            else:
+                failed.append(index)
+            done = sum(1 for span in spans if span in traced)
+            show_msg(f"Border: {done:,} of {len(spans):,} segments traced, {len(failed):,} failed")
+            yield {"type": "msg", "msg": f"Border, {done:,} of {len(spans):,} segments"}
+        for index in failed:
+            if index not in spans:
+                # Already joined with another failed segment
+                continue
+            if len(spans) == 1:
+                raise Exception("Unable to find path to connect the start and end!")
+            at = spans.index(index)
+            if at + 1 < len(spans):
+                spans[at:at + 2] = [(spans[at][0], spans[at + 1][1])]
+            else:
+                spans[at - 1:at + 1] = [(spans[at - 1][0], spans[at][1])]
+    return [(span, traced[span]) for span in spans]
+
+def find_edge_parallel(show_msg=show_msg):
+    # Split the border into segments at points from border_percs.txt, trace each segment in a
+    # worker process, and stitch them back together.  Returns the trail, or yields GUI messages
+    pixel = OPTIONS["scan_size"]
+    border_iter = OPTIONS["border_iter"]
+    segments = OPTIONS["edge_segments"]
+    procs = OPTIONS["edge_procs"]
+    base = {"pixel": pixel, "border_iter": border_iter}
+    start = find_first_border(MandelEngine(max_iters=border_iter))
+
+    # How far along the border each row of border_percs.txt is, in scan lattice steps
+    rows = get_border_percs().rows
+    along = np.concatenate([[0.0], np.cumsum(np.hypot(np.diff(rows[:, 1]), np.diff(rows[:, 2])))]) * pixel
+    picks = [round(i * (len(rows) - 1) / segments) for i in range(1, segments)]
+
+    with multiprocessing.Pool(processes=procs, initializer=init_edge_worker, initargs=(pixel, border_iter)) as pool:
+        show_msg(f"Finding {len(picks):,} anchor points with {procs} workers")
+        yield {"type": "msg", "msg": "Finding Anchors"}
+        jobs = [dict(base, x=rows[i, 1], y=rows[i, 2], radius=int(pixel * 0.002) + 8, island=int(pixel * EDGE_ISLAND_SIZE)) for i in picks]
+        found = pool.map(find_edge_anchor, jobs)
+        # Each anchor is a lattice point, how far along the border it is, and its row
+        anchors = [(start, 0.0, 0)]
+        for pt, i in zip(found, picks):
+            if pt is not None and pt != anchors[-1][0] and pt != start:
+                anchors.append((pt, along[i], i))
+        anchors.append((start, along[-1], len(rows) - 1))
+        traced = yield from trace_edge_spans(pool, anchors, base, show_msg)
+
+        # Keep the middle of each segment, and trace the seams between them again.  Seam k runs
+        # from the end of middle k - 1, or the start, to the start of middle k, or back to the
+        # start.  If a seam can't be traced, the way the segments took through the anchor is used
+        middles, fallbacks = [], [(array("q"), array("q"))]
+        for span, (xs, ys) in traced:
+            lo = min(int(pixel * EDGE_SEAM_SIZE), len(xs) // 4)
+            hi = len(xs) - lo
+            fallbacks[-1] = (fallbacks[-1][0] + xs[:lo], fallbacks[-1][1] + ys[:lo])
+            middles.append((xs[lo:hi], ys[lo:hi]))
+            fallbacks.append((xs[hi - 1:], ys[hi - 1:]))
+        ends = [start] + [(xs[-1], ys[-1]) for xs, ys in middles]
+        jobs = []
+        for k, (xs, ys) in enumerate(fallbacks):
+            end = (middles[k][0][0], middles[k][1][0]) if k < len(middles) else start
+            jobs.append(dict(base, index=k, start=ends[k], end=end, max_nodes=max(EDGE_MIN_NODES, EDGE_NODES_PER_STEP * len(xs))))
+        seams = list(fallbacks)
+        for done, (k, trail) in enumerate(pool.imap_unordered(trace_edge_segment, jobs)):
+            if trail is not None:
+                seams[k] = trail
+            show_msg(f"Border: {done + 1:,} of {len(jobs):,} seams traced")
+            yield {"type": "msg", "msg": f"Border, {done + 1:,} of {len(jobs):,} seams"}
+
+        def pool_mid_points(points, border_iter, pixel):
+            # Split each batch of points to refine between the workers
+            size = -(-len(points) // procs)
+            jobs = [{"points": points[i:i + size], "border_iter": border_iter, "pixel": pixel} for i in range(0, len(points), size)]
+            return [pt for found in pool.map(find_edge_mid_points, jobs) for pt in found]
+
+        # Space out points along the whole border in order, carrying the last point kept from
+        # one piece to the next, which is the same as one pass over the border, like find_edge
+        show_msg("Spacing out trail points")
+        yield {"type": "msg", "msg": "Spacing Trail"}
+        final_trail, final_head = [], None
+        pieces = [seams[0]]
+        for k, (xs, ys) in enumerate(middles):
+            pieces += [(xs[:-1], ys[:-1]), seams[k + 1]]
+        for xs, ys in pieces:
+            for cur, nearest in space_trail(list(zip(xs, ys)), final_head, pixel, border_iter, OPTIONS["precise_point"], batch_size=256 * procs, mid_points=pool_mid_points):
+                final_trail.append(nearest)
+                final_head = cur
+    final_trail.append(final_trail[0])
+    show_msg(f"Found trail of {len(final_trail):,} items from {len(middles):,} segments")
+    return final_trail
+
 def find_edge(show_msg=show_msg):
     # State machine to find the border of the mandelbrot, does so by a simple A* scan around the border
     yield {"type": "msg", "msg": "Filling Edge"}
@@ -323,6 +1001,9 @@ def find_edge(show_msg=show_msg):
 
     if "saved_trail" in OPTIONS:
         precise_trail = OPTIONS["saved_trail"]
+    elif OPTIONS["edge_procs"] > 1:
+        precise_trail = yield from find_edge_parallel(show_msg=show_msg)
+        save_trail(precise_trail)
     else:
         # Figure out all the possible extra digits we can use for precision before
         # the double type no longer has any fraction bits left
@@ -340,14 +1021,7 @@ def find_edge(show_msg=show_msg):
         bits = MandelEngine(max_iters=border_iter)
 
         # Start scanning in the center of the Mandelbrot
-        x, y = 0, 0
-        while True:
-            is_border, add_x, add_y = bits.is_border(x, y)
-            if is_border:
-                break
-            if bits.get_iter_level(x, y) < border_iter:
-                raise Exception("Unable to find first border point!")
-            x += 1
+        x, y = find_first_border(bits)
 
         # Make sure the target final point is actually a border unit
         tx, ty = x, y
@@ -360,21 +1034,40 @@ def find_edge(show_msg=show_msg):
         # The point where the A* algo is allowed to start searching up
         unleash = False
 
-        # A priority queue to keep searching the "cheapest route"
-        todo = []
-        heapq.heappush(todo, (0, x, y, add_x, add_y, None))
-        todo_len = 1
+        # A priority queue to keep searching the "cheapest route", along with
+        # the parent of every node pushed so the route can be walked back
+        todo = PathStore(pixel)
+        cost = 0
+        cost_check = 0
+
+        # Pick up where a previous run left off if there's a checkpoint for it
+        checkpoint = None
+        if "RESUME_TRAIL" in os.environ:
+            checkpoint = ScanCheckpoint(os.environ["RESUME_TRAIL"])
+            resume = checkpoint.load()
+            if resume is not None:
+                if (resume["pixel"], resume["border_iter"], resume["precise_point"], resume["frame_spacing"], resume["tx"], resume["ty"]) != (pixel, border_iter, precise_point, OPTIONS["frame_spacing"], tx, ty):
+                    raise Exception("The checkpoint in RESUME_TRAIL is for a different scan!")
+                final_trail.extend(resume["trail"])
+                final_head = resume["final_head"]
+                unleash = resume["unleash"]
+                cost, x, y, cost_check = resume["cost"], resume["x"], resume["y"], resume["cost_check"]
+                bits.seen_cur, bits.seen_prev = resume["seen_cur"], resume["seen_prev"]
+                bits.seen_cur_size = len(bits.seen_cur)
+                show_msg(f"Resuming scan with {len(final_trail):,} frames at {x/pixel:0.4f} x {y/pixel:0.4f}")
+        todo.push(cost, x, y, -1)
+        next_checkpoint = time.time() + OPTIONS["checkpoint_secs"]
 
         # Dump out some message every now and then for the GUI mode
         at = time.time() + 0.5
-        cost_check = 0
 
         while True:
-            cost, x, y, add_x, add_y, history = heapq.heappop(todo)
-            todo_len -= 1
+            cost, x, y, node = todo.pop()
+            parent = todo.parents[node]
+            todo_len = len(todo)
 
             force_cost_check = False
-            if cost >= cost_check and history is not None and todo_len == 0:
+            if cost >= cost_check and parent != -1 and todo_len == 0:
                 force_cost_check = True
             elif cost >= 100 and (x, y) == (tx, ty):
                 force_cost_check = True
@@ -391,27 +1084,23 @@ def find_edge(show_msg=show_msg):
                 # to shrink down memory usage.  This is also where we drop points along the edge
                 # so we don't end up rendering millions of items.
                 cost_check += 5000
-                temp = deque()
-                # Invert the queue, and pop out the item we care about
-                while history is not None:
-                    temp.append(history[1:5])
-                    history = history[5]
-                # Place the inverted queue on our final queue
-                while len(temp):
-                    cur = temp.pop()
-                    if final_head is None or math.sqrt(((final_head[0] - cur[0]) ** 2) + ((final_head[1] - cur[1]) ** 2)) / pixel >= OPTIONS["frame_spacing"]:
-                        if precise_point:
-                            nearest = find_mid_point(cur[0] / pixel, cur[1] / pixel, border_iter, pixel)
-                        else:
-                            nearest = (cur[0] / pixel, cur[1] / pixel)
-                        if nearest is not None:
-                            final_trail.append(nearest)
-                            final_head = cur
-                history = None
+                # Walk back up to the last root, and add that path to our final queue
+                for cur, nearest in space_trail(todo.path(parent), final_head, pixel, border_iter, precise_point):
+                    final_trail.append(nearest)
+                    final_head = cur
+                # Everything up to here is in the final queue, and nothing else is in the
+                # queue, so drop all of the nodes and start over with this one as the root
+                node = todo.reset(x, y)
                 if (x, y) == (tx, ty):
                     # We hit the end point, so we're all done!
                     break
 
+                # This is the only point left to look at, so it's a good time to save off
+                # the state of the scan, as long as it's been a while since the last time
+                if checkpoint is not None and time.time() >= next_checkpoint:
+                    checkpoint.append(pixel, border_iter, precise_point, (tx, ty), cost, x, y, cost_check, unleash, final_head, final_trail, bits)
+                    next_checkpoint = time.time() + OPTIONS["checkpoint_secs"]
+
                 # Temporary hack to limit the output based on the number of frames
                 # if len(final_trail) >= 10:
                 #     break
@@ -430,7 +1119,11 @@ def find_edge(show_msg=show_msg):
             else:
                 if time.time() >= at:
                     perc = get_border_perc(x / pixel, y / pixel)
-                    show_msg(f"Border: {perc:0.2f}%, $ {cost:.2e}, F {len(final_trail):,}, Q {todo_len:3,}, C {bits.seen_cur_size:9,}, @ {x/pixel:0.4f} x {y/pixel:0.4f}")
+                    tiles = "" if bits.tiles is None else f", T {len(bits.tiles):,} {bits.tiles.hit_rate() * 100:0.1f}%"
+                    peak = peak_memory()
+                    if peak is None:
+                        peak = todo.peak_bytes()
+                    show_msg(f"Border: {perc:0.2f}%, $ {cost:.2e}, F {len(final_trail):,}, Q {todo_len:3,}, N {todo.node_count():,}, C {bits.seen_cur_size:9,}{tiles}, M {peak / 1048576:,.0f}MB, @ {x/pixel:0.4f} x {y/pixel:0.4f}")
                     at = time.time() + 60
 
             # Check all the touching points of this
@@ -452,8 +1145,7 @@ def find_edge(show_msg=show_msg):
                     is_border, new_add_x, new_add_y = bits.is_border(ox, oy)
                     if is_border:
                         # Ok, this point is possibly part of a path, go ahead and add it to our queue
-                        heapq.heappush(todo, (cost + 1, ox, oy, new_add_x, new_add_y, (cost, x, y, add_x, add_y, history)))
-                        todo_len += 1
+                        todo.push(cost + 1, ox, oy, node)
 
         if _show_gui:
             if not OPTIONS["save_edge"]:
@@ -511,11 +1203,7 @@ def find_edge(show_msg=show_msg):
         show_msg(f"Found trail of {len(final_trail):,} items")
 
         precise_trail = final_trail
-
-        OPTIONS["saved_trail"] = precise_trail
-        if "SAVE_TRAIL" in os.environ:
-            with open(os.environ["SAVE_TRAIL"], "wb") as f:
-                pickle.dump(OPTIONS["saved_trail"], f)
+        save_trail(precise_trail)
 
     if OPTIONS["save_edge"]:
         for x, y in precise_trail:
@@ -554,21 +1242,32 @@ def dupe_frame(source, dest):
     yield {"type": "dupe_frame", "source": source, "dest": dest}
     yield None
 
+def mark_done(row_no):
+    # State machine to note a row from frames.jsonl is done, once everything before it has run
+    yield {"type": "mark_done", "row_no": row_no}
+    yield None
+
 def set_target(x, y):
     # State machine to note a specific point of which point we're using for the Julia
     yield {"type": "set_target", "x": x, "y": y}
     yield None
 
-def multiproc_worker(row):
+def multiproc_worker(row, threads=1):
     # This is the main worker for a process being called from multiproc mode
     # Just a slimmed down version of main() that does no UI, and only works
-    # on one frame then exits
+    # on one frame then exits.  With vector_render, threads is passed on to render_grid
 
     if os.path.isfile("abort.txt"):
         return None
 
-    engines = []
     state = State()
+    if OPTIONS["vector_render"] and row["cmd"] == "draw":
+        # No need for the event stream, just render the final pass directly
+        if not os.path.isfile(os.path.join("data", row["dest"])):
+            render_frame(state, row, threads)
+        return row['dest']
+
+    engines = []
     add_frame(engines, row)
     for engine in engines:
         while True:
@@ -578,6 +1277,8 @@ def multiproc_worker(row):
                 break
             elif job['type'] == 'draw_mand':
                 proc = handle_draw_mand
+            elif job['type'] == 'draw_mand_frame':
+                proc = handle_draw_mand_frame
             elif job['type'] == 'save_frame':
                 proc = handle_save_frame
             elif job['type'] == 'dupe_frame':
@@ -591,62 +1292,153 @@ def multiproc_worker(row):
     # Just return something so the caller knows what we did
     return row['dest']
 
+def render_frame(state, row, threads=1):
+    # Render a frame without any events, only the last pass shows up in the final 
+    # image, so that's the only one to calculate
+    passes = [skip for skip in _MAND_PASSES if skip >= row["mand"].get("max_skip", 0)]
+    handle_set_target(state, {"type": "set_target", **row["set"]})
+    if len(passes) > 0:
+        args = {key: value for key, value in row["mand"].items() if key != "max_skip"}
+        rgb, escape, smoothed = calc_mand_pass(passes[-1], threads=threads, **args)
+        handle_draw_mand_frame(state, {
+            "type": "draw_mand_frame",
+            "skip": passes[-1],
+            "new": np.ones(escape.shape, dtype=bool),
+            "rgb": rgb,
+            "escape": escape,
+            "smoothed": smoothed,
+        })
+    handle_save_frame(state, {"type": "save_frame", "fn": row["dest"]}, show_msg=lambda x: None)
+
+def render_jobs(jobs):
+    # With vector_render, each frame is one render_grid call that already uses every core with
+    # the GIL released, so frames are rendered one at a time in this process.  Otherwise, each
+    # frame is handed to a worker process
+    if OPTIONS["vector_render"]:
+        for row in jobs:
+            yield multiproc_worker(row, threads=OPTIONS.get("procs", 0))
+    else:
+        args = {}
+        if "procs" in OPTIONS:
+            args["processes"] = OPTIONS["procs"]
+        with multiprocessing.Pool(**args) as pool:
+            yield from pool.imap_unordered(multiproc_worker, jobs)
+
 def main_multiproc():
     # Simplified version of main() that launches multiple workers on different cores
     if os.path.isfile("abort.txt"):
         os.unlink("abort.txt")
 
     show_msg("Working...")
-    jobs, dupes = [], defaultdict(list)
-    with open(os.path.join("data", "frames.jsonl")) as f:
-        # Pull in work units
-        for row in f:
-            row = json.loads(row)
-            if not os.path.isfile(os.path.join("data", row["dest"])):
-                if "requires" in row:
-                    dupes[row["requires"]].append(row)
-                else:
-                    jobs.append(row)
+    jobs, dupes, row_nos = [], defaultdict(list), {}
+    # Pull in work units, the index knows which ones are already done
+    index = get_job_index()
+    for row_no, row in index.pending():
+        row_nos[row["dest"]] = row_no
+        if "requires" in row:
+            dupes[row["requires"]].append(row)
+        else:
+            jobs.append(row)
+    show_msg(f"{len(jobs):,} frames and {sum(len(x) for x in dupes.values()):,} dupes left to do")
         
-    # Start the workers
-    args = {}
-    if "procs" in OPTIONS:
-        args["processes"] = OPTIONS["procs"]
-    with multiprocessing.Pool(**args) as pool:
-        for fn in pool.imap_unordered(multiproc_worker, jobs):
-            if fn is not None:
-                show_msg(f"Wrote {fn}")
-                if OPTIONS["multiproc_sync"]:
-                    subprocess.check_call(["python3", "sync.py", "single", fn])
-                # Make sure to run any processes that depend on this one
-                engines = []
-                for row in dupes[fn]:
-                    add_frame(engines, row)
-                for engine in engines:
-                    while True:
-                        job = next(engine)
-                        if job is None:
-                            break
-                        elif job['type'] == 'dupe_frame':
-                            handle_dupe_frame(State(), job)
-                            if OPTIONS["multiproc_sync"]:
-                                subprocess.check_call(["python3", "sync.py", "single", job["dest"]])
-    
+    # Dupes are made on their own thread, so they don't hold up collecting results.  The
+    # index isn't thread safe, so the rows they finish are passed back to be marked here
+    dupe_todo, dupe_done = Queue(), Queue()
+    def dupe_worker():
+        while True:
+            rows = dupe_todo.get()
+            if rows is None:
+                break
+            try:
+                for row in rows:
+                    how = handle_dupe_frame(State(), {"type": "dupe_frame", "source": row["source"], "dest": row["dest"]})
+                    if OPTIONS["multiproc_sync"]:
+                        subprocess.check_call(["python3", "sync.py", "single", frame_dupes.MANIFEST if how == "manifest" else row["dest"]])
+                    dupe_done.put(row_nos[row["dest"]])
+            except Exception as e:
+                # Hand the error to the main thread, it stops everything there
+                dupe_done.put(e)
+                break
+    dupe_thread = threading.Thread(target=dupe_worker, daemon=True)
+    dupe_thread.start()
+
+    def mark_dupes_done():
+        while True:
+            try:
+                row_no = dupe_done.get_nowait()
+            except Empty:
+                break
+            if isinstance(row_no, Exception):
+                raise Exception(f"Unable to make dupe frames: {row_no}") from row_no
+            index.mark_done(row_no)
+
+    # Dupes of frames that were done on an earlier run won't be set off by a worker finishing
+    job_dests = set(row["dest"] for row in jobs)
+    for source, rows in list(dupes.items()):
+        if source not in job_dests:
+            if os.path.isfile(os.path.join("data", source)):
+                dupe_todo.put(rows)
+            else:
+                show_msg(f"WARNING: {len(rows):,} dupes of {source} can't be made, it's missing and not queued")
+
+    for fn in render_jobs(jobs):
+        if fn is not None:
+            show_msg(f"Wrote {fn}")
+            index.mark_done(row_nos[fn])
+            if OPTIONS["multiproc_sync"]:
+                subprocess.check_call(["python3", "sync.py", "single", fn])
+            # Make sure to run any processes that depend on this one
+            if len(dupes[fn]) > 0:
+                dupe_todo.put(dupes[fn])
+        mark_dupes_done()
+
+    dupe_todo.put(None)
+    dupe_thread.join()
+    mark_dupes_done()
+    close_job_index()
     show_msg("Done")
 
-def add_frame(engines, row):
-    # Helper to create the state machine workers for a given frame
+_job_index = None
+def get_job_index():
+    # The index for data/frames.jsonl, rows written before there was an index are checked
+    # against the disk the first time they're seen
+    global _job_index
+    if _job_index is None:
+        if not os.path.isdir("data"):
+            os.mkdir("data")
+        _job_index = job_index.JobIndex(
+            os.path.join("data", "frames.jsonl"), 
+            probe=lambda row: os.path.isfile(os.path.join("data", row["dest"])),
+        )
+    return _job_index
+
+def close_job_index():
+    global _job_index
+    if _job_index is not None:
+        _job_index.close()
+        _job_index = None
+
+def handle_mark_done(state, job, show_msg=show_msg):
+    # Handle a row from frames.jsonl being done
+    get_job_index().mark_done(job["row_no"])
+
+def add_frame(engines, row, row_no=None):
+    # Helper to create the state machine workers for a given frame.  If the row is from the
+    # job index, row_no is its row number, the index already knows it's not done, and it's
+    # marked as done once the frame is written
     if isinstance(row, str):
         row = json.loads(row)
-    if not os.path.isfile(os.path.join("data", row["dest"])):
+    if row_no is not None or not os.path.isfile(os.path.join("data", row["dest"])):
         if row["cmd"] == "draw":
             engines.append(set_target(**row["set"]))
-            engines.append(draw_mand(**row["mand"]))
+            engines.append((draw_mand_frame if OPTIONS["vector_render"] else draw_mand)(**row["mand"]))
             engines.append(save_frame(row["dest"]))
         elif row["cmd"] == "dupe":
             engines.append(dupe_frame(row["source"], row["dest"]))
         else:
             raise Exception(f"Unknown command: {row}")
+        if row_no is not None:
+            engines.append(mark_done(row_no))
 
 def handle_draw_mand(state, job, show_msg=show_msg):
     # Handle a draw event from a state machine
@@ -676,12 +1468,50 @@ def handle_draw_mand(state, job, show_msg=show_msg):
                 if _show_gui:
                     state.screen.set_at(((job['x'] + xo) // _gui_shrink, (job['y'] + yo) // _gui_shrink), job['rgb'])
 
+def handle_draw_mand_frame(state, job, show_msg=show_msg):
+    # Handle a draw event for an entire pass from draw_mand_frame, same as handle_draw_mand
+    skip = job['skip']
+    grid_y, grid_x = np.nonzero(job['new'])
+    pt_x, pt_y = grid_x * skip, grid_y * skip
+    rgb = job['rgb'][grid_y, grid_x]
+    escape = job['escape'][grid_y, grid_x]
+    smoothed = job['smoothed'][grid_y, grid_x]
+
+    if state.target is None:
+        # When drawing the mandelbrot, save it so we 
+        # can quickly draw it later on top of the Julia set
+        alpha = np.where(np.isnan(smoothed), 1.0, (np.clip(smoothed, 1, 4) - 1) / 3)
+        keep = alpha > 0
+        if keep.any():
+            state.preview.append((alpha[keep], rgb[keep], pt_x[keep], pt_y[keep]))
+
+    # Track the pool, so we can highlight it later, useful to see where
+    # things are happening
+    pool = (escape < 0) | (escape >= 10)
+    if pool.any():
+        if state.pool_mask is None:
+            state.pool_mask = np.zeros((_height, _width), dtype=bool)
+            state.pool_rgb = np.zeros((_height, _width, 3), dtype=np.uint8)
+        state.pool_mask[pt_y[pool], pt_x[pool]] = True
+        state.pool_rgb[pt_y[pool], pt_x[pool]] = rgb[pool]
+
+    # And light up the pixels we were told about, each one covers a skip by skip block
+    block_rgb = np.repeat(np.repeat(job['rgb'], skip, axis=0), skip, axis=1)[:_height, :_width]
+    block_new = np.repeat(np.repeat(job['new'], skip, axis=0), skip, axis=1)[:_height, :_width]
+    state.pixels[block_new] = block_rgb[block_new]
+    if _show_gui:
+        update_screen(state)
+
+def update_screen(state):
+    # Copy the entire image to the GUI in one go
+    view = state.pixels[::_gui_shrink, ::_gui_shrink][:_height // _gui_shrink, :_width // _gui_shrink]
+    pygame.surfarray.blit_array(state.screen, view.transpose(1, 0, 2))
+
 def handle_dupe_frame(state, job, show_msg=show_msg):
-    # Handle a dupe frame event, just copy the image
-    show_msg(f"Dupe {job['source']} to {job['dest']}")
-    with open(os.path.join("data", job['source']), 'rb') as f_source:
-        with open(os.path.join("data", job['dest']), 'wb') as f_dest:
-            f_dest.write(f_source.read())
+    # Handle a dupe frame event, link to the image if possible, see frame_dupes
+    how = frame_dupes.dupe(os.path.join("data", job['source']), os.path.join("data", job['dest']), OPTIONS["dupe_mode"])
+    show_msg(f"Dupe {job['source']} to {job['dest']} ({how})")
+    return how
 
 def handle_save_frame(state, job, show_msg=show_msg):
     # Handle a save frame event
@@ -690,6 +1520,13 @@ def handle_save_frame(state, job, show_msg=show_msg):
     if os.path.isfile(os.path.join("data", "frame_preview.dat")):
         with open(os.path.join("data", "frame_preview.dat"), "rb") as f:
             for alpha, rgb, x, y in pickle.load(f):
+                if isinstance(alpha, np.ndarray):
+                    # A whole pass from the vectorized renderer
+                    alpha = alpha[:, None]
+                    state.pixels[y, x] = (rgb * alpha + state.pixels[y, x] * (1 - alpha)).astype(np.uint8)
+                    if _show_gui:
+                        update_screen(state)
+                    continue
                 rgb[0] = int(rgb[0] * alpha + state.pixels[y, x, 0] * (1 - alpha))
                 rgb[1] = int(rgb[1] * alpha + state.pixels[y, x, 1] * (1 - alpha))
                 rgb[2] = int(rgb[2] * alpha + state.pixels[y, x, 2] * (1 - alpha))
@@ -816,6 +1653,8 @@ class State:
     # with the information necessary to save the image
     def __init__(self):
         self.pool = {}
+        self.pool_mask = None
+        self.pool_rgb = None
         self.preview = []
         self.pixels = np.zeros(
             (
@@ -830,7 +1669,7 @@ class State:
         self.extra = None
 
 def append_mand(engines):
-    engines.append(draw_mand(
+    engines.append((draw_mand_frame if OPTIONS["vector_render"] else draw_mand)(
         alias=1 if (OPTIONS["quick_mode"] or OPTIONS["no_alias"]) else 2, 
         size=_mand_loc_size, 
         center_x=_mand_loc_x, 
@@ -857,9 +1696,8 @@ def main():
     # create some starter state machines, they will add others unless
     # we're in View only mode
     if os.path.isfile(os.path.join("data", "frames.jsonl")) and not OPTIONS["view_only"] and OPTIONS["save_results"]:
-        with open(os.path.join("data", "frames.jsonl")) as f:
-            for row in f:
-                add_frame(engines, row)
+        for row_no, row in get_job_index().pending():
+            add_frame(engines, row, row_no)
     else:
         append_mand(engines)
         if not OPTIONS["view_only"]:
@@ -948,6 +1786,8 @@ def main():
                     handle_dupe_frame(state, job)
                 elif job['type'] == 'save_frame':
                     handle_save_frame(state, job)
+                elif job['type'] == 'mark_done':
+                    handle_mark_done(state, job)
                 elif job['type'] == 'msg':
                     # A simple message, either update the caption if we have on, or just dump to stdout
                     if _show_gui:
@@ -1013,13 +1853,11 @@ def main():
                         fn = f"frame_{frame_number:05d}.png"
                         frame_number += 1
                         row = {"cmd": "draw", "mand": args_mand, "set": args_set, "dest": fn}
-                        if OPTIONS["draw_julias"]:
-                            add_frame(engines, row)
+                        row_no = None
                         if OPTIONS["save_results"]:
-                            if not os.path.isdir("data"):
-                                os.mkdir("data")
-                            with open(os.path.join("data", "frames.jsonl"), "at") as f:
-                                f.write(json.dumps(row) + "\n")
+                            row_no = get_job_index().append(row)
+                        if OPTIONS["draw_julias"]:
+                            add_frame(engines, row, row_no)
 
                         dupes = 0
                         if OPTIONS["add_extra_frames"]:
@@ -1034,19 +1872,21 @@ def main():
                                 fn = f"frame_{frame_number:05d}.png"
                                 frame_number += 1
                                 row = {"cmd": "dupe", "source": source_fn, "dest": fn, "requires": source_fn}
-                                add_frame(engines, row)
+                                row_no = None
                                 if OPTIONS["save_results"]:
-                                    if not os.path.isdir("data"):
-                                        os.mkdir("data")
-                                    with open(os.path.join("data", "frames.jsonl"), "at") as f:
-                                        f.write(json.dumps(row) + "\n")
+                                    row_no = get_job_index().append(row)
+                                add_frame(engines, row, row_no)
                 elif job['type'] == 'draw_mand':
                     handle_draw_mand(state, job)
+                elif job['type'] == 'draw_mand_frame':
+                    handle_draw_mand_frame(state, job)
 
             if _show_gui:
                 pygame.display.flip()
                 pygame.display.update()
 
+    close_job_index()
+
 if __name__ == "__main__":
     show_flags()
     if OPTIONS["multiproc"]:
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import shutil
+import sys
+import threading
+
+# Dupe frames are the same image under another name.  Rather than writing out a full copy,
+# they're hard linked, or reflinked on filesystems that can share data between files.  If
+# neither works, the dupe is noted in a manifest in the same directory, which is expanded
+# into real files, or into an ffmpeg concat list, when the video is put together
+MANIFEST = "dupes.jsonl"
+# How a dupe can be made, "link" tries links first, and falls back to the manifest if there is one
+MODES = ("link", "copy", "manifest")
+# ioctl to clone one file's data into another, from linux/fs.h
+FICLONE = 0x40049409
+
+_manifest_lock = threading.Lock()
+
+def clear_tmp(tmp):
+    # A temp file left behind by a crash may be a hard link to the source, so writing into it
+    # would overwrite the source.  Always start from a new file instead
+    if os.path.lexists(tmp):
+        os.unlink(tmp)
+
+def hardlink(source, dest):
+    # Returns True if dest is now a hard link to source
+    clear_tmp(dest + ".tmp")
+    try:
+        os.link(source, dest + ".tmp")
+    except (OSError, AttributeError):
+        return False
+    os.replace(dest + ".tmp", dest)
+    return True
+
+def reflink(source, dest):
+    # Returns True if dest is now a copy of source sharing the same data on disk
+    if not sys.platform.startswith("linux"):
+        return False
+    import fcntl
+    clear_tmp(dest + ".tmp")
+    try:
+        f_source = open(source, "rb")
+    except OSError:
+        return False
+    with f_source:
+        # Only ever clone into a file made here
+        with open(dest + ".tmp", "xb") as f_dest:
+            try:
+                fcntl.ioctl(f_dest.fileno(), FICLONE, f_source.fileno())
+                cloned = True
+            except OSError:
+                cloned = False
+    if not cloned:
+        os.unlink(dest + ".tmp")
+        return False
+    os.replace(dest + ".tmp", dest)
+    return True
+
+def copy(source, dest):
+    clear_tmp(dest + ".tmp")
+    with open(source, "rb") as f_source, open(dest + ".tmp", "xb") as f_dest:
+        shutil.copyfileobj(f_source, f_dest)
+    os.replace(dest + ".tmp", dest)
+
+def add_to_manifest(source, dest):
+    # Note that dest is a dupe of source, both are stored relative to the manifest's directory
+    base = os.path.dirname(source)
+    with _manifest_lock:
+        with open(os.path.join(base, MANIFEST), "at") as f:
+            f.write(json.dumps({"source": os.path.basename(source), "dest": os.path.relpath(dest, base)}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+def dupe(source, dest, mode="link", use_manifest=True):
+    # Make dest a dupe of source, returns how it was done: "hardlink", "reflink", "copy", or "manifest"
+    if mode not in MODES:
+        raise Exception(f"Unknown dupe mode: {mode}")
+    if mode == "link":
+        if hardlink(source, dest):
+            return "hardlink"
+        if reflink(source, dest):
+            return "reflink"
+    if mode == "manifest" or (mode == "link" and use_manifest):
+        add_to_manifest(source, dest)
+        return "manifest"
+    copy(source, dest)
+    return "copy"
+
+def read_manifest(base):
+    # Returns {dest: source} for every dupe in the manifest, later entries win
+    ret = {}
+    fn = os.path.join(base, MANIFEST)
+    if os.path.isfile(fn):
+        with open(fn) as f:
+            for row in f:
+                if len(row.strip()) > 0:
+                    row = json.loads(row)
+                    ret[row["dest"]] = row["source"]
+    return ret
+
+def expand_manifest(base):
+    # Turn every dupe in the manifest into a real file, then remove the manifest.  Returns
+    # the number of files created
+    dupes = read_manifest(base)
+    created = 0
+    for dest, source in sorted(dupes.items()):
+        if not os.path.isfile(os.path.join(base, dest)):
+            dupe(os.path.join(base, source), os.path.join(base, dest), "link", use_manifest=False)
+            created += 1
+    if os.path.isfile(os.path.join(base, MANIFEST)):
+        os.unlink(os.path.join(base, MANIFEST))
+    return created
+
+def write_concat_list(base, fn, frame_rate, prefix="frame_", suffix=".png"):
+    # Write an ffmpeg concat demuxer list of every frame in base, in name order, with dupes in the
+    # manifest pointing at their source, so a video can be made without expanding the manifest.
+    # Use with: ffmpeg -f concat -safe 0 -i fn ...  Returns the number of frames
+    dupes = read_manifest(base)
+    names = set(dupes)
+    for cur in os.listdir(base):
+        if cur.startswith(prefix) and cur.endswith(suffix):
+            names.add(cur)
+    names = sorted(names)
+    with open(fn, "wt") as f:
+        for name in names:
+            path = os.path.abspath(os.path.join(base, dupes.get(name, name))).replace("'", "'\\''")
+            f.write(f"file '{path}'\n")
+            f.write(f"duration {1 / frame_rate:.8f}\n")
+    return len(names)
+
+if __name__ == "__main__":
+    print("This module is not meant to be run directly")
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+
+from scipy.ndimage import uniform_filter
+import numpy as np
+
+# The same SSIM that skimage.metrics.structural_similarity calculates with its defaults, but
+# split so the parts that only depend on one frame are calculated once per frame.  When walking
+# frames in order, each frame's statistics are used for the pair on either side of it, and only
+# the cross term needs to be calculated for each pair
+WIN_SIZE = 7
+K1 = 0.01
+K2 = 0.03
+# Sample covariance over the window
+COV_NORM = (WIN_SIZE ** 2) / (WIN_SIZE ** 2 - 1)
+
+class FrameStats:
+    # Everything SSIM needs from one frame
+    __slots__ = ["im", "ux", "ux_sq", "vx"]
+    def __init__(self, frame):
+        self.im = np.asarray(frame).astype(np.float64, copy=False)
+        self.ux = uniform_filter(self.im, size=WIN_SIZE)
+        self.ux_sq = self.ux ** 2
+        uxx = uniform_filter(self.im * self.im, size=WIN_SIZE)
+        self.vx = COV_NORM * (uxx - self.ux * self.ux)
+
+def ssim(a, b, data_range=256):
+    # SSIM between two FrameStats
+    uxy = uniform_filter(a.im * b.im, size=WIN_SIZE)
+    vxy = COV_NORM * (uxy - a.ux * b.ux)
+
+    c1 = (K1 * data_range) ** 2
+    c2 = (K2 * data_range) ** 2
+    a1 = 2 * a.ux * b.ux + c1
+    a2 = 2 * vxy + c2
+    b1 = a.ux_sq + b.ux_sq + c1
+    b2 = a.vx + b.vx + c2
+    s = (a1 * a2) / (b1 * b2)
+
+    # Ignore the filter radius strip around the edges
+    pad = (WIN_SIZE - 1) // 2
+    return s[pad:-pad, pad:-pad].mean(dtype=np.float64)
+
+def ssim_stream(frames, data_range=256):
+    # Given frames in order, yield the SSIM of each frame with the one after it
+    last = None
+    for frame in frames:
+        cur = FrameStats(frame)
+        if last is not None:
+            yield ssim(last, cur, data_range)
+        last = cur
+
+if __name__ == "__main__":
+    print("This module is not meant to be run directly")
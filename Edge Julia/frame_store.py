@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+import lzma
+import numpy as np
+import os
+import pickle
+import struct
+import zlib
+try:
+    # zstd decodes faster than zlib, but isn't required
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Each encoded frame starts with this, followed by the codec, the frame's shape, and the data
+MAGIC = b"EJF"
+RECORD = struct.Struct("<3sBII")
+CODEC_ZLIB = 1
+CODEC_ZSTD = 2
+# The index is one fixed size entry per frame number: offset into the data file and length,
+# with a length of 0 for frames that aren't stored yet
+INDEX = struct.Struct("<QQ")
+
+def encode_frame(frame, allow_zstd=True):
+    # Turn a 2D uint8 frame into bytes, using the fastest codec we have, and that
+    # whoever reads it has when allow_zstd is False
+    frame = np.ascontiguousarray(frame, dtype=np.uint8)
+    if zstandard is not None and allow_zstd:
+        codec, data = CODEC_ZSTD, zstandard.ZstdCompressor(level=3).compress(frame.tobytes())
+    else:
+        codec, data = CODEC_ZLIB, zlib.compress(frame.tobytes(), 1)
+    return RECORD.pack(MAGIC, codec, frame.shape[0], frame.shape[1]) + data
+
+def decode_frame(data):
+    # Turn bytes from encode_frame back into a frame, this also handles the older
+    # lzma compressed pickles that used to be stored in the database
+    if data[:len(MAGIC)] != MAGIC:
+        return pickle.loads(lzma.decompress(data))
+    _, codec, width, height = RECORD.unpack_from(data, 0)
+    data = memoryview(data)[RECORD.size:]
+    if codec == CODEC_ZSTD:
+        if zstandard is None:
+            raise Exception("Frame is compressed with zstd, but zstandard isn't installed")
+        data = zstandard.ZstdDecompressor().decompress(data, max_output_size=width * height)
+    else:
+        data = zlib.decompress(data)
+    return np.frombuffer(data, dtype=np.uint8).reshape(width, height)
+
+class FrameStore:
+    # Frames addressed by frame number.  Encoded frames are appended to a data file, and
+    # a fixed stride index file says where each frame lives
+    def __init__(self, base_fn):
+        self.data_fn = base_fn + ".frames"
+        self.index_fn = base_fn + ".frames.idx"
+        self._data = None
+        self._index = None
+        self._pid = None
+
+    def _open(self):
+        # Files are opened unbuffered, once per process.  A forked child shares the parent's file
+        # positions, so it gets its own files, and reads don't use the file position at all
+        if self._pid != os.getpid():
+            self.close()
+        if self._data is None:
+            for fn in [self.data_fn, self.index_fn]:
+                if not os.path.isfile(fn):
+                    with open(fn, "wb"):
+                        pass
+            self._data = open(self.data_fn, "r+b", buffering=0)
+            self._index = open(self.index_fn, "r+b", buffering=0)
+            self._pid = os.getpid()
+
+    def close(self):
+        for f in [self._data, self._index]:
+            if f is not None:
+                f.close()
+        self._data, self._index = None, None
+        self._pid = None
+
+    def put(self, frame_no, data):
+        # Store an encoded frame, the index entry is only written after the data is
+        self._open()
+        self._data.seek(0, os.SEEK_END)
+        offset = self._data.tell()
+        self._data.write(data)
+        self._index.seek(frame_no * INDEX.size)
+        self._index.write(INDEX.pack(offset, len(data)))
+
+    def flush(self):
+        # Make sure everything put so far is on disk, call before marking frames as done elsewhere
+        if self._data is not None and self._pid == os.getpid():
+            for f in [self._data, self._index]:
+                f.flush()
+                os.fsync(f.fileno())
+
+    def get_data(self, frame_no):
+        # The encoded frame, or None if it's not in the store
+        self._open()
+        entry = os.pread(self._index.fileno(), INDEX.size, frame_no * INDEX.size)
+        if len(entry) < INDEX.size:
+            return None
+        offset, size = INDEX.unpack(entry)
+        if size == 0:
+            return None
+        data = os.pread(self._data.fileno(), size, offset)
+        if len(data) < size:
+            raise Exception(f"Frame {frame_no} is cut short in {self.data_fn}")
+        return data
+
+    def get(self, frame_no):
+        data = self.get_data(frame_no)
+        return None if data is None else decode_frame(data)
+
+    def stored(self):
+        # The frame number of every frame in the store
+        if not os.path.isfile(self.index_fn):
+            return []
+        count = os.path.getsize(self.index_fn) // INDEX.size
+        index = np.fromfile(self.index_fn, dtype="<u8", count=count * 2).reshape(count, 2)
+        return np.flatnonzero(index[:, 1] > 0).tolist()
+
+if __name__ == "__main__":
+    print("This module is not meant to be run directly")
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+
+import json
+import numpy as np
+import os
+import struct
+import zlib
+
+# An index kept next to a JSONL file of jobs, so resuming doesn't need to parse every row or
+# check the disk for every output.  Two files sit next to the JSONL:
+#   .idx  - A header, followed by the byte offset of each row, in order
+#   .done - A bitmap, one bit per row, set once that row's job is done
+# Rows are only ever appended to the JSONL, so each time it's opened only the new rows need
+# to be indexed.  If the JSONL looks like it was replaced or cut short, the index is rebuilt
+MAGIC = b"EJJOBIDX"
+# Magic, number of rows, how much of the JSONL has been indexed, CRC of the last bit indexed
+HEADER = struct.Struct("<8sQQI")
+OFFSET = struct.Struct("<Q")
+# How much of the end of the indexed part of the JSONL to check hasn't changed
+TAIL_CHECK = 64
+# The bitmap grows this many bytes at a time
+BITMAP_CHUNK = 64 * 1024
+# Write out the bitmap after this many jobs are marked done
+FLUSH_EVERY = 64
+
+class JobIndex:
+    # probe is called with each row that was added to the JSONL without going through the index,
+    # and returns True if it's already done, this is only ever called once per row
+    def __init__(self, fn, probe=None):
+        self.fn = fn
+        self.idx_fn = fn + ".idx"
+        self.done_fn = fn + ".done"
+        self.probe = probe
+        self.count = 0
+        self.indexed = 0
+        self.tail_crc = 0
+        self.offsets = np.zeros(0, dtype=np.uint64)
+        self._bits = None
+        self._unflushed = 0
+        self._load()
+        self.refresh()
+
+    def _load(self):
+        if os.path.isfile(self.idx_fn):
+            with open(self.idx_fn, "rb") as f:
+                header = f.read(HEADER.size)
+                if len(header) == HEADER.size:
+                    magic, count, indexed, tail_crc = HEADER.unpack(header)
+                    if magic == MAGIC:
+                        offsets = np.frombuffer(f.read(count * OFFSET.size), dtype="<u8")
+                        if len(offsets) == count:
+                            self.count, self.indexed, self.tail_crc = count, indexed, tail_crc
+                            self.offsets = offsets.copy()
+        # Without a bitmap that covers every indexed row, there's no telling which are done, so
+        # start over, and every row gets probed again
+        have_bits = os.path.isfile(self.done_fn) and os.path.getsize(self.done_fn) >= (self.count + 7) // 8
+        if not os.path.isfile(self.done_fn):
+            with open(self.done_fn, "wb"):
+                pass
+        self._map_bits(max(os.path.getsize(self.done_fn), BITMAP_CHUNK))
+        if not have_bits:
+            self._reset()
+
+    def _map_bits(self, size):
+        # Memory map the bitmap, growing the file to size bytes if needed
+        if self._bits is not None:
+            self._bits.flush()
+            self._bits = None
+        if os.path.getsize(self.done_fn) < size:
+            with open(self.done_fn, "r+b") as f:
+                f.truncate(size)
+        self._bits = np.memmap(self.done_fn, dtype=np.uint8, mode="r+")
+
+    def _jsonl_tail_crc(self, f, indexed):
+        start = max(0, indexed - TAIL_CHECK)
+        f.seek(start)
+        return zlib.crc32(f.read(indexed - start))
+
+    def _write_header(self):
+        # The header is only written once everything it points to is on disk
+        with open(self.idx_fn, "r+b") as f:
+            f.write(HEADER.pack(MAGIC, self.count, self.indexed, self.tail_crc))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _reset(self):
+        self.count, self.indexed, self.tail_crc = 0, 0, 0
+        self.offsets = np.zeros(0, dtype=np.uint64)
+        with open(self.idx_fn, "wb") as f:
+            f.write(HEADER.pack(MAGIC, 0, 0, 0))
+        self._bits[:] = 0
+        self._bits.flush()
+
+    def _add_rows(self, offsets, done, indexed, tail_crc):
+        # Add rows to the end of the index, along with their status
+        first = self.count
+        needed = (first + len(offsets) + 7) // 8
+        if needed > len(self._bits):
+            self._map_bits(((needed + BITMAP_CHUNK - 1) // BITMAP_CHUNK) * BITMAP_CHUNK)
+        for i, is_done in enumerate(done):
+            self._set_bit(first + i, is_done)
+        self._bits.flush()
+        self._unflushed = 0
+
+        offsets = np.asarray(offsets, dtype="<u8")
+        if not os.path.isfile(self.idx_fn):
+            with open(self.idx_fn, "wb") as f:
+                f.write(HEADER.pack(MAGIC, 0, 0, 0))
+        with open(self.idx_fn, "r+b") as f:
+            f.seek(HEADER.size + first * OFFSET.size)
+            f.write(offsets.tobytes())
+            f.truncate()
+            f.flush()
+            os.fsync(f.fileno())
+        self.offsets = np.concatenate([self.offsets, offsets])
+        self.count += len(offsets)
+        self.indexed = indexed
+        self.tail_crc = tail_crc
+        self._write_header()
+
+    def refresh(self):
+        # Index any rows added to the JSONL since the last time
+        if not os.path.isfile(self.fn):
+            if self.count > 0 or not os.path.isfile(self.idx_fn):
+                self._reset()
+            return
+        size = os.path.getsize(self.fn)
+        with open(self.fn, "rb") as f:
+            if size < self.indexed or self._jsonl_tail_crc(f, self.indexed) != self.tail_crc:
+                self._reset()
+            if size == self.indexed:
+                return
+            f.seek(self.indexed)
+            data = f.read(size - self.indexed)
+            # Only index complete rows, a partial row at the end is picked up once it's finished
+            end = data.rfind(b"\n") + 1
+            if end == 0:
+                return
+            offsets, done = [], []
+            pos = 0
+            while pos < end:
+                line_end = data.index(b"\n", pos)
+                if len(data[pos:line_end].strip()) > 0:
+                    offsets.append(self.indexed + pos)
+                    done.append(self.probe is not None and self.probe(json.loads(data[pos:line_end])))
+                pos = line_end + 1
+            indexed = self.indexed + end
+            tail_crc = self._jsonl_tail_crc(f, indexed)
+        self._add_rows(offsets, done, indexed, tail_crc)
+
+    def _set_bit(self, row_no, value):
+        if value:
+            self._bits[row_no >> 3] |= np.uint8(1 << (row_no & 7))
+        else:
+            self._bits[row_no >> 3] &= np.uint8(~(1 << (row_no & 7)) & 0xFF)
+
+    def is_done(self, row_no):
+        return bool(self._bits[row_no >> 3] & (1 << (row_no & 7)))
+
+    def mark_done(self, row_no):
+        # Only call this once the job's output is on disk
+        self._set_bit(row_no, True)
+        self._unflushed += 1
+        if self._unflushed >= FLUSH_EVERY:
+            self.flush()
+
+    def flush(self):
+        if self._bits is not None and self._unflushed > 0:
+            self._bits.flush()
+            self._unflushed = 0
+
+    def pending_rows(self):
+        # Row numbers of everything that isn't done, in order
+        bits = np.unpackbits(np.asarray(self._bits[:(self.count + 7) // 8]), bitorder="little")[:self.count]
+        return np.flatnonzero(bits == 0).tolist()
+
+    def pending(self):
+        # Yield (row_no, row) for everything that isn't done, only reading those rows
+        with open(self.fn, "rb") as f:
+            for row_no in self.pending_rows():
+                f.seek(int(self.offsets[row_no]))
+                yield row_no, json.loads(f.readline())
+
+    def append(self, row):
+        # Add a new row to the JSONL, it starts out not done.  Returns its row number
+        self.refresh()
+        line = (json.dumps(row) + "\n").encode("utf-8")
+        offset = self.indexed
+        with open(self.fn, "ab") as f:
+            f.write(line)
+        with open(self.fn, "rb") as f:
+            tail_crc = self._jsonl_tail_crc(f, offset + len(line))
+        self._add_rows([offset], [False], offset + len(line), tail_crc)
+        return self.count - 1
+
+    def close(self):
+        self.flush()
+        self._bits = None
+
+if __name__ == "__main__":
+    print("This module is not meant to be run directly")
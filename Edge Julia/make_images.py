@@ -3,48 +3,30 @@
 from collections import defaultdict
 from PIL import Image, ImageDraw, ImageFont
 from scottsutils.command_opts import opt, main_entry
+import frame_dupes
 import mandelbrot_native_helper
 import math
 import numpy as np
 import os
-import pickle
+import palette
+import trail_file
 import subprocess
 
-def val_to_color(val):
-    colors = [
-        (0, 1, (0, 0, 0), (0, 0, 100)),
-        (1, 15, (0, 0, 100), (255, 255, 255)),
-        (15, 50, (255, 255, 255), (255, 180, 0)),
-        (50, 250, (255, 180, 0), (100, 0, 0)),
-    ]
-    for a, b, rgb_a, rgb_b in colors:
-        if a <= val <= b:
-            val = (val - a) / (b - a)
-            return (
-                int(rgb_a[0] * (1 - val) + rgb_b[0] * val),
-                int(rgb_a[1] * (1 - val) + rgb_b[1] * val),
-                int(rgb_a[2] * (1 - val) + rgb_b[2] * val),
-            )
-
 def calc_point(x, y, image_size, iters=250, julia=False, julia_pt=[0,0]):
     alias_size = 8
-    hits = 0
-    total = 0
-    for ox in range(alias_size):
-        for oy in range(alias_size):
-            if julia:
-                px = ((x + ox / alias_size) / image_size) * 3 - 1.5
-                py = ((y + oy / alias_size) / image_size) * 3 - 1.5
-            else:
-                px = ((x + ox / alias_size) / image_size) * 3 - 2.25
-                py = ((y + oy / alias_size) / image_size) * 3 - 1.5
-            in_set, escaped_at, final_dist = mandelbrot_native_helper.calc(px, py, julia, julia_pt[0], julia_pt[1], iters)
-            total += 1
-            if in_set:
-                hits += 0
-            else:
-                hits += escaped_at
-    return hits / total
+    # Build all of the alias points for this pixel, and calculate them in one batch
+    offsets = np.arange(alias_size) / alias_size
+    ox, oy = [v.flatten() for v in np.meshgrid(offsets, offsets, indexing="ij")]
+    if julia:
+        px = ((x + ox) / image_size) * 3 - 1.5
+        py = ((y + oy) / image_size) * 3 - 1.5
+    else:
+        px = ((x + ox) / image_size) * 3 - 2.25
+        py = ((y + oy) / image_size) * 3 - 1.5
+    escaped_at = np.zeros(len(px), dtype=np.int32)
+    mandelbrot_native_helper.calc_batch(px, py, julia, julia_pt[0], julia_pt[1], iters, None, escaped_at, None)
+    # Points in the set report an escape of 0, so they don't add to the total
+    return int(escaped_at.sum()) / len(px)
 
 @opt("Draw a Mandelbrot to a Julia")
 def mand_to_julia():
@@ -57,15 +39,11 @@ def mand_to_julia():
     border = 10
     bits = np.zeros([fract_size + border * 2, fract_size * 2 + border * 3, 3], dtype=np.uint8)
 
-    for y in range(fract_size):
-        for x in range(fract_size):
-            val = calc_point(x, y, fract_size)
-            bits[y + border, x + border] = val_to_color(val)
+    vals = np.array([[calc_point(x, y, fract_size) for x in range(fract_size)] for y in range(fract_size)])
+    bits[border:border + fract_size, border:border + fract_size] = palette.IMAGES.colors(vals)
 
-    for y in range(fract_size):
-        for x in range(fract_size):
-            val = calc_point(x, y, fract_size, julia=True, julia_pt=julia_pt)
-            bits[y + border, x + fract_size + border * 2] = val_to_color(val)
+    vals = np.array([[calc_point(x, y, fract_size, julia=True, julia_pt=julia_pt) for x in range(fract_size)] for y in range(fract_size)])
+    bits[border:border + fract_size, fract_size + border * 2:fract_size * 2 + border * 2] = palette.IMAGES.colors(vals)
 
     dot_size, border_size = 4, 5
     alias_size = 4
@@ -88,7 +66,7 @@ def mand_to_julia():
     for x, y in totals:
         dot_val = hits[(x, y)] / totals[(x, y)]
         border_val = hits[(x, y)] / totals[(x, y)]
-        if val > 0:
+        if vals[-1, -1] > 0:
             bits[(dot_y + y, dot_x + x)] = (
                 int(float(bits[dot_y + y, dot_x + x][0]) * (1 - (dot_val + border_val)) + (255 * dot_val) + (0 * border_val)),
                 int(float(bits[dot_y + y, dot_x + x][0]) * (1 - (dot_val + border_val)) + (0 * dot_val) + (0 * border_val)),
@@ -357,25 +335,22 @@ def animate_border():
         width, height = 400, 300
         bits = np.zeros((height, width, 3), np.uint8)
         alias = 4
-        for x in range(width):
-            for y in range(height):
-                hits, total = 0, 0
-                for ox in range(alias):
-                    for oy in range(alias):
-                        in_set, escaped_at, final_dist = mandelbrot_native_helper.calc(
-                            (((x + ox / alias) - (width/2)) / 300 * 2.75 - 0.75), 
-                            (((y + oy / alias) - (height/2)) / 300 * 2.75), 
-                            False, 0, 0, iter,
-                        )
-                        if in_set:
-                            hits += 1
-                        total += 1
-                val = int(hits / total * 255)
-                bits[y, x] = (val, val, val)
+        # Calculate every alias point for the entire frame in one batch
+        offsets = np.arange(alias) / alias
+        sample_x = (np.arange(width)[:, None] + offsets[None, :]).flatten()
+        sample_y = (np.arange(height)[:, None] + offsets[None, :]).flatten()
+        px, py = np.meshgrid(
+            ((sample_x - (width/2)) / 300 * 2.75 - 0.75),
+            ((sample_y - (height/2)) / 300 * 2.75),
+        )
+        in_set = np.zeros(px.size, dtype=np.int32)
+        mandelbrot_native_helper.calc_batch(px.ravel(), py.ravel(), False, 0, 0, iter, in_set, None, None)
+        hits = in_set.reshape(height, alias, width, alias).sum(axis=(1, 3))
+        val = (hits / (alias * alias) * 255).astype(np.uint8)
+        bits[:, :] = val[:, :, None]
 
         border = np.zeros((height * alias, width * alias), np.uint8)
-        with open(fn.replace("ITER", f"{iter:05d}"), "rb") as f:
-            data = pickle.load(f)
+        data = trail_file.read_trail(fn.replace("ITER", f"{iter:05d}"))
         seen = set()
         for pt_x, pt_y in data:
             x = int(((width / 2) + (300 / 11) * (4 * pt_x + 3)) * alias)
@@ -425,6 +400,16 @@ def animate_border():
         os.path.join("images", "border_animated.gif"),
     ])
 
+@opt("Turn dupe frames noted in data/dupes.jsonl into real files")
+def expand_dupes():
+    created = frame_dupes.expand_manifest("data")
+    print(f"Created {created:,} dupe frames")
+
+@opt("Write an ffmpeg concat list of the frames in data, with dupes pointing at their source")
+def dupe_concat(fn="frames.txt", frame_rate="60"):
+    count = frame_dupes.write_concat_list("data", fn, float(frame_rate))
+    print(f"Wrote {count:,} frames to {fn}, use it with: ffmpeg -f concat -safe 0 -i {fn}")
+
 
 if __name__ == "__main__":
     main_entry('func')
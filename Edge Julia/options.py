@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
-import os, pickle
+import os
+import trail_file
 
 OPTIONS = {
     "width": 3840,              # Width of the final output image
@@ -11,10 +12,12 @@ OPTIONS = {
     "multiproc": False,         # Draw multiple frames at once (disables show_gui)
     "multiproc_sync": False,    # Turn on multiproc, and call "sync.py up" every now and then
     "quick_mode": False,        # Disable alias, draw frames at 1/2 quality
+    "vector_render": True,      # Render each pass as whole arrays instead of one event per pixel
     "no_alias": False,          # Disable alias, but draw frames at normal quality
     "view_only": False,         # Only view the main mandelbrot
     "save_results": True,       # Save all results as we go
     "add_extra_frames": True,   # Add extra frames to the start and end
+    "dupe_mode": "link",        # How to make extra frames: link (hard/reflink, else data/dupes.jsonl), copy, or manifest
     "draw_julias": True,        # Draw all Julia frames
     "save_edge": False,         # Draw the edge and save it as a graphics file
     "precise_point": True,      # Find the precise point after finding a target point
@@ -24,6 +27,11 @@ OPTIONS = {
     "border_iter": 75,          # Number of iterations when searching for the border points
     "shrink": 1,                # Number to divide all width/height calls by
     "scan_size": 100_000,       # Number of points per unit when searching for the border
+    "border_cache_tiles": 16384,# Number of 64x64 tiles of border scan results to cache (0 to disable)
+    "checkpoint_secs": 600,     # Seconds between border scan checkpoints when RESUME_TRAIL is set
+    "edge_procs": 0,            # Trace the border with this many worker processes (0 or 1 for a single scan)
+    "edge_segments": 32,        # Number of segments to split the border into for edge_procs, using border_percs.txt.  An anchor
+                                # can land in a pocket that makes its segment scan again, so more segments use more CPU
     "frame_spacing": 0.001      # Spacing, in Mandelbrot coords, between frames along the edge
 }
 
@@ -54,33 +62,13 @@ if False:
     source_fn = os.path.join("data", OPTIONS["source_data_file"] + ".png.dat")
 
     if "saved_trail" not in OPTIONS:
-        def limit_trail(trail, spacing):
-            import math
-            ret = [trail[0]]
-            for x, y in trail[1:-1]:
-                if math.sqrt(((ret[-1][0] - x) ** 2) + ((ret[-1][1] - y) ** 2)) >= spacing:
-                    ret.append((x, y))
-            ret.append(trail[-1])
-            return ret
-
-        def find_nearest(target_length, fn):
-            with open(fn, "rb") as f:
-                temp = pickle.load(f)
-            best_skip, best_trail = 0, temp
-            for i in range(1, 20):
-                for add in [-1, 1]:
-                    test_skip = best_skip + add / (2 ** i)
-                    test_trail = limit_trail(temp, test_skip)
-                    if abs(target_length - len(test_trail)) < abs(target_length - len(best_trail)):
-                        best_skip, best_trail = test_skip, test_trail
-            return best_trail, best_skip, len(temp)
-
-        OPTIONS["saved_trail"], best_skip, orig_frames = find_nearest(target_frames, source_fn)
-        print(f'Using {OPTIONS["source_data_file"]}, with {len(OPTIONS["saved_trail"]):,} from {orig_frames:,} frames, and skip {best_skip}')
+        temp = trail_file.read_trail(source_fn)
+        OPTIONS["saved_trail"] = trail_file.resample(temp, target_frames)
+        spacing = trail_file.spacing_for(temp, target_frames)
+        print(f'Using {OPTIONS["source_data_file"]}, with {len(OPTIONS["saved_trail"]):,} from {len(temp):,} frames, and spacing {spacing}')
 
 if "LOAD_TRAIL" in os.environ:
-    with open(os.environ["LOAD_TRAIL"], "rb") as f:
-        OPTIONS["saved_trail"] = pickle.load(f)
+    OPTIONS["saved_trail"] = trail_file.read_trail(os.environ["LOAD_TRAIL"])
 
 if "DRAW_EDGE" in os.environ:
     OPTIONS["border_iter"] = 3
@@ -104,6 +92,14 @@ if "MULTIPROC" in os.environ or "SYNCMODE" in os.environ:
     if "SYNCMODE" in os.environ:
         OPTIONS["multiproc_sync"] = True
 
+if "EDGE_PROCS" in os.environ:
+    # Allow an env variable to trace the border in parallel
+    OPTIONS["edge_procs"] = int(os.environ["EDGE_PROCS"])
+
+if "DUPE_MODE" in os.environ:
+    # Allow an env variable to pick how dupe frames are made
+    OPTIONS["dupe_mode"] = os.environ["DUPE_MODE"]
+
 if OPTIONS["shrink"] > 1:
     # If shrink is turned on, shrink down the image size
     OPTIONS["width"] //= OPTIONS["shrink"]
@@ -111,7 +107,7 @@ if OPTIONS["shrink"] > 1:
     OPTIONS["add_extra_frames"] = False
 
 def show_flags():
-    for arg in ["LOAD_TRAIL", "SAVE_TRAIL", "PROCS"]:
+    for arg in ["LOAD_TRAIL", "SAVE_TRAIL", "RESUME_TRAIL", "PROCS", "EDGE_PROCS", "DUPE_MODE"]:
         if arg in os.environ:
             print(f"{arg} option set to {os.environ[arg]}")
     for arg in ["NO_GUI", "MULTIPROC", "SYNCMODE", "DRAW_EDGE"]:
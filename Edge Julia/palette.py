@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+import bisect
+import math
+import numpy as np
+
+class Palette:
+    # A palette defined by color stops.  The segments between stops are turned into a
+    # table once, so whole arrays of values can be colored in one vectorized call.
+    def __init__(self, stops, inside=(0, 0, 0)):
+        # stops is a list of (position, (r, g, b)), sorted by position
+        # inside is the color used for NaN values, which mark points inside the set
+        self.positions = [float(pos) for pos, _ in stops]
+        self.rgbs = [tuple(rgb) for _, rgb in stops]
+        self.inside = tuple(inside)
+
+        # The lookup table, one entry per segment between two stops
+        self._starts = np.array(self.positions[:-1], dtype=np.float64)
+        self._widths = np.array([b - a for a, b in zip(self.positions[:-1], self.positions[1:])], dtype=np.float64)
+        self._rgb_a = np.array(self.rgbs[:-1], dtype=np.float64)
+        self._rgb_b = np.array(self.rgbs[1:], dtype=np.float64)
+
+    @property
+    def end(self):
+        return self.positions[-1]
+
+    def color(self, value):
+        # Scalar version of colors(), for code that still works one point at a time
+        if value is None or math.isnan(value):
+            return self.inside
+        value = max(self.positions[0], min(self.positions[-1], value))
+        i = min(max(bisect.bisect_right(self.positions, value) - 1, 0), len(self.positions) - 2)
+        frac = (value - self.positions[i]) / (self.positions[i + 1] - self.positions[i])
+        rgb_a, rgb_b = self.rgbs[i], self.rgbs[i + 1]
+        return (
+            int(rgb_a[0] * (1 - frac) + rgb_b[0] * frac),
+            int(rgb_a[1] * (1 - frac) + rgb_b[1] * frac),
+            int(rgb_a[2] * (1 - frac) + rgb_b[2] * frac),
+        )
+
+    def colors(self, values):
+        # Turn an array of values into a uint8 array of colors, with one more dimension for RGB
+        values = np.asarray(values, dtype=np.float64)
+        inside = np.isnan(values)
+        values = np.clip(np.nan_to_num(values), self.positions[0], self.positions[-1])
+        index = np.clip(np.searchsorted(self.positions, values, side="right") - 1, 0, len(self.positions) - 2)
+        frac = ((values - self._starts[index]) / self._widths[index])[..., None]
+        rgb = (self._rgb_a[index] * (1 - frac) + self._rgb_b[index] * frac).astype(np.uint8)
+        rgb[inside] = self.inside
+        return rgb
+
+# The palette used for all of the Julia and Mandelbrot renders, spread out over max_iters
+MANDEL = Palette([
+    (0, (0, 0, 100)),
+    (1, (255, 255, 255)),
+    (2, (255, 180, 0)),
+    (3, (100, 0, 0)),
+    (4, (100, 0, 0)),
+], inside=(50, 0, 0))
+
+# The palette used for the README images, based on the average escape count
+IMAGES = Palette([
+    (0, (0, 0, 0)),
+    (1, (0, 0, 100)),
+    (15, (255, 255, 255)),
+    (50, (255, 180, 0)),
+    (250, (100, 0, 0)),
+])
+
+def smooth_iters(escaped_at, final_dist):
+    # Turn escape counts and final escape distances into smoothed iteration counts
+    log_zn = np.log(final_dist) / 2
+    nu = np.log(log_zn / math.log(2)) / math.log(2)
+    return escaped_at + 1 - nu
+
+def smoothed_color(smoothed, max_iters, palette=MANDEL):
+    # Color one smoothed iteration count, None is inside the set
+    if smoothed is None:
+        return palette.inside
+    return palette.color(max(0, min(1, smoothed / max_iters)) * palette.end)
+
+def smoothed_colors(smoothed, max_iters, palette=MANDEL):
+    # Color an array of smoothed iteration counts, NaN is inside the set
+    return palette.colors(np.clip(smoothed / max_iters, 0, 1) * palette.end)
+
+if __name__ == "__main__":
+    print("This module is not meant to be run directly")
@@ -1,95 +1,824 @@
-#define PY_SSIZE_T_CLEAN
-#include <Python.h>
-#include <math.h>
-
-// #pragma GCC diagnostic ignored "-Wpointer-to-int-cast"
-// #pragma GCC diagnostic ignored "-Wint-to-pointer-cast"
-// #pragma GCC diagnostic error "-Wimplicit-function-declaration"
-
-static PyObject * mandelbrot_calc(PyObject *self, PyObject * args) {
-    /*
-        Calculate one point, doesn't use cache, points should be in natural coords
-        Returns (in_set, escaped_at, escape_dist)
-    */
-
-    int isJulia, maxIters;
-    double x, y, juliaX, juliaY;
-
-    if(!PyArg_ParseTuple(args, "ddpddi", &x, &y, &isJulia, &juliaX, &juliaY, &maxIters)) {
-        return NULL;
-    }
-
-    double u, v;
-
-    if (isJulia == 0) {
-        double p = sqrt(((x - 1.0 / 4.0) * (x - 1.0 / 4.0)) + (y*y));
-        if (x <= p - (2.0 * (p * p)) + (1.0 / 4.0)) {
-            /* This point is in the main cardioid */
-            return Py_BuildValue("iid", 1, 0, 0.0);
-        } else if ((x + 1.0) * (x + 1.0) + (y * y) <= 1.0 / 16.0) {
-            /* This point is in the first circular bulb */
-            return Py_BuildValue("iid", 1, 0, 0.0);
-        }
-
-        u = x;
-        v = y;
-    } else {
-        u = juliaX;
-        v = juliaY;
-    }
-
-    for (int i = 0; i < maxIters; i++) {
-        double nextX, nextY, dist;
-        nextX = x * x - y * y + u;
-        nextY = 2.0 * x * y + v;
-        x = nextX;
-        y = nextY;
-        dist = x * x + y * y;
-        if (dist >= 1<<10) {
-            return Py_BuildValue("iid", 0, i, dist);
-        }
-    }
-    return Py_BuildValue("iid", 1, 0, 0.0);
-}
-
-PyMODINIT_FUNC PyInit_mandelbrot_native_helper() {
-    static PyMethodDef Methods[] = {
-        {"calc", mandelbrot_calc, METH_VARARGS, "Calculate a pixel"},
-        {NULL, NULL, 0, NULL}
-    };
-
-    static struct PyModuleDef module = {
-        PyModuleDef_HEAD_INIT,
-        "mandelbrot_native_helper",
-        NULL,
-        -1,
-        Methods
-    };
-
-    return PyModule_Create(&module);
-}
-
-// PyMODINIT_FUNC initmandelbrot_native_helper(void)
-// {
-//     PyObject *m;
-
-//     m = Py_InitModule("mandelbrot_native_helper", Methods);
-
-//     if ( m == NULL )
-//     {
-//         return;
-//     }
-
-//     // MandelbrotError = PyErr_NewException("mandelbrot.error", NULL, NULL);
-//     // Py_INCREF(MandelbrotError);
-//     // PyModule_AddObject(m, "error", MandelbrotError);
-// }
-
-// int main(int argc, char *argv[])
-// {
-//     Py_Initialize();
-//     PyInit_initmandelbrot_native_helper();
-
-//     return 0;
-// }
-
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <math.h>
+#include <string.h>
+#ifdef _WIN32
+#include <windows.h>
+#else
+#include <pthread.h>
+#include <unistd.h>
+#endif
+
+#if defined(__GNUC__) && (defined(__x86_64__) || defined(__i386__))
+/* GCC and Clang can build the SIMD kernels without turning them on for the whole module */
+#define HAVE_X86_SIMD
+#include <immintrin.h>
+#define TARGET_SSE2 __attribute__((target("sse2")))
+#define TARGET_AVX2 __attribute__((target("avx2")))
+#elif defined(_MSC_VER) && defined(_M_X64)
+#define HAVE_X86_SIMD
+#include <immintrin.h>
+#include <intrin.h>
+#define TARGET_SSE2
+#define TARGET_AVX2
+#endif
+
+// #pragma GCC diagnostic ignored "-Wpointer-to-int-cast"
+// #pragma GCC diagnostic ignored "-Wint-to-pointer-cast"
+// #pragma GCC diagnostic error "-Wimplicit-function-declaration"
+
+static int in_main_bulbs(double x, double y) {
+    /* Returns 1 if the point is in the main cardioid or the first circular bulb */
+    double p = sqrt(((x - 1.0 / 4.0) * (x - 1.0 / 4.0)) + (y*y));
+    if (x <= p - (2.0 * (p * p)) + (1.0 / 4.0)) {
+        /* This point is in the main cardioid */
+        return 1;
+    } else if ((x + 1.0) * (x + 1.0) + (y * y) <= 1.0 / 16.0) {
+        /* This point is in the first circular bulb */
+        return 1;
+    }
+    return 0;
+}
+
+static int mandelbrot_point(double x, double y, int isJulia, double juliaX, double juliaY, int maxIters, int *escapedAt, double *escapeDist, int *period) {
+    /*
+        The core iteration for one point, used by calc() and the scalar kernel
+        Returns 1 if the point is in the set, otherwise 0 with escapedAt and escapeDist filled in
+        If the orbit is found to repeat, period is set to the length of the cycle, otherwise 0
+    */
+
+    double u, v;
+    /* Brent's cycle detection, compare against a saved point that moves out at powers of two */
+    double checkX = x, checkY = y;
+    int checkAt = -1, checkLen = 1;
+
+    *escapedAt = 0;
+    *escapeDist = 0.0;
+    *period = 0;
+
+    if (isJulia == 0) {
+        if (in_main_bulbs(x, y)) {
+            return 1;
+        }
+
+        u = x;
+        v = y;
+    } else {
+        u = juliaX;
+        v = juliaY;
+    }
+
+    for (int i = 0; i < maxIters; i++) {
+        double nextX, nextY, dist;
+        nextX = x * x - y * y + u;
+        nextY = 2.0 * x * y + v;
+        x = nextX;
+        y = nextY;
+        dist = x * x + y * y;
+        if (dist >= 1<<10) {
+            *escapedAt = i;
+            *escapeDist = dist;
+            return 0;
+        }
+        if (x == checkX && y == checkY) {
+            /* The orbit repeated exactly, so it will never escape */
+            *period = i - checkAt;
+            return 1;
+        }
+        if (i - checkAt == checkLen) {
+            checkX = x;
+            checkY = y;
+            checkAt = i;
+            checkLen *= 2;
+        }
+    }
+    return 1;
+}
+
+/*
+    Kernels to calculate many points at once, all kernels must produce exactly the same
+    results as mandelbrot_point(), so the SIMD versions do the same operations in the
+    same order, just on several points at a time
+*/
+typedef void (*PointsKernel)(const double *xs, const double *ys, Py_ssize_t count, int isJulia, double juliaX, double juliaY, int maxIters, int *inSet, int *escapedAt, double *escapeDist, int *period);
+
+static void points_scalar(const double *xs, const double *ys, Py_ssize_t count, int isJulia, double juliaX, double juliaY, int maxIters, int *inSet, int *escapedAt, double *escapeDist, int *period) {
+    for (Py_ssize_t i = 0; i < count; i++) {
+        inSet[i] = mandelbrot_point(xs[i], ys[i], isJulia, juliaX, juliaY, maxIters, &escapedAt[i], &escapeDist[i], &period[i]);
+    }
+}
+
+#ifdef HAVE_X86_SIMD
+TARGET_SSE2 static void points_sse2(const double *xs, const double *ys, Py_ssize_t count, int isJulia, double juliaX, double juliaY, int maxIters, int *inSet, int *escapedAt, double *escapeDist, int *period) {
+    const __m128d limit = _mm_set1_pd(1<<10);
+    const __m128d two = _mm_set1_pd(2.0);
+    double lanes[2];
+    Py_ssize_t i = 0;
+
+    for (; i + 2 <= count; i += 2) {
+        int active = 0, checkAt = -1, checkLen = 1;
+        __m128d x, y, u, v, checkX, checkY;
+
+        for (int lane = 0; lane < 2; lane++) {
+            inSet[i + lane] = 1;
+            escapedAt[i + lane] = 0;
+            escapeDist[i + lane] = 0.0;
+            period[i + lane] = 0;
+            if (isJulia != 0 || !in_main_bulbs(xs[i + lane], ys[i + lane])) {
+                active |= 1 << lane;
+            }
+        }
+        if (active == 0) {
+            continue;
+        }
+
+        x = _mm_loadu_pd(xs + i);
+        y = _mm_loadu_pd(ys + i);
+        if (isJulia == 0) {
+            u = x;
+            v = y;
+        } else {
+            u = _mm_set1_pd(juliaX);
+            v = _mm_set1_pd(juliaY);
+        }
+        checkX = x;
+        checkY = y;
+
+        for (int iter = 0; iter < maxIters; iter++) {
+            __m128d nextX = _mm_add_pd(_mm_sub_pd(_mm_mul_pd(x, x), _mm_mul_pd(y, y)), u);
+            __m128d nextY = _mm_add_pd(_mm_mul_pd(_mm_mul_pd(two, x), y), v);
+            __m128d dist;
+            int escaped, repeated;
+            x = nextX;
+            y = nextY;
+            dist = _mm_add_pd(_mm_mul_pd(x, x), _mm_mul_pd(y, y));
+            /* Only lanes that are still running can escape, the others just keep going harmlessly */
+            escaped = _mm_movemask_pd(_mm_cmpge_pd(dist, limit)) & active;
+            if (escaped != 0) {
+                _mm_storeu_pd(lanes, dist);
+                for (int lane = 0; lane < 2; lane++) {
+                    if (escaped & (1 << lane)) {
+                        inSet[i + lane] = 0;
+                        escapedAt[i + lane] = iter;
+                        escapeDist[i + lane] = lanes[lane];
+                    }
+                }
+                active &= ~escaped;
+                if (active == 0) {
+                    break;
+                }
+            }
+            /* Lanes whose orbit repeated exactly are in the set, so stop tracking them */
+            repeated = _mm_movemask_pd(_mm_and_pd(_mm_cmpeq_pd(x, checkX), _mm_cmpeq_pd(y, checkY))) & active;
+            if (repeated != 0) {
+                for (int lane = 0; lane < 2; lane++) {
+                    if (repeated & (1 << lane)) {
+                        period[i + lane] = iter - checkAt;
+                    }
+                }
+                active &= ~repeated;
+                if (active == 0) {
+                    break;
+                }
+            }
+            if (iter - checkAt == checkLen) {
+                checkX = x;
+                checkY = y;
+                checkAt = iter;
+                checkLen *= 2;
+            }
+        }
+    }
+
+    points_scalar(xs + i, ys + i, count - i, isJulia, juliaX, juliaY, maxIters, inSet + i, escapedAt + i, escapeDist + i, period + i);
+}
+
+TARGET_AVX2 static void points_avx2(const double *xs, const double *ys, Py_ssize_t count, int isJulia, double juliaX, double juliaY, int maxIters, int *inSet, int *escapedAt, double *escapeDist, int *period) {
+    const __m256d limit = _mm256_set1_pd(1<<10);
+    const __m256d two = _mm256_set1_pd(2.0);
+    double lanes[4];
+    Py_ssize_t i = 0;
+
+    for (; i + 4 <= count; i += 4) {
+        int active = 0, checkAt = -1, checkLen = 1;
+        __m256d x, y, u, v, checkX, checkY;
+
+        for (int lane = 0; lane < 4; lane++) {
+            inSet[i + lane] = 1;
+            escapedAt[i + lane] = 0;
+            escapeDist[i + lane] = 0.0;
+            period[i + lane] = 0;
+            if (isJulia != 0 || !in_main_bulbs(xs[i + lane], ys[i + lane])) {
+                active |= 1 << lane;
+            }
+        }
+        if (active == 0) {
+            continue;
+        }
+
+        x = _mm256_loadu_pd(xs + i);
+        y = _mm256_loadu_pd(ys + i);
+        if (isJulia == 0) {
+            u = x;
+            v = y;
+        } else {
+            u = _mm256_set1_pd(juliaX);
+            v = _mm256_set1_pd(juliaY);
+        }
+        checkX = x;
+        checkY = y;
+
+        for (int iter = 0; iter < maxIters; iter++) {
+            __m256d nextX = _mm256_add_pd(_mm256_sub_pd(_mm256_mul_pd(x, x), _mm256_mul_pd(y, y)), u);
+            __m256d nextY = _mm256_add_pd(_mm256_mul_pd(_mm256_mul_pd(two, x), y), v);
+            __m256d dist;
+            int escaped, repeated;
+            x = nextX;
+            y = nextY;
+            dist = _mm256_add_pd(_mm256_mul_pd(x, x), _mm256_mul_pd(y, y));
+            /* Only lanes that are still running can escape, the others just keep going harmlessly */
+            escaped = _mm256_movemask_pd(_mm256_cmp_pd(dist, limit, _CMP_GE_OQ)) & active;
+            if (escaped != 0) {
+                _mm256_storeu_pd(lanes, dist);
+                for (int lane = 0; lane < 4; lane++) {
+                    if (escaped & (1 << lane)) {
+                        inSet[i + lane] = 0;
+                        escapedAt[i + lane] = iter;
+                        escapeDist[i + lane] = lanes[lane];
+                    }
+                }
+                active &= ~escaped;
+                if (active == 0) {
+                    break;
+                }
+            }
+            /* Lanes whose orbit repeated exactly are in the set, so stop tracking them */
+            repeated = _mm256_movemask_pd(_mm256_and_pd(_mm256_cmp_pd(x, checkX, _CMP_EQ_OQ), _mm256_cmp_pd(y, checkY, _CMP_EQ_OQ))) & active;
+            if (repeated != 0) {
+                for (int lane = 0; lane < 4; lane++) {
+                    if (repeated & (1 << lane)) {
+                        period[i + lane] = iter - checkAt;
+                    }
+                }
+                active &= ~repeated;
+                if (active == 0) {
+                    break;
+                }
+            }
+            if (iter - checkAt == checkLen) {
+                checkX = x;
+                checkY = y;
+                checkAt = iter;
+                checkLen *= 2;
+            }
+        }
+    }
+
+    points_scalar(xs + i, ys + i, count - i, isJulia, juliaX, juliaY, maxIters, inSet + i, escapedAt + i, escapeDist + i, period + i);
+}
+
+static int cpu_has_avx2() {
+#if defined(_MSC_VER)
+    int regs[4];
+    __cpuid(regs, 0);
+    if (regs[0] < 7) {
+        return 0;
+    }
+    __cpuid(regs, 1);
+    /* Need both AVX and the OS saving the AVX registers */
+    if (!(regs[2] & (1 << 27)) || !(regs[2] & (1 << 28)) || (_xgetbv(0) & 6) != 6) {
+        return 0;
+    }
+    __cpuidex(regs, 7, 0);
+    return (regs[1] & (1 << 5)) != 0;
+#else
+    __builtin_cpu_init();
+    return __builtin_cpu_supports("avx2");
+#endif
+}
+#endif
+
+typedef struct {
+    const char *name;
+    PointsKernel kernel;
+    int supported;
+} KernelInfo;
+
+static KernelInfo all_kernels[] = {
+    {"scalar", points_scalar, 1},
+#ifdef HAVE_X86_SIMD
+    /* SSE2 is always present on x86-64, the AVX2 support is filled in at import */
+    {"sse2", points_sse2, 1},
+    {"avx2", points_avx2, 0},
+#endif
+    {NULL, NULL, 0}
+};
+
+/* The kernel used by calc_batch() and render_grid(), picked when the module loads */
+static KernelInfo *points_kernel = &all_kernels[0];
+
+static void pick_kernel() {
+#ifdef HAVE_X86_SIMD
+    all_kernels[2].supported = cpu_has_avx2();
+#endif
+    /* Use the last, and best, kernel this CPU supports */
+    for (KernelInfo *cur = all_kernels; cur->name != NULL; cur++) {
+        if (cur->supported) {
+            points_kernel = cur;
+        }
+    }
+}
+
+static PyObject * mandelbrot_get_kernel(PyObject *self, PyObject * args) {
+    /* Returns the name of the kernel in use */
+    return PyUnicode_FromString(points_kernel->name);
+}
+
+static PyObject * mandelbrot_supported_kernels(PyObject *self, PyObject * args) {
+    /* Returns a list of all kernel names this CPU can use */
+    PyObject *ret = PyList_New(0);
+    if (ret == NULL) {
+        return NULL;
+    }
+    for (KernelInfo *cur = all_kernels; cur->name != NULL; cur++) {
+        if (cur->supported) {
+            PyObject *name = PyUnicode_FromString(cur->name);
+            if (name == NULL || PyList_Append(ret, name) != 0) {
+                Py_XDECREF(name);
+                Py_DECREF(ret);
+                return NULL;
+            }
+            Py_DECREF(name);
+        }
+    }
+    return ret;
+}
+
+static PyObject * mandelbrot_set_kernel(PyObject *self, PyObject * args) {
+    /* Force a specific kernel, mostly useful for testing the kernels against each other */
+    const char *name;
+
+    if(!PyArg_ParseTuple(args, "s", &name)) {
+        return NULL;
+    }
+
+    for (KernelInfo *cur = all_kernels; cur->name != NULL; cur++) {
+        if (strcmp(cur->name, name) == 0) {
+            if (!cur->supported) {
+                PyErr_Format(PyExc_ValueError, "Kernel %s is not supported on this CPU", name);
+                return NULL;
+            }
+            points_kernel = cur;
+            Py_RETURN_NONE;
+        }
+    }
+
+    PyErr_Format(PyExc_ValueError, "Unknown kernel %s", name);
+    return NULL;
+}
+
+/* Number of points the batch helpers hand to a kernel at once */
+#define CHUNK_SIZE 1024
+
+static PyObject * mandelbrot_calc(PyObject *self, PyObject * args) {
+    /*
+        Calculate one point, doesn't use cache, points should be in natural coords
+        Returns (in_set, escaped_at, escape_dist), or (in_set, escaped_at, escape_dist, period)
+        if report_period is set, period is the length of the orbit's cycle if one was found
+    */
+
+    int isJulia, maxIters, inSet, escapedAt, period, reportPeriod = 0;
+    double x, y, juliaX, juliaY, escapeDist;
+
+    if(!PyArg_ParseTuple(args, "ddpddi|p", &x, &y, &isJulia, &juliaX, &juliaY, &maxIters, &reportPeriod)) {
+        return NULL;
+    }
+
+    inSet = mandelbrot_point(x, y, isJulia, juliaX, juliaY, maxIters, &escapedAt, &escapeDist, &period);
+    if (reportPeriod) {
+        return Py_BuildValue("iidi", inSet, escapedAt, escapeDist, period);
+    }
+    return Py_BuildValue("iid", inSet, escapedAt, escapeDist);
+}
+
+static int get_array(PyObject *obj, Py_buffer *view, const char *name, char kind, int writable) {
+    /*
+        Grab a contiguous 1D view of a buffer protocol object (NumPy arrays, array.array, etc)
+        kind is 'd' for float64 data, or 'i' for int32 data
+        Returns 0 on success, -1 with an exception set on failure
+    */
+
+    const char *format;
+
+    if (PyObject_GetBuffer(obj, view, PyBUF_C_CONTIGUOUS | PyBUF_FORMAT | (writable ? PyBUF_WRITABLE : 0)) != 0) {
+        return -1;
+    }
+
+    /* Ignore any byte order or alignment prefix, we only support native data */
+    format = view->format == NULL ? "B" : view->format;
+    if (format[0] == '@' || format[0] == '=' || format[0] == '<' || format[0] == '>' || format[0] == '!') {
+        format++;
+    }
+
+    if (kind == 'd') {
+        if (view->itemsize != sizeof(double) || strcmp(format, "d") != 0) {
+            PyErr_Format(PyExc_TypeError, "%s must be an array of float64", name);
+            PyBuffer_Release(view);
+            return -1;
+        }
+    } else {
+        if (view->itemsize != 4 || (strcmp(format, "i") != 0 && strcmp(format, "l") != 0)) {
+            PyErr_Format(PyExc_TypeError, "%s must be an array of int32", name);
+            PyBuffer_Release(view);
+            return -1;
+        }
+    }
+
+    return 0;
+}
+
+static PyObject * mandelbrot_calc_batch(PyObject *self, PyObject * args) {
+    /*
+        Calculate many points at once, the batch version of calc()
+        Takes arrays of x and y, and writes the results into the caller provided
+        in_set (int32), escaped_at (int32), and final_dist (float64) arrays, and
+        optionally the period (int32) of any cycle found, any of the outputs can
+        be None if the caller doesn't need them
+        Returns None
+    */
+
+    int isJulia, maxIters;
+    double juliaX, juliaY;
+    PyObject *xsObj, *ysObj, *inSetObj, *escapedObj, *distObj, *periodObj = Py_None;
+    Py_buffer xs, ys, inSet, escaped, dist, period;
+    Py_ssize_t count, i;
+    int ok = 0;
+
+    if(!PyArg_ParseTuple(args, "OOpddiOOO|O", &xsObj, &ysObj, &isJulia, &juliaX, &juliaY, &maxIters, &inSetObj, &escapedObj, &distObj, &periodObj)) {
+        return NULL;
+    }
+
+    memset(&inSet, 0, sizeof(Py_buffer));
+    memset(&escaped, 0, sizeof(Py_buffer));
+    memset(&dist, 0, sizeof(Py_buffer));
+    memset(&period, 0, sizeof(Py_buffer));
+
+    if (get_array(xsObj, &xs, "xs", 'd', 0) != 0) {
+        return NULL;
+    }
+    if (get_array(ysObj, &ys, "ys", 'd', 0) != 0) {
+        PyBuffer_Release(&xs);
+        return NULL;
+    }
+
+    count = xs.len / xs.itemsize;
+    if (ys.len / ys.itemsize != count) {
+        PyErr_SetString(PyExc_ValueError, "xs and ys must be the same length");
+        goto done;
+    }
+
+    if (inSetObj != Py_None && get_array(inSetObj, &inSet, "in_set", 'i', 1) != 0) {
+        goto done;
+    }
+    if (escapedObj != Py_None && get_array(escapedObj, &escaped, "escaped_at", 'i', 1) != 0) {
+        goto done;
+    }
+    if (distObj != Py_None && get_array(distObj, &dist, "final_dist", 'd', 1) != 0) {
+        goto done;
+    }
+    if (periodObj != Py_None && get_array(periodObj, &period, "period", 'i', 1) != 0) {
+        goto done;
+    }
+
+    if ((inSet.buf != NULL && inSet.len / inSet.itemsize != count) ||
+        (escaped.buf != NULL && escaped.len / escaped.itemsize != count) ||
+        (dist.buf != NULL && dist.len / dist.itemsize != count) ||
+        (period.buf != NULL && period.len / period.itemsize != count)) {
+        PyErr_SetString(PyExc_ValueError, "Output arrays must be the same length as xs and ys");
+        goto done;
+    }
+
+    {
+        const double *xsData = (const double*)xs.buf;
+        const double *ysData = (const double*)ys.buf;
+        int *inSetData = (int*)inSet.buf;
+        int *escapedData = (int*)escaped.buf;
+        double *distData = (double*)dist.buf;
+        int *periodData = (int*)period.buf;
+
+        PointsKernel kernel = points_kernel->kernel;
+
+        /* The buffers are held for the duration, so the GIL isn't needed while working */
+        Py_BEGIN_ALLOW_THREADS
+        for (i = 0; i < count; i += CHUNK_SIZE) {
+            int chunkInSet[CHUNK_SIZE], chunkEscaped[CHUNK_SIZE], chunkPeriod[CHUNK_SIZE];
+            double chunkDist[CHUNK_SIZE];
+            Py_ssize_t chunk = count - i < CHUNK_SIZE ? count - i : CHUNK_SIZE;
+
+            kernel(xsData + i, ysData + i, chunk, isJulia, juliaX, juliaY, maxIters, chunkInSet, chunkEscaped, chunkDist, chunkPeriod);
+            if (inSetData != NULL) {
+                memcpy(inSetData + i, chunkInSet, sizeof(int) * chunk);
+            }
+            if (escapedData != NULL) {
+                memcpy(escapedData + i, chunkEscaped, sizeof(int) * chunk);
+            }
+            if (distData != NULL) {
+                memcpy(distData + i, chunkDist, sizeof(double) * chunk);
+            }
+            if (periodData != NULL) {
+                memcpy(periodData + i, chunkPeriod, sizeof(int) * chunk);
+            }
+        }
+        Py_END_ALLOW_THREADS
+    }
+    ok = 1;
+
+done:
+    PyBuffer_Release(&xs);
+    PyBuffer_Release(&ys);
+    if (inSet.obj != NULL) {
+        PyBuffer_Release(&inSet);
+    }
+    if (escaped.obj != NULL) {
+        PyBuffer_Release(&escaped);
+    }
+    if (dist.obj != NULL) {
+        PyBuffer_Release(&dist);
+    }
+    if (period.obj != NULL) {
+        PyBuffer_Release(&period);
+    }
+
+    if (!ok) {
+        return NULL;
+    }
+    Py_RETURN_NONE;
+}
+
+typedef struct {
+    /* The viewport and settings for one call to render_grid(), shared by all threads */
+    double centerX, centerY, size;
+    int width, height, alias;
+    /* Only every step-th pixel along each axis is rendered, gridWidth x gridHeight in all */
+    int step, gridWidth, gridHeight;
+    int isJulia;
+    double juliaX, juliaY;
+    int maxIters;
+    int *escaped;
+    double *smoothed;
+    int threadCount;
+    PointsKernel kernel;
+} GridSettings;
+
+typedef struct {
+    GridSettings *settings;
+    int threadIndex;
+} GridWorker;
+
+static void render_grid_rows(GridSettings *s, int threadIndex) {
+    /*
+        Render every row of the grid for one thread, rows are interleaved between threads
+        so the expensive rows near the set are spread out evenly
+    */
+
+    int maxDim = s->width > s->height ? s->width : s->height;
+    double offX = s->height > s->width ? (s->height - s->width) / 2.0 : 0.0;
+    double offY = s->width > s->height ? (s->width - s->height) / 2.0 : 0.0;
+    int cols = s->gridWidth * s->alias;
+
+    for (int gridY = threadIndex; gridY < s->gridHeight; gridY += s->threadCount) {
+        int ptY = gridY * s->step;
+        for (int yo = 0; yo < s->alias; yo++) {
+            /* Same math as gui_to_mand() in edge_julia.py so the results match exactly */
+            double y = (((ptY + offY) + (double)yo / s->alias) / maxDim) * s->size - ((s->size / 2.0) - s->centerY);
+            int row = gridY * s->alias + yo;
+            for (int start = 0; start < cols; start += CHUNK_SIZE) {
+                double xs[CHUNK_SIZE], ys[CHUNK_SIZE], dist[CHUNK_SIZE];
+                int inSet[CHUNK_SIZE], escapedAt[CHUNK_SIZE], period[CHUNK_SIZE];
+                int chunk = cols - start < CHUNK_SIZE ? cols - start : CHUNK_SIZE;
+
+                for (int i = 0; i < chunk; i++) {
+                    int ptX = ((start + i) / s->alias) * s->step;
+                    int xo = (start + i) % s->alias;
+                    xs[i] = (((ptX + offX) + (double)xo / s->alias) / maxDim) * s->size - ((s->size / 2.0) - s->centerX);
+                    ys[i] = y;
+                }
+
+                s->kernel(xs, ys, chunk, s->isJulia, s->juliaX, s->juliaY, s->maxIters, inSet, escapedAt, dist, period);
+
+                for (int i = 0; i < chunk; i++) {
+                    int at = row * cols + start + i;
+                    if (inSet[i]) {
+                        s->escaped[at] = -1;
+                        s->smoothed[at] = NAN;
+                    } else {
+                        double logZn = log(dist[i]) / 2.0;
+                        double nu = log(logZn / log(2.0)) / log(2.0);
+                        s->escaped[at] = escapedAt[i];
+                        s->smoothed[at] = (escapedAt[i] + 1) - nu;
+                    }
+                }
+            }
+        }
+    }
+}
+
+#ifdef _WIN32
+static DWORD WINAPI render_grid_thread(LPVOID arg) {
+    GridWorker *worker = (GridWorker*)arg;
+    render_grid_rows(worker->settings, worker->threadIndex);
+    return 0;
+}
+#else
+static void * render_grid_thread(void *arg) {
+    GridWorker *worker = (GridWorker*)arg;
+    render_grid_rows(worker->settings, worker->threadIndex);
+    return NULL;
+}
+#endif
+
+static int get_cpu_count() {
+#ifdef _WIN32
+    SYSTEM_INFO info;
+    GetSystemInfo(&info);
+    return (int)info.dwNumberOfProcessors;
+#else
+    long count = sysconf(_SC_NPROCESSORS_ONLN);
+    return count > 0 ? (int)count : 1;
+#endif
+}
+
+static PyObject * new_array(PyObject *numpy, int rows, int cols, const char *dtype, Py_buffer *view) {
+    /* Create an empty NumPy array, and grab a writable view of its data */
+    PyObject *ret = PyObject_CallMethod(numpy, "empty", "((ii)s)", rows, cols, dtype);
+    if (ret == NULL) {
+        return NULL;
+    }
+    if (PyObject_GetBuffer(ret, view, PyBUF_C_CONTIGUOUS | PyBUF_WRITABLE) != 0) {
+        Py_DECREF(ret);
+        return NULL;
+    }
+    return ret;
+}
+
+static PyObject * mandelbrot_render_grid(PyObject *self, PyObject * args) {
+    /*
+        Render a full viewport, splitting the rows between threads with the GIL released
+        center_x, center_y is the point in the middle of the view, and size is the span
+        of the larger of width and height, alias is the number of samples per pixel along
+        each axis, threads of 0 means use every core, and step only renders every step-th
+        pixel along each axis, for drawing quick passes
+        Returns (escaped_at, smoothed), each a NumPy array of (grid_height * alias, grid_width * alias),
+        where grid_height is height / step rounded up, and likewise for grid_width,
+        escaped_at is -1 and smoothed is NaN for points inside the set
+    */
+
+    GridSettings settings;
+    int threads = 0;
+    PyObject *numpy, *escapedObj, *smoothedObj;
+    Py_buffer escapedView, smoothedView;
+
+    settings.step = 1;
+    if(!PyArg_ParseTuple(args, "dddiiipddi|ii", 
+        &settings.centerX, &settings.centerY, &settings.size, 
+        &settings.width, &settings.height, &settings.alias, 
+        &settings.isJulia, &settings.juliaX, &settings.juliaY, 
+        &settings.maxIters, &threads, &settings.step)) {
+        return NULL;
+    }
+
+    if (settings.width <= 0 || settings.height <= 0 || settings.alias <= 0 || settings.step <= 0) {
+        PyErr_SetString(PyExc_ValueError, "width, height, alias, and step must be positive");
+        return NULL;
+    }
+    settings.gridWidth = (settings.width + settings.step - 1) / settings.step;
+    settings.gridHeight = (settings.height + settings.step - 1) / settings.step;
+
+    if (threads <= 0) {
+        threads = get_cpu_count();
+    }
+    if (threads > settings.gridHeight) {
+        threads = settings.gridHeight;
+    }
+    settings.threadCount = threads;
+    settings.kernel = points_kernel->kernel;
+
+    numpy = PyImport_ImportModule("numpy");
+    if (numpy == NULL) {
+        return NULL;
+    }
+    escapedObj = new_array(numpy, settings.gridHeight * settings.alias, settings.gridWidth * settings.alias, "int32", &escapedView);
+    if (escapedObj == NULL) {
+        Py_DECREF(numpy);
+        return NULL;
+    }
+    smoothedObj = new_array(numpy, settings.gridHeight * settings.alias, settings.gridWidth * settings.alias, "float64", &smoothedView);
+    Py_DECREF(numpy);
+    if (smoothedObj == NULL) {
+        PyBuffer_Release(&escapedView);
+        Py_DECREF(escapedObj);
+        return NULL;
+    }
+    settings.escaped = (int*)escapedView.buf;
+    settings.smoothed = (double*)smoothedView.buf;
+
+    Py_BEGIN_ALLOW_THREADS
+    if (threads == 1) {
+        render_grid_rows(&settings, 0);
+    } else {
+        GridWorker *workers = (GridWorker*)malloc(sizeof(GridWorker) * threads);
+#ifdef _WIN32
+        HANDLE *handles = (HANDLE*)malloc(sizeof(HANDLE) * threads);
+#else
+        pthread_t *handles = (pthread_t*)malloc(sizeof(pthread_t) * threads);
+#endif
+        int *started = (int*)malloc(sizeof(int) * threads);
+
+        if (workers == NULL || handles == NULL || started == NULL) {
+            /* Not enough memory to track threads, just do the work here */
+            settings.threadCount = 1;
+            render_grid_rows(&settings, 0);
+        } else {
+            for (int i = 0; i < threads; i++) {
+                workers[i].settings = &settings;
+                workers[i].threadIndex = i;
+#ifdef _WIN32
+                handles[i] = CreateThread(NULL, 0, render_grid_thread, &workers[i], 0, NULL);
+                started[i] = handles[i] != NULL;
+#else
+                started[i] = pthread_create(&handles[i], NULL, render_grid_thread, &workers[i]) == 0;
+#endif
+            }
+            for (int i = 0; i < threads; i++) {
+                if (started[i]) {
+#ifdef _WIN32
+                    WaitForSingleObject(handles[i], INFINITE);
+                    CloseHandle(handles[i]);
+#else
+                    pthread_join(handles[i], NULL);
+#endif
+                } else {
+                    /* Unable to start this thread, so do its rows here */
+                    render_grid_rows(&settings, i);
+                }
+            }
+        }
+
+        free(workers);
+        free(handles);
+        free(started);
+    }
+    Py_END_ALLOW_THREADS
+
+    PyBuffer_Release(&escapedView);
+    PyBuffer_Release(&smoothedView);
+    return Py_BuildValue("NN", escapedObj, smoothedObj);
+}
+
+PyMODINIT_FUNC PyInit_mandelbrot_native_helper() {
+    static PyMethodDef Methods[] = {
+        {"calc", mandelbrot_calc, METH_VARARGS, "Calculate a pixel"},
+        {"calc_batch", mandelbrot_calc_batch, METH_VARARGS, "Calculate an array of pixels"},
+        {"render_grid", mandelbrot_render_grid, METH_VARARGS, "Render a full viewport using multiple threads"},
+        {"get_kernel", mandelbrot_get_kernel, METH_NOARGS, "Name of the kernel in use"},
+        {"supported_kernels", mandelbrot_supported_kernels, METH_NOARGS, "Names of all kernels this CPU supports"},
+        {"set_kernel", mandelbrot_set_kernel, METH_VARARGS, "Pick the kernel to use"},
+        {NULL, NULL, 0, NULL}
+    };
+
+    static struct PyModuleDef module = {
+        PyModuleDef_HEAD_INIT,
+        "mandelbrot_native_helper",
+        NULL,
+        -1,
+        Methods
+    };
+
+    pick_kernel();
+    return PyModule_Create(&module);
+}
+
+// PyMODINIT_FUNC initmandelbrot_native_helper(void)
+// {
+//     PyObject *m;
+
+//     m = Py_InitModule("mandelbrot_native_helper", Methods);
+
+//     if ( m == NULL )
+//     {
+//         return;
+//     }
+
+//     // MandelbrotError = PyErr_NewException("mandelbrot.error", NULL, NULL);
+//     // Py_INCREF(MandelbrotError);
+//     // PyModule_AddObject(m, "error", MandelbrotError);
+// }
+
+// int main(int argc, char *argv[])
+// {
+//     Py_Initialize();
+//     PyInit_initmandelbrot_native_helper();
+
+//     return 0;
+// }
+
@@ -1,14 +1,20 @@
 #!/usr/bin/env python3
 
 from distutils.core import setup, Extension
+import sys
 
 def main():
+    # render_grid uses pthreads everywhere but Windows
+    libraries = [] if sys.platform == "win32" else ["pthread"]
+    # Don't let the compiler fuse multiply and add, the SIMD kernels need to match the scalar one exactly
+    compile_args = [] if sys.platform == "win32" else ["-ffp-contract=off"]
+
     setup(name="mandelbrot_native_helper",
           version="1.0.0",
           description="Native Mandelbrot Helper",
           author="Scott Seligman",
           author_email="scott.seligman@gmail.com",
-          ext_modules=[Extension("mandelbrot_native_helper", ["mandelbrot_native_helper.c"])])
+          ext_modules=[Extension("mandelbrot_native_helper", ["mandelbrot_native_helper.c"], libraries=libraries, extra_compile_args=compile_args)])
 
 if __name__ == "__main__":
     main()
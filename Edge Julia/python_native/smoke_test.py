@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import mandelbrot_native_helper
+import numpy as np
 
 in_set, escaped_at, dist = mandelbrot_native_helper.calc(0, 0, False, 0, 0, 1000)
 if in_set != 1:
@@ -9,4 +10,80 @@ in_set, escaped_at, dist = mandelbrot_native_helper.calc(-4, -4, False, 0, 0, 10
 if in_set != 0:
     raise Exception()
 
+# The batch version should match the single point version for every point
+xs = np.linspace(-2.5, 1.0, 97)
+ys = np.linspace(-1.25, 1.25, 97)
+xs, ys = [v.flatten() for v in np.meshgrid(xs, ys)]
+for julia in [None, (-0.51, 0.52)]:
+    batch_in_set = np.zeros(len(xs), dtype=np.int32)
+    batch_escaped = np.zeros(len(xs), dtype=np.int32)
+    batch_dist = np.zeros(len(xs), dtype=np.float64)
+    jx, jy = (0, 0) if julia is None else julia
+    mandelbrot_native_helper.calc_batch(xs, ys, julia is not None, jx, jy, 250, batch_in_set, batch_escaped, batch_dist)
+    for i in range(len(xs)):
+        if mandelbrot_native_helper.calc(xs[i], ys[i], julia is not None, jx, jy, 250) != (batch_in_set[i], batch_escaped[i], batch_dist[i]):
+            raise Exception()
+
+# The grid renderer should match single point calls using the same math as gui_to_mand
+width, height, alias, size, center_x, center_y = 37, 23, 2, 3.5, -0.75, 0.1
+for julia in [None, (-0.51, 0.52)]:
+    jx, jy = (0, 0) if julia is None else julia
+    escaped, smoothed = mandelbrot_native_helper.render_grid(center_x, center_y, size, width, height, alias, julia is not None, jx, jy, 100, 4)
+    if escaped.shape != (height * alias, width * alias) or smoothed.shape != escaped.shape:
+        raise Exception()
+    single_escaped, _ = mandelbrot_native_helper.render_grid(center_x, center_y, size, width, height, alias, julia is not None, jx, jy, 100, 1)
+    if not np.array_equal(escaped, single_escaped):
+        raise Exception()
+    for pt_y in range(height):
+        for pt_x in range(width):
+            for yo in range(alias):
+                for xo in range(alias):
+                    x = (((pt_x + max(0, (height - width) / 2)) + xo / alias) / max(width, height)) * size - ((size / 2) - center_x)
+                    y = (((pt_y + max(0, (width - height) / 2)) + yo / alias) / max(width, height)) * size - ((size / 2) - center_y)
+                    in_set, escaped_at, _ = mandelbrot_native_helper.calc(x, y, julia is not None, jx, jy, 100)
+                    if escaped[pt_y * alias + yo, pt_x * alias + xo] != (-1 if in_set else escaped_at):
+                        raise Exception()
+    # Rendering every 4th pixel should match the same pixels from the full render
+    step_escaped, _ = mandelbrot_native_helper.render_grid(center_x, center_y, size, width, height, alias, julia is not None, jx, jy, 100, 0, 4)
+    full = escaped.reshape(height, alias, width, alias)[::4, :, ::4, :].reshape(step_escaped.shape)
+    if not np.array_equal(step_escaped, full):
+        raise Exception()
+
+# Every kernel this CPU supports should produce exactly the same results
+default_kernel = mandelbrot_native_helper.get_kernel()
+for julia in [None, (-0.51, 0.52)]:
+    jx, jy = (0, 0) if julia is None else julia
+    results = {}
+    for kernel in mandelbrot_native_helper.supported_kernels():
+        mandelbrot_native_helper.set_kernel(kernel)
+        batch_in_set = np.zeros(len(xs), dtype=np.int32)
+        batch_escaped = np.zeros(len(xs), dtype=np.int32)
+        batch_dist = np.zeros(len(xs), dtype=np.float64)
+        mandelbrot_native_helper.calc_batch(xs, ys, julia is not None, jx, jy, 250, batch_in_set, batch_escaped, batch_dist)
+        _, smoothed = mandelbrot_native_helper.render_grid(-0.75, 0, 3.5, 101, 57, 2, julia is not None, jx, jy, 250)
+        batch_period = np.zeros(len(xs), dtype=np.int32)
+        mandelbrot_native_helper.calc_batch(xs, ys, julia is not None, jx, jy, 250, None, None, None, batch_period)
+        results[kernel] = (batch_in_set.tobytes(), batch_escaped.tobytes(), batch_dist.tobytes(), smoothed.tobytes(), batch_period.tobytes())
+    if len(set(results.values())) != 1:
+        raise Exception()
+mandelbrot_native_helper.set_kernel(default_kernel)
+
+# Cycle detection should find simple orbits, and report their period
+if mandelbrot_native_helper.calc(0, 0, True, -1, 0, 1000, True) != (1, 0, 0.0, 2):
+    raise Exception()
+if mandelbrot_native_helper.calc(0, 0, True, 0, 0, 1000, True) != (1, 0, 0.0, 1):
+    raise Exception()
+
+# And cycle detection shouldn't change any results from simply running all iterations
+def calc_all_iters(x, y, u, v, max_iters):
+    for i in range(max_iters):
+        x, y = x * x - y * y + u, 2.0 * x * y + v
+        dist = x * x + y * y
+        if dist >= 1 << 10:
+            return 0, i, dist
+    return 1, 0, 0.0
+for i in range(0, len(xs), 7):
+    if mandelbrot_native_helper.calc(xs[i], ys[i], True, -0.12, 0.75, 1000) != calc_all_iters(xs[i], ys[i], -0.12, 0.75, 1000):
+        raise Exception()
+
 print("Smoke test passed!")
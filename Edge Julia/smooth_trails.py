@@ -1,21 +1,47 @@
 #!/usr/bin/env python3
 
-from skimage.metrics import structural_similarity as ssim
 from collections import deque
 from datetime import datetime, timedelta
+from queue import Empty, Queue
 from scottsutils.command_opts import opt, main_entry
 from scottsutils.window_title import set_title
-from urllib.request import urlopen
+import frame_ssim
+import frame_store
 import mandelbrot_native_helper
 import numpy as np
-import lzma, math, multiprocessing, os, pickle, psutil
-import socket, sqlite3, statistics, threading, time, subprocess, sys
+import palette
+import trail_file
+import work_protocol
+import functools, heapq, math, multiprocessing, os, pickle, psutil
+import socket, socketserver, sqlite3, statistics, threading, time, subprocess, sys
 if sys.version_info >= (3, 11): from datetime import UTC
 else: import datetime as datetime_fix; UTC=datetime_fix.timezone.utc
 
 TARGET = "edge_00039_e06x177"
 DATA_FILE = os.path.join("data", TARGET + ".png.dat")
 DB_FILE = TARGET + ".smooth.db"
+# Frame data lives in TARGET.smooth.frames, see frame_store
+FRAMES_BASE = TARGET + ".smooth"
+# With the pyramid option, frames are first rendered and compared this many times smaller
+# on each side, level 0 is full size, level 1 is the coarse frames in TARGET.smooth.l1.frames
+PYRAMID_SHRINK = 4
+COARSE_LEVEL = 1
+# Coarse scores within this fraction of the best full size score get checked at full size
+PYRAMID_MARGIN = 0.10
+# How long a client has to finish work handed out by the server before it's handed out again
+LEASE_SECS = 600
+# Results and leases are written to the database in groups, at least this often
+GROUP_COMMIT_SECS = 30
+GROUP_COMMIT_SIZE = 5_000
+# Each client gets batches sized to take about this long, based on how fast it's been so far
+TARGET_BATCH_SECS = 20
+MIN_BATCH_SIZE = 1
+MAX_BATCH_SIZE = 500
+DEFAULT_BATCH_SIZE = 5
+# How many batches each client worker keeps on hand, so it's never waiting on the network
+PREFETCH_BATCHES = 2
+# How long a client waits before asking again when everything left is handed out to others
+WAIT_SECS = 5
 OUTPUT_FILE = TARGET + ".smooth.dat"
 FINAL_FRAME_COUNT = 15_000
 
@@ -26,6 +52,21 @@ def opt_history():
     _save_history = True
     show_msg("Option: Save All History set to True")
 
+_pyramid = False
+@opt("Render and compare small frames first, only going to full size when it matters")
+def opt_pyramid():
+    global _pyramid
+    _pyramid = True
+    show_msg("Option: Pyramid set to True")
+
+def start_level():
+    # The level frames are rendered and compared at before any are checked at full size
+    return COARSE_LEVEL if _pyramid else 0
+
+def level_bit(level):
+    # Each frame's levels column has this bit set once it's stored at that pyramid level
+    return 1 << level
+
 _skip_load = False
 @opt("Skip loading of frame data")
 def opt_skip():
@@ -33,13 +74,27 @@ def opt_skip():
     _skip_load = True
     show_msg("Option: Skip Load set to True")
 
+_frame_procs = False
+@opt("Render frames with a process per core, instead of one process using every core")
+def opt_procs():
+    global _frame_procs
+    _frame_procs = True
+    show_msg("Option: Frame Procs set to True")
+
+def client_workers(clients=None):
+    # Returns how many client processes to run, and how many threads each renders a frame with.
+    # render_grid spreads a frame over every core with the GIL released, so one client does it
+    # all, unless the procs option or a client count asks for separate processes
+    if clients:
+        return int(clients), 1
+    if _frame_procs:
+        return psutil.cpu_count(logical=False), 1
+    return 1, 0
+
 @opt("Visualize a frame from the database")
 def vis_frame(frame_no, fn):
     db, _ = open_db()
-    frame_no = int(frame_no)
-    data = db.execute("SELECT frame_data FROM frames WHERE frame_no=?;", (frame_no,)).fetchone()[0]
-    data = lzma.decompress(data)
-    data = pickle.loads(data)
+    data = load_frame(db, int(frame_no), render_missing=True)
 
     data = np.rot90(data)
 
@@ -69,6 +124,8 @@ def stats():
     show_msg(f"Total of {total:,} frames")
     frame_data = run_sql("SELECT count(*) FROM frames WHERE has_frame_data = 1;")
     show_msg(f"Total of {frame_data:,} frames with frame data, or {frame_data/total*100:.2f}%")
+    coarse = run_sql(f"SELECT count(*) FROM frames WHERE (levels & {level_bit(COARSE_LEVEL)}) != 0;")
+    show_msg(f"Total of {coarse:,} frames with coarse frame data, or {coarse/total*100:.2f}%")
     to_use = run_sql("SELECT count(*) FROM frames WHERE has_frame_data = 1 AND use_frame=1;")
     show_msg(f"Total of {frame_data:,} frames set to use, or {to_use/frame_data*100:.2f}%")
 
@@ -112,7 +169,8 @@ def open_db():
                     xy_data BLOB NOT NULL,
                     has_frame_data INT NOT NULL,
                     use_frame INT NOT NULL,
-                    frame_data BLOB
+                    frame_data BLOB,
+                    levels INT NOT NULL DEFAULT 0
                 );
         """)
         db.execute("""
@@ -120,7 +178,8 @@ def open_db():
                 diffs(
                     frame_a INT NOT NULL,
                     frame_b INT NOT NULL,
-                    diff INT NOT NULL
+                    diff INT NOT NULL,
+                    level INT NOT NULL DEFAULT 0
                 );
         """)
         db.execute("CREATE INDEX IF NOT EXISTS diffs_a_b_index ON diffs(frame_a, frame_b);")
@@ -130,8 +189,65 @@ def open_db():
         db.execute("CREATE INDEX IF NOT EXISTS frames_use_has_index ON frames(use_frame, has_frame_data);")
         db.execute("CREATE INDEX IF NOT EXISTS frames_use_has_no_index ON frames(use_frame, has_frame_data, frame_no);")
         db.commit()
+    elif "level" not in [row[1] for row in db.execute("PRAGMA table_info(diffs);")]:
+        # Older databases only had full size diffs
+        db.execute("ALTER TABLE diffs ADD COLUMN level INT NOT NULL DEFAULT 0;")
+        db.commit()
+    if "levels" not in [row[1] for row in db.execute("PRAGMA table_info(frames);")]:
+        # Older databases only said if a frame had data, which was at whatever level it was
+        # rendered at, so work out the levels from the database and the stores themselves
+        db.execute("ALTER TABLE frames ADD COLUMN levels INT NOT NULL DEFAULT 0;")
+        db.execute("UPDATE frames SET levels = 1 WHERE frame_data IS NOT NULL;")
+        for level in range(COARSE_LEVEL + 1):
+            bit = level_bit(level)
+            db.executemany("UPDATE frames SET levels = levels | ? WHERE frame_no = ?;", [(bit, frame_no) for frame_no in get_store(level).stored()])
+        db.execute("UPDATE frames SET has_frame_data = levels & 1;")
+        db.commit()
+    # Work the server has handed out, so a restarted server doesn't hand it out again right away
+    db.execute("CREATE TABLE IF NOT EXISTS leases(frame_no INT PRIMARY KEY, expires REAL NOT NULL, client TEXT);")
     return db, existing_file
 
+_stores = {}
+def get_store(level=0):
+    # The frame store for this process, one per pyramid level
+    store = _stores.get(level)
+    if store is None:
+        if level == 0:
+            store = frame_store.FrameStore(FRAMES_BASE)
+        else:
+            store = frame_store.FrameStore(f"{FRAMES_BASE}.l{level}")
+        _stores[level] = store
+    return store
+
+def save_frames(db, batch, level=0):
+    # Store a batch of (frame_data, frame_no) items, and mark them as done once they're on disk.
+    # Only the main process writes to the stores, workers hand their frames back to it
+    store = get_store(level)
+    for data, frame_no in batch:
+        store.put(frame_no, data)
+    store.flush()
+    full_size = 1 if level == 0 else 0
+    db.executemany(
+        "UPDATE frames SET levels = levels | ?, has_frame_data = has_frame_data | ? WHERE frame_no = ?;",
+        [(level_bit(level), full_size, frame_no) for _, frame_no in batch],
+    )
+    db.commit()
+
+def load_frame(db, frame_no, level=0, render_missing=False):
+    # Load a frame from the store, or from the database if it was calculated before the store existed.
+    # With the pyramid option, full size frames are only rendered when they're first needed, which
+    # the main process asks for with render_missing.  Anywhere else, a missing frame is an error
+    data = get_store(level).get_data(frame_no)
+    if data is None and level == 0:
+        data = db.execute("SELECT frame_data FROM frames WHERE frame_no=?;", (frame_no,)).fetchone()[0]
+    if data is None:
+        if not render_missing:
+            raise Exception(f"Frame {frame_no} hasn't been calculated at level {level}")
+        xy_data = db.execute("SELECT xy_data FROM frames WHERE frame_no=?;", (frame_no,)).fetchone()[0]
+        _, data = calculate_frame((frame_no, xy_data, level), ignore_abort=True, threads=0)
+        save_frames(db, [(data, frame_no)], level)
+    return frame_store.decode_frame(data)
+
 def load_frames(db):
     show_msg("Loading frame data into DB...")
     if not os.path.isfile(DATA_FILE):
@@ -141,9 +257,8 @@ def load_frames(db):
             "s3://scotts-mess/temp/edge/" + DATA_FILE.replace("\\", "/").split("/")[-1], 
             DATA_FILE,
         ])
-    with open(DATA_FILE, "rb") as f:
-        data = pickle.load(f)
-    inserts = [(i, pickle.dumps(row), 0, None, 1) for (i, row) in enumerate(data)]
+    data = trail_file.read_trail(DATA_FILE)
+    inserts = [(i, trail_file.pack_point(x, y), 0, None, 1) for i, (x, y) in enumerate(data)]
     if db.execute("SELECT count(*) FROM frames;").fetchone()[0] != len(inserts):
         db.execute("DELETE FROM frames;")
         db.execute("DELETE FROM diffs;")
@@ -153,51 +268,32 @@ def load_frames(db):
     else:
         show_msg("DB has frame data already")
 
-def calculate_frame(job, ignore_abort=False):
+def calculate_frame(job, ignore_abort=False, threads=1, allow_zstd=True):
     if not ignore_abort:
         if os.path.isfile("abort.txt"):
             return None
 
-    frame_no, xy_data = job
+    # Jobs can carry a pyramid level, each level is PYRAMID_SHRINK times smaller on each side
+    frame_no, xy_data = job[:2]
+    level = job[2] if len(job) > 2 else 0
 
-    width, height = 1280, 720
+    width, height = 1280 // (PYRAMID_SHRINK ** level), 720 // (PYRAMID_SHRINK ** level)
     max_iters = 250
-    data = np.zeros((width, height), dtype=np.uint8)
-
-    pool_color = (50, 0, 0)
-    colors = [
-        (0, 0, 100),
-        (255, 255, 255),
-        (255, 180, 0),
-        (100, 0, 0),
-        (100, 0, 0),
-    ]
 
-    jx, jy = pickle.loads(xy_data)
-    for y in range(height):
-        y_point = (y - height // 2) / min(height, width) * 2.5
-        for x in range(width):
-            x_point = (x - width // 2) / min(height, width) * 2.5
+    # Render the whole frame in one native call, the view is 2.5 units along the short side
+    jx, jy = trail_file.unpack_point(xy_data)
+    escaped, smoothed = mandelbrot_native_helper.render_grid(
+        0.0, 0.0, 2.5 * max(width, height) / min(width, height), 
+        width, height, 1, True, jx, jy, max_iters, threads,
+    )
 
-            in_set, escaped_at, final_dist = mandelbrot_native_helper.calc(x_point, y_point, True, jx, jy, max_iters)
-            if in_set == 1:
-                rgb = pool_color
-            else:
-                log_zn = math.log(final_dist) / 2
-                nu = math.log(log_zn / math.log(2)) / math.log(2)
-                rgb = ((escaped_at + 1 - nu) / max_iters)
-                rgb = max(0, min(1, rgb)) * 4
-                rgb = (
-                    int(colors[int(rgb)][0] * (1 - (rgb - int(rgb))) + colors[int(rgb) + 1][0] * (rgb - int(rgb))),
-                    int(colors[int(rgb)][1] * (1 - (rgb - int(rgb))) + colors[int(rgb) + 1][1] * (rgb - int(rgb))),
-                    int(colors[int(rgb)][2] * (1 - (rgb - int(rgb))) + colors[int(rgb) + 1][2] * (rgb - int(rgb))),
-                )
-            data[x, y] = int((((rgb[0] / 255) * 0.3) + ((rgb[0] / 255) * 0.6) + ((rgb[0] / 255) * 0.1)) * 255)
+    # Pick a color along a simple palette, only the red channel ends up being used
+    red = palette.smoothed_colors(smoothed, max_iters)[:, :, 0].astype(np.int64)
+    data = ((((red / 255) * 0.3) + ((red / 255) * 0.6) + ((red / 255) * 0.1)) * 255).astype(np.uint8)
+    # Frames are stored as width x height
+    data = np.ascontiguousarray(data.T)
 
-    data = pickle.dumps(data)
-    data = lzma.compress(data)
-
-    return (frame_no, data)
+    return (frame_no, frame_store.encode_frame(data, allow_zstd))
 
 @opt("Run a server to serve up work units", name="server")
 def run_server():
@@ -207,137 +303,436 @@ def run_server():
     if os.path.isfile("abort.txt"):
         os.unlink("abort.txt")
 
-    import flask
-    import logging
-    log = logging.getLogger('werkzeug')
-    log.setLevel(logging.ERROR)
     db, _ = open_db()
+    my_ip = socket.gethostbyname(socket.gethostname())
+    port = 5566
+    server, queue = create_server(db, ("0.0.0.0", port), start_level())
+    show_msg(f"Running server at {my_ip}, port {port}")
 
+    try:
+        with server:
+            server.serve_forever()
+    finally:
+        show_msg(f"Flushed {queue.commit():,} items")
+
+def create_server(db, address, level):
+    # Create a server for the frames still left in the database, at address, which is (host, port)
+    # or the path of a Unix socket.  Returns the server, which isn't running yet, and its WorkQueue
     total_count = db.execute("SELECT count(*) FROM frames;").fetchone()[0]
-    done_count = db.execute("SELECT count(*) FROM frames WHERE has_frame_data = 1;").fetchone()[0]
-    todo = deque(row for row in db.execute("SELECT frame_no, xy_data FROM frames WHERE has_frame_data = 0;"))
-
-    def get_work_item():
-        ret = []
-        for _ in range(5):
-            if len(todo) > 0:
-                ret.append(todo.popleft())
-            else:
-                break
-        if len(ret) > 0:
-            return pickle.dumps(ret)
-        else:
-            return b''
-
-    batch = []
+    done_count = db.execute("SELECT count(*) FROM frames WHERE (levels & ?) != 0;", (level_bit(level),)).fetchone()[0]
+    queue = WorkQueue(db, level)
+    left, leased = queue.left()
+    show_msg(f"{left:,} frames left, {leased:,} of them still leased out")
+    # Connections are handled on their own threads, this guards the counters used for status messages
+    status_lock = threading.Lock()
     next_msg = datetime.now(UTC).replace(tzinfo=None)
     recently_done = {}
 
-    def get_hello_page():
-        return b'HELLO'
-
-    def get_flush_items():
-        nonlocal batch, next_msg, recently_done, done_count
-        flushed = len(batch)
-        if len(batch) > 0:
-            db.executemany("UPDATE frames SET frame_data = ?, has_frame_data = 1 WHERE frame_no = ?;", batch)
-            db.commit()
-            batch = []
-        msg = f"Flushed {flushed:,} items"
-        show_msg(msg)
-        msg += "\n"
-        return msg.encode("utf-8")
-
-    def post_work_item():
-        nonlocal batch, next_msg, recently_done, done_count
-        job = flask.request.get_data()
-        job = pickle.loads(job)
-        recently_done[job['from']] = recently_done.get(job['from'], 0) + len(job['batch'])
-        done_count += len(job['batch'])
-        for frame_no, data in job['batch']:
-            batch.append((data, frame_no))
-
-        if len(batch) >= 5_000:
-            db.executemany("UPDATE frames SET frame_data = ?, has_frame_data = 1 WHERE frame_no = ?;", batch)
-            db.commit()
-            batch = []
+    def get_jobs(client):
+        jobs = queue.take(client)
+        if len(jobs) > 0:
+            jobs = [(frame_no, *trail_file.unpack_point(xy_data), level) for frame_no, xy_data, level in jobs]
+            return work_protocol.pack_jobs(work_protocol.JOBS_READY, jobs)
+        elif queue.left()[0] > 0:
+            # Everything left is leased out, the client should check back in case a lease runs out
+            return work_protocol.pack_jobs(work_protocol.JOBS_WAIT, [])
+        else:
+            return work_protocol.pack_jobs(work_protocol.JOBS_DONE, [])
 
-        if datetime.now(UTC).replace(tzinfo=None) >= next_msg:
-            temp = []
-            for key in sorted(recently_done):
-                value = recently_done[key]
-                temp.append(f"{key}:{value:3d}")
-            temp = " / ".join(temp)
-            recently_done = {}
-            show_msg(f"{done_count / total_count * 100:.2f}% done, {temp}")
-            while datetime.now(UTC).replace(tzinfo=None) >= next_msg:
-                next_msg += timedelta(seconds=60)
-        return b'OK'
+    def submit_results(client, results, secs):
+        nonlocal next_msg, recently_done, done_count
+        accepted = queue.finish(client, results, secs)
 
-    my_ip = socket.gethostbyname(socket.gethostname())
-    port = 5566
-    show_msg(f"Running server at {my_ip}, port {port}")
+        with status_lock:
+            recently_done[client] = recently_done.get(client, 0) + accepted
+            done_count += accepted
+            if datetime.now(UTC).replace(tzinfo=None) >= next_msg:
+                temp = []
+                for key in sorted(recently_done):
+                    value = recently_done[key]
+                    temp.append(f"{key}:{value:3d}")
+                temp = " / ".join(temp)
+                recently_done = {}
+                show_msg(f"{done_count / total_count * 100:.2f}% done, {temp}")
+                while datetime.now(UTC).replace(tzinfo=None) >= next_msg:
+                    next_msg += timedelta(seconds=60)
 
-    app = flask.Flask(__name__, static_url_path='')
-    app.add_url_rule('/get', 'get-main-page', get_work_item)
-    app.add_url_rule('/hello', 'get-hello-page', get_hello_page)
-    app.add_url_rule('/flush', 'get-flush-page', get_flush_items)
-    app.add_url_rule('/done', 'work-item-done', post_work_item, methods=['POST'])
-    app.run(debug=False, threaded=False, port=port, host="0.0.0.0")
-
-def safe_urlopen(url, data=None):
-    bail_at = datetime.now(UTC).replace(tzinfo=None) + timedelta(minutes=5)
-    to_sleep = 1
-    while True:
+    class Handler(socketserver.BaseRequestHandler):
+        # One of these runs for each client connection, for as long as the client keeps it open
+        def handle(self):
+            sock = self.request
+            work_protocol.configure_socket(sock)
+            try:
+                msg_type, payload = work_protocol.recv_message(sock)
+                if msg_type != work_protocol.MSG_HELLO:
+                    work_protocol.send_message(sock, work_protocol.MSG_ERROR, b"Expected hello")
+                    return
+                version, caps, client = work_protocol.unpack_hello(payload)
+                if version != work_protocol.VERSION:
+                    work_protocol.send_message(sock, work_protocol.MSG_ERROR, f"Server speaks version {work_protocol.VERSION}".encode("utf-8"))
+                    return
+                caps &= work_protocol.local_caps()
+                work_protocol.send_message(sock, work_protocol.MSG_HELLO, work_protocol.pack_hello(caps, socket.gethostname()))
+
+                while True:
+                    msg_type, payload = work_protocol.recv_message(sock)
+                    if msg_type == work_protocol.MSG_GET:
+                        work_protocol.send_message(sock, work_protocol.MSG_JOBS, get_jobs(client))
+                    elif msg_type == work_protocol.MSG_SUBMIT:
+                        want_more, secs, results = work_protocol.unpack_submit(payload)
+                        submit_results(client, results, secs)
+                        reply = get_jobs(client) if want_more else work_protocol.pack_jobs(work_protocol.JOBS_DONE, [])
+                        work_protocol.send_message(sock, work_protocol.MSG_JOBS, reply)
+                    elif msg_type == work_protocol.MSG_FLUSH:
+                        flushed = queue.commit()
+                        show_msg(f"Flushed {flushed:,} items")
+                        work_protocol.send_message(sock, work_protocol.MSG_FLUSHED, work_protocol.COUNT.pack(flushed))
+                    elif msg_type == work_protocol.MSG_RELEASE:
+                        released = queue.release(work_protocol.unpack_release(payload))
+                        work_protocol.send_message(sock, work_protocol.MSG_RELEASED, work_protocol.COUNT.pack(released))
+                    else:
+                        work_protocol.send_message(sock, work_protocol.MSG_ERROR, f"Unknown message {msg_type}".encode("utf-8"))
+                        return
+            except OSError:
+                # The client went away, anything it had leased will be handed out again
+                pass
+            except Exception as e:
+                # Most likely results can't be saved, so there's no point in the client carrying on
+                work_protocol.send_message(sock, work_protocol.MSG_ERROR, str(e).encode("utf-8"))
+                raise
+
+    if isinstance(address, str):
+        class Server(socketserver.ThreadingUnixStreamServer):
+            daemon_threads = True
+        if os.path.exists(address):
+            os.unlink(address)
+    else:
+        class Server(socketserver.ThreadingTCPServer):
+            allow_reuse_address = True
+            daemon_threads = True
+
+    return Server(address, Handler), queue
+
+class WorkQueue:
+    # Frames the server still needs rendered.  Frames are handed out under a lease, and handed
+    # out again if the lease runs out before the result comes back.  Results are only accepted
+    # once per frame, so a late result from a slow client is dropped instead of stored twice.
+    # Results and leases are written to the database together by a writer thread, every
+    # GROUP_COMMIT_SIZE results or GROUP_COMMIT_SECS, whichever comes first, so a crash loses at
+    # most that much work, and requests never wait on the database.  Everything is safe to call
+    # from any thread
+    def __init__(self, db, level):
+        self.level = level
+        self.lock = threading.Condition()
+        # Every frame that doesn't have a result yet, and the subset that's waiting to be handed out
+        self.outstanding = {}
+        self.todo = deque()
+        # Frame number to lease expiry, and a heap of (expiry, frame_no) to find ones that ran out
+        self.leases = {}
+        self.expiry = []
+        self.new_leases = []
+        self.released = []
+        self.results = []
+        # Seconds per frame for each client, as a moving average
+        self.frame_secs = {}
+        # Commits asked for, and how many of those have been written
+        self.commits_wanted = 0
+        self.commits_done = 0
+        # When the last result came in
+        self.finished_at = None
+        # Set if the writer failed, after that nothing else can be saved
+        self.error = None
+
+        leases = {frame_no: expires for frame_no, expires in db.execute("SELECT frame_no, expires FROM leases;")}
+        todo = db.execute("SELECT frame_no, xy_data FROM frames WHERE (levels & ?) = 0 ORDER BY frame_no;", (level_bit(level),))
+        for frame_no, xy_data in todo:
+            self.outstanding[frame_no] = (frame_no, xy_data, level)
+            if frame_no in leases:
+                self._lease(frame_no, leases[frame_no])
+            else:
+                self.todo.append(self.outstanding[frame_no])
+
+        threading.Thread(target=self._writer, daemon=True).start()
+
+    def _lease(self, frame_no, expires):
+        self.leases[frame_no] = expires
+        heapq.heappush(self.expiry, (expires, frame_no))
+
+    def _reissue_expired(self):
+        now = time.time()
+        while len(self.expiry) > 0 and self.expiry[0][0] <= now:
+            expires, frame_no = heapq.heappop(self.expiry)
+            # Skip entries for frames that are done, or have been leased again since
+            if self.leases.get(frame_no) == expires:
+                del self.leases[frame_no]
+                self.todo.append(self.outstanding[frame_no])
+
+    def _check_error(self):
+        # Call with the lock held, there's no point handing out or taking in work that can't be saved
+        if self.error is not None:
+            raise Exception(f"Unable to save results: {self.error}") from self.error
+
+    def batch_size(self, client):
+        secs = self.frame_secs.get(client)
+        if secs is None:
+            return DEFAULT_BATCH_SIZE
+        return max(MIN_BATCH_SIZE, min(MAX_BATCH_SIZE, int(TARGET_BATCH_SECS / max(secs, 0.001))))
+
+    def take(self, client):
+        # Lease out a batch of jobs sized for this client
+        with self.lock:
+            self._check_error()
+            self._reissue_expired()
+            count = self.batch_size(client)
+            ret = []
+            expires = time.time() + LEASE_SECS
+            while len(ret) < count and len(self.todo) > 0:
+                job = self.todo.popleft()
+                if job[0] not in self.outstanding:
+                    # A result came in after the lease ran out and it was queued again
+                    continue
+                self._lease(job[0], expires)
+                self.new_leases.append((job[0], expires, client))
+                ret.append(job)
+            return ret
+
+    def finish(self, client, batch, secs):
+        # Accept a batch of (frame_no, data) results that took the client secs to calculate,
+        # returns how many were new
+        with self.lock:
+            self._check_error()
+            now = time.time()
+            if len(batch) > 0 and secs > 0:
+                # Only the time spent calculating counts, not the time the work sat prefetched
+                secs = secs / len(batch)
+                last = self.frame_secs.get(client)
+                self.frame_secs[client] = secs if last is None else last * 0.7 + secs * 0.3
+            accepted = 0
+            for frame_no, data in batch:
+                if self.outstanding.pop(frame_no, None) is None:
+                    continue
+                self.leases.pop(frame_no, None)
+                self.results.append((data, frame_no))
+                accepted += 1
+            if accepted > 0 and len(self.outstanding) == 0:
+                self.finished_at = now
+            if len(self.results) >= GROUP_COMMIT_SIZE:
+                self.lock.notify_all()
+            return accepted
+
+    def release(self, frame_nos):
+        # A client won't calculate these after all, so hand them out again next.  Returns how
+        # many were still leased out
+        with self.lock:
+            released = set()
+            for frame_no in reversed(frame_nos):
+                if frame_no in self.outstanding and self.leases.pop(frame_no, None) is not None:
+                    self.todo.appendleft(self.outstanding[frame_no])
+                    self.released.append((frame_no,))
+                    released.add(frame_no)
+            # Leases that haven't been written yet don't need to be
+            self.new_leases = [row for row in self.new_leases if row[0] not in released]
+            return len(released)
+
+    def left(self):
+        with self.lock:
+            return len(self.outstanding), len(self.leases)
+
+    def commit(self):
+        # Wait for everything so far to be written, returns the number of results written
+        with self.lock:
+            self.commits_wanted += 1
+            wanted = self.commits_wanted
+            flushed = len(self.results)
+            self.lock.notify_all()
+            self.lock.wait_for(lambda: self.commits_done >= wanted or self.error is not None)
+            self._check_error()
+            return flushed
+
+    def _writer(self):
         try:
-            resp = urlopen(url, data=data)
-            resp = resp.read()
-            return resp
-        except:
-            if datetime.now(UTC).replace(tzinfo=None) >= bail_at:
-                return None
-            to_sleep = min(to_sleep + 5, 30)
-            time.sleep(to_sleep)
-
-def run_client_internal(queue, server):
+            self._write_groups()
+        except Exception as e:
+            # Anyone waiting on a commit finds out, and so does the next request
+            with self.lock:
+                self.error = e
+                self.lock.notify_all()
+
+    def _write_groups(self):
+        # SQLite connections can't be shared between threads, so the writer has its own
+        db, _ = open_db()
+        while True:
+            with self.lock:
+                self.lock.wait_for(
+                    lambda: self.commits_wanted > self.commits_done or len(self.results) >= GROUP_COMMIT_SIZE,
+                    timeout=GROUP_COMMIT_SECS,
+                )
+                wanted = self.commits_wanted
+                leases, self.new_leases = self.new_leases, []
+                released, self.released = self.released, []
+                results, self.results = self.results, []
+
+            # Released frames go first, since they may have been leased out again after
+            if len(released) > 0:
+                db.executemany("DELETE FROM leases WHERE frame_no = ?;", released)
+            if len(leases) > 0:
+                db.executemany("INSERT OR REPLACE INTO leases(frame_no, expires, client) VALUES (?, ?, ?);", leases)
+            if len(results) > 0:
+                db.executemany("DELETE FROM leases WHERE frame_no = ?;", [(frame_no,) for _, frame_no in results])
+                # This commits the lease changes along with the results
+                save_frames(db, results, self.level)
+            else:
+                db.commit()
+
+            with self.lock:
+                self.commits_done = wanted
+                self.lock.notify_all()
+
+class ServerLink:
+    # A connection to the server that's reconnected as needed, calls give up and return None
+    # if the server can't be reached for 5 minutes
+    def __init__(self, server):
+        self.address = server
+        self.conn = None
+
+    def call(self, func):
+        bail_at = datetime.now(UTC).replace(tzinfo=None) + timedelta(minutes=5)
+        to_sleep = 1
+        while True:
+            try:
+                if self.conn is None:
+                    self.conn = work_protocol.Connection(self.address, socket.gethostname())
+                return func(self.conn)
+            except OSError:
+                if self.conn is not None:
+                    self.conn.close()
+                    self.conn = None
+                if datetime.now(UTC).replace(tzinfo=None) >= bail_at:
+                    return None
+                to_sleep = min(to_sleep + 5, 30)
+                time.sleep(to_sleep)
+
+def run_client_internal(queue, server, threads=1):
+    # A network thread keeps up to PREFETCH_BATCHES batches of work on hand and sends results back
+    # as they're done, while this thread does nothing but calculate frames.  On abort, the batch
+    # being worked on is finished and everything calculated is sent before exiting, any batches
+    # that were prefetched but not started are given back to the server to hand out again
+    link = ServerLink(server)
+    batches = Queue(maxsize=PREFETCH_BATCHES)
+    results = Queue()
+    # Set when this thread is done putting results, and when the server has no more work for us
+    stopped = threading.Event()
+    server_done = threading.Event()
+
+    def network():
+        pending = []
+        pending_secs = 0.0
+        # When the server says to wait, don't ask for work until then, but keep sending results
+        wait_until = 0
+        while True:
+            # Check for stopping first, so once it's seen, every result is already in the queue
+            done = stopped.is_set()
+            while True:
+                try:
+                    batch, secs = results.get_nowait()
+                except Empty:
+                    break
+                pending.extend(batch)
+                pending_secs += secs
+            want_more = (
+                not done and not server_done.is_set() and not batches.full()
+                and time.time() >= wait_until and not os.path.isfile("abort.txt")
+            )
+            if not want_more and len(pending) == 0:
+                if done:
+                    break
+                # Nothing to send, and either no room for more work or no more to get
+                try:
+                    batch, secs = results.get(timeout=1)
+                except Empty:
+                    continue
+                pending.extend(batch)
+                pending_secs += secs
+                continue
+
+            # Results are sent along with the request for the next batch, and kept until the server
+            # has them, it's fine to send them again if the connection drops part way through
+            if len(pending) > 0:
+                resp = link.call(lambda conn: conn.submit(pending, want_more, pending_secs))
+            else:
+                resp = link.call(lambda conn: conn.get())
+            if resp is None:
+                queue.put(f"Unable to reach server, giving up")
+                server_done.set()
+                return
+            pending = []
+            pending_secs = 0.0
+            status, jobs = resp
+            if not want_more:
+                continue
+            if status == work_protocol.JOBS_DONE:
+                queue.put("No more jobs!")
+                server_done.set()
+            elif status == work_protocol.JOBS_WAIT:
+                wait_until = time.time() + WAIT_SECS
+            else:
+                batches.put(((link.conn.caps & work_protocol.CAP_ZSTD) != 0, jobs))
+
+        # Anything still prefetched won't be started, so don't leave it leased to us
+        unstarted = []
+        while True:
+            try:
+                unstarted.extend(frame_no for frame_no, _, _, _ in batches.get_nowait()[1])
+            except Empty:
+                break
+        if len(unstarted) > 0 and link.call(lambda conn: conn.release(unstarted)) is not None:
+            queue.put(f"Gave back {len(unstarted):,} unstarted frames")
+
+    thread = threading.Thread(target=network, daemon=True)
+    thread.start()
+
     while not os.path.isfile("abort.txt"):
-        jobs = safe_urlopen(server + "get")
-        if jobs is None or len(jobs) == 0:
-            queue.put("No more jobs!")
-            break
-        jobs = pickle.loads(jobs)
+        try:
+            allow_zstd, jobs = batches.get(timeout=1)
+        except Empty:
+            if server_done.is_set() or not thread.is_alive():
+                break
+            continue
         batch = []
-        for job in jobs:
-            result = calculate_frame(job, ignore_abort=True)
+        started = time.time()
+        for frame_no, x, y, level in jobs:
+            result = calculate_frame((frame_no, trail_file.pack_point(x, y), level), ignore_abort=True, threads=threads, allow_zstd=allow_zstd)
             if result is not None:
                 batch.append(result)
-        batch = pickle.dumps({
-            "from": socket.gethostname(),
-            "batch": batch,
-        })
-        resp = safe_urlopen(server + "done", batch)
-        if resp != b'OK':
-            queue.put(f"Got error response from server, giving up")
-            break
+        results.put((batch, time.time() - started))
         queue.put(jobs[0][0])
+
+    stopped.set()
+    thread.join()
+    if link.conn is not None:
+        link.conn.close()
     queue.put(None)
 
 def fix_server_name(server):
-    if "." not in server:
+    # Returns (host, port), or the path of a Unix socket for "unix:path".  A bare number is
+    # a machine on the home network
+    if server.startswith("unix:"):
+        return server[len("unix:"):]
+    if server.startswith("http://"):
+        server = server[len("http://"):]
+    server = server.rstrip("/")
+    if server.isdigit():
         server = "192.168.1." + server
     if ":" not in server:
         server = server + ":5566"
-    if not server.startswith("http://"):
-        server = "http://" + server
-    if not server.endswith("/"):
-        server += "/"
-    return server
+    host, port = server.rsplit(":", 1)
+    return host, int(port)
 
 @opt("Flush server", name="flush")
 def flush_server(server="127.0.0.1"):
-    server = fix_server_name(server)
-    resp = urlopen(server + "flush").read()
-    show_msg(resp.decode("utf-8"))
+    conn = work_protocol.Connection(fix_server_name(server), socket.gethostname())
+    show_msg(f"Flushed {conn.flush():,} items")
+    conn.close()
 
 @opt("Run a client to get work units from a server", name="client")
 def run_client(server="127.0.0.1"):
@@ -346,21 +741,24 @@ def run_client(server="127.0.0.1"):
 
     start_enter_worker()
     
-    show_msg(f"Starting client pointing to {server}")
+    show_msg(f"Starting client pointing to {work_protocol.describe_address(server)}")
 
-    if urlopen(server + "hello").read() == b'HELLO':
-        show_msg("Got hello response from server")
-    else:
-        raise Exception("Unable to talk to server")
+    conn = work_protocol.Connection(server, socket.gethostname())
+    show_msg(f"Got hello response from {conn.server_name}, protocol version {work_protocol.VERSION}")
+    conn.close()
 
     if os.path.isfile("abort.txt"):
         os.unlink("abort.txt")
-    workers = psutil.cpu_count(logical=False)
+    run_client_workers(server, *client_workers())
+
+def run_client_workers(server, workers, threads=1):
+    # Run worker processes against the server until they run out of work, each rendering
+    # frames with the given number of threads
     queue = multiprocessing.Queue()
 
     procs = []
     for _ in range(workers):
-        proc = multiprocessing.Process(target=run_client_internal, args=(queue, server))
+        proc = multiprocessing.Process(target=run_client_internal, args=(queue, server, threads))
         proc.start()
         procs.append(proc)
 
@@ -370,6 +768,8 @@ def run_client(server="127.0.0.1"):
         msg = queue.get()
         if msg is None:
             workers -= 1
+        elif isinstance(msg, str):
+            show_msg(msg)
         else:
             batches.append(msg)
             if datetime.now(UTC).replace(tzinfo=None) >= next_msg:
@@ -380,43 +780,114 @@ def run_client(server="127.0.0.1"):
 
     for proc in procs:
         proc.join()
-    
+
+def serve_local(db, workers, level, unix_path=None, threads=1):
+    # Run a server on loopback, or a Unix socket, and workers pointing at it, until all of the
+    # frames are done.  This goes through the same leases and commits as a real cluster
+    server, queue = create_server(db, unix_path if unix_path else ("127.0.0.1", 0), level)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    show_msg(f"Running local server at {work_protocol.describe_address(server.server_address)} with {workers} clients")
+    try:
+        run_client_workers(server.server_address, workers, threads)
+    finally:
+        server.shutdown()
+        server.server_close()
+        show_msg(f"Flushed {queue.commit():,} items")
+        if unix_path and os.path.exists(unix_path):
+            os.unlink(unix_path)
+    return queue
+
+@opt("Run a server and clients on this machine to calculate all frames", name="local")
+def run_local(clients=None, unix=None):
+    set_title("Smooth Local")
+    start_enter_worker()
+
+    if os.path.isfile("abort.txt"):
+        os.unlink("abort.txt")
+
+    db, _ = open_db()
+    workers, threads = client_workers(clients)
+    serve_local(db, workers, start_level(), unix, threads)
+
+@opt("Benchmark a local server and clients on made up frames", name="bench_local")
+def bench_local(frames="2000", clients=None, level="2", unix=None):
+    # Runs in a scratch directory, with frames rendered at the given pyramid level so the
+    # server and protocol make up more of the work.  Afterwards, checks everything made it to disk
+    import tempfile
+    frames, level = int(frames), int(level)
+    workers, threads = client_workers(clients)
+    old_dir = os.getcwd()
+    with tempfile.TemporaryDirectory() as temp_dir:
+        os.chdir(temp_dir)
+        try:
+            db, _ = open_db()
+            inserts = [(i, trail_file.pack_point(-0.75 + i * 1e-5, 0.1), 0, None, 1) for i in range(frames)]
+            db.executemany("INSERT INTO frames(frame_no, xy_data, has_frame_data, frame_data, use_frame) VALUES (?, ?, ?, ?, ?);", inserts)
+            db.commit()
+
+            started = time.time()
+            queue = serve_local(db, workers, level, os.path.join(temp_dir, "work.sock") if unix else None, threads)
+            ended = time.time()
+            last = (queue.finished_at or ended) - started
+
+            done = db.execute("SELECT count(*) FROM frames WHERE (levels & ?) != 0;", (level_bit(level),)).fetchone()[0]
+            leased = db.execute("SELECT count(*) FROM leases;").fetchone()[0]
+            store = _stores.pop(level, None) or frame_store.FrameStore(f"{FRAMES_BASE}.l{level}" if level else FRAMES_BASE)
+            missing = sum(1 for i in range(frames) if store.get_data(i) is None)
+            store.close()
+            db.close()
+
+            show_msg(f"{frames:,} frames at level {level} with {workers} clients, last frame in at {last:.2f}s, {frames / last:,.1f} frames/s")
+            show_msg(f"Everything shut down at {ended - started:.2f}s")
+            show_msg(f"{done:,} frames marked done, {missing:,} missing from the store, {leased:,} leases left")
+        finally:
+            os.chdir(old_dir)
+
+def render_frames(todo):
+    # Render each job with calculate_frame, one at a time in this process with render_grid using
+    # every core, or with the procs option, one frame per process on a pool
+    if _frame_procs:
+        with multiprocessing.Pool(psutil.cpu_count(logical=False)) as pool:
+            yield from pool.imap_unordered(calculate_frame, todo)
+    else:
+        for job in todo:
+            yield calculate_frame(job, threads=0)
+
 def populate_frames(db):
     if _skip_load:
         show_msg("Skipping loading frame data!")
         return
 
     show_msg("Calculating all frames from DB...")
-    todo = [row for row in db.execute("SELECT frame_no, xy_data FROM frames WHERE has_frame_data = 0;")]
+    level = start_level()
+    todo = [row for row in db.execute("SELECT frame_no, xy_data, ? FROM frames WHERE (levels & ?) = 0;", (level, level_bit(level)))]
     total_count = db.execute("SELECT count(*) FROM frames;").fetchone()[0]
     
-    workers = psutil.cpu_count(logical=False)
     left = len(todo)
     inserts = []
     next_msg = datetime.now(UTC).replace(tzinfo=None)
-    with multiprocessing.Pool(workers) as pool:
-        for job in pool.imap_unordered(calculate_frame, todo):
-            if job is not None:
-                frame_no, data = job
-                left -= 1
-                if datetime.now(UTC).replace(tzinfo=None) >= next_msg:
-                    show_msg(f"Done with {frame_no:,}, {left:,} left, {frame_no / total_count * 100:.2f}%")
-                    while datetime.now(UTC).replace(tzinfo=None) >= next_msg:
-                        next_msg += timedelta(seconds=15)
-                inserts.append(((data, frame_no)))
-                if len(inserts) >= 5_000:
-                    db.executemany("UPDATE frames SET frame_data = ?, has_frame_data=1 WHERE frame_no = ?;", inserts)
-                    db.commit()
-                    inserts = []
-            else:
-                break
+    for job in render_frames(todo):
+        if job is not None:
+            frame_no, data = job
+            left -= 1
+            if datetime.now(UTC).replace(tzinfo=None) >= next_msg:
+                show_msg(f"Done with {frame_no:,}, {left:,} left, {frame_no / total_count * 100:.2f}%")
+                while datetime.now(UTC).replace(tzinfo=None) >= next_msg:
+                    next_msg += timedelta(seconds=15)
+            inserts.append(((data, frame_no)))
+            if len(inserts) >= 5_000:
+                save_frames(db, inserts, level)
+                inserts = []
+        else:
+            break
 
     if len(inserts) > 0:
-        db.executemany("UPDATE frames SET frame_data = ?, has_frame_data=1 WHERE frame_no = ?;", inserts)
-        db.commit()
+        save_frames(db, inserts, level)
 
 _db = None
-def compare_frames(job, db=None):
+_frame_cache = {}
+def compare_frames(job, db=None, level=0, render_missing=False):
     if os.path.isfile("abort.txt"):
         return None
 
@@ -427,39 +898,35 @@ def compare_frames(job, db=None):
         if _db is None:
             _db, _ = open_db()
 
-    def load_frame(val):
-        ret = _db.execute("SELECT frame_data FROM frames WHERE frame_no=?;", (val,)).fetchone()[0]
-        ret = lzma.decompress(ret)
-        ret = pickle.loads(ret)
+    def load_cached(val):
+        # Neighboring pairs share a frame, so keep the SSIM statistics for the last few frames
+        # around, that way each frame is only loaded and filtered once as we walk along
+        ret = _frame_cache.get((val, level))
+        if ret is None:
+            ret = frame_ssim.FrameStats(load_frame(_db, val, level, render_missing))
+            _frame_cache[(val, level)] = ret
+            while len(_frame_cache) > 4:
+                del _frame_cache[next(iter(_frame_cache))]
         return ret
         # return ret.astype(np.int16)
 
     # def compare_frames(a, b):
     #     return int(np.sum(np.abs(np.subtract(b, a))))
     def compare_frames(a, b):
-        return (1/ssim(a, b, data_range=256)) * 1_000_000
+        return (1/frame_ssim.ssim(a, b, data_range=256)) * 1_000_000
         # frame_diff = int(np.sum(np.abs(np.subtract(data_b, data_a))))
 
 
     if isinstance(job, list):
-        last_frame_no = None
-        last_frame = None
-
-        ret = []
-
-        for frame_no in job:
-            frame = load_frame(frame_no)
-            if last_frame is not None:
-                frame_diff = compare_frames(last_frame, frame)
-                ret.append((last_frame_no, frame_no, frame_diff))
-            last_frame, last_frame_no = frame, frame_no
-        
-        return ret
+        # A run of frames in order, each frame is only loaded and filtered once
+        frames = (load_frame(_db, frame_no, level, render_missing) for frame_no in job)
+        scores = frame_ssim.ssim_stream(frames, data_range=256)
+        return [(a, b, (1/score) * 1_000_000) for a, b, score in zip(job, job[1:], scores)]
     else:
         a, b = job
 
-        data_a = load_frame(a)
-        data_b = load_frame(b)
+        data_a = load_cached(a)
+        data_b = load_cached(b)
 
         frame_diff = compare_frames(data_a, data_b)
 
@@ -475,10 +942,11 @@ def create_batches(temp):
 
 def prepare_initial_diffs(db, test_mode=False):
     show_msg("Finding items to update")
-    if db.execute("SELECT count(*) FROM diffs;").fetchone()[0] > 0:
+    level = start_level()
+    if db.execute("SELECT count(*) FROM diffs WHERE level = ?;", (level,)).fetchone()[0] > 0:
         show_msg("Already has diff data, skipping finding more!")
         return
-    temp = [x for x, in db.execute("SELECT frame_no FROM frames WHERE has_frame_data = 1 ORDER BY frame_no;")]
+    temp = [x for x, in db.execute("SELECT frame_no FROM frames WHERE (levels & ?) != 0 ORDER BY frame_no;", (level_bit(level),))]
     left = len(temp) - 1
     total = left
 
@@ -488,7 +956,7 @@ def prepare_initial_diffs(db, test_mode=False):
         workers = psutil.cpu_count(logical=False)
         inserts = []
         with multiprocessing.Pool(workers) as pool:
-            for job in pool.imap_unordered(compare_frames, create_batches(temp)):
+            for job in pool.imap_unordered(functools.partial(compare_frames, level=level), create_batches(temp)):
                 if job is not None:
                     for a, b, diff in job:
                         left -= 1 
@@ -497,16 +965,16 @@ def prepare_initial_diffs(db, test_mode=False):
                             show_msg(f"Diffs: {a} -> {b} = {int(diff):10d}, {perc:.2f}%, {left:,} left")
                             while datetime.now(UTC).replace(tzinfo=None) >= next_msg:
                                 next_msg += timedelta(seconds=60)
-                        inserts.append((a, b, diff))
+                        inserts.append((a, b, level, diff))
                         if len(inserts) >= 25_000:
                             if not test_mode:
-                                db.executemany("INSERT INTO diffs(frame_a, frame_b, diff) VALUES (?, ?, ?);", inserts)
+                                db.executemany("INSERT INTO diffs(frame_a, frame_b, level, diff) VALUES (?, ?, ?, ?);", inserts)
                                 db.commit()
                             inserts = []
 
         if len(inserts) > 0:
             if not test_mode:
-                db.executemany("INSERT INTO diffs(frame_a, frame_b, diff) VALUES (?, ?, ?);", inserts)
+                db.executemany("INSERT INTO diffs(frame_a, frame_b, level, diff) VALUES (?, ?, ?, ?);", inserts)
                 db.commit()
 
 @opt("Reset use frames to use all frames")
@@ -532,8 +1000,8 @@ class Cache:
         self.diffs = {}
         self.pending = []
         show_msg("Loading cache data")
-        for a, b, diff in db.execute("SELECT frame_a, frame_b, diff FROM diffs;"):
-            self.diffs[(a, b)] = diff
+        for a, b, level, diff in db.execute("SELECT frame_a, frame_b, level, diff FROM diffs;"):
+            self.diffs[(a, b, level)] = diff
         show_msg("Done loading cache")
 
     def get_dist(self, db, a, b):
@@ -544,29 +1012,36 @@ class Cache:
             self.dists[key] = dist
         return dist
     
-    def get_diff(self, db, a, b):
-        key = (a.frame_no, b.frame_no)
+    def get_diff(self, db, a, b, level=0):
+        key = (a.frame_no, b.frame_no, level)
         diff = self.diffs.get(key, None)
         if diff is None:
-            diff = compare_frames((a.frame_no, b.frame_no), db=db)[2]
+            diff = compare_frames((a.frame_no, b.frame_no), db=db, level=level, render_missing=True)[2]
             self.diffs[key] = diff
-            self.pending.append((a.frame_no, b.frame_no, diff))
+            self.pending.append(key + (diff,))
         return diff
 
     def flush_diff(self, db):
         if len(self.pending) > 0:
-            db.executemany("INSERT INTO diffs(frame_a, frame_b, diff) VALUES (?, ?, ?);", self.pending)
+            db.executemany("INSERT INTO diffs(frame_a, frame_b, level, diff) VALUES (?, ?, ?, ?);", self.pending)
             db.commit()
             self.pending = []
 
 class FrameInfo:
-    __slots__ = ['frame_no', 'x', 'y', 'dist', 'diff']
+    __slots__ = ['frame_no', 'x', 'y', 'dist', 'diff', 'level', 'key', 'prev', 'next', 'removed']
     def __init__(self, frame_no, x, y):
         self.frame_no = frame_no
         self.x = x
         self.y = y
         self.dist = 0
         self.diff = 0
+        # The pyramid level diff was found at, and what it was queued with
+        self.level = 0
+        self.key = 0
+        # Neighbors in the list of frames still in use
+        self.prev = None
+        self.next = None
+        self.removed = False
 
     def __lt__(self, other):
         return self.diff < other.diff
@@ -582,8 +1057,9 @@ def smooth_frames(db, test_mode=False):
     all_frames = []
     
     range_x, range_y = Range(), Range()
-    for frame_no, xy_data in db.execute("SELECT frame_no, xy_data FROM frames WHERE use_frame=1 AND has_frame_data=1 ORDER BY frame_no" + limit + ";"):
-        x, y = pickle.loads(xy_data)
+    level = start_level()
+    for frame_no, xy_data in db.execute("SELECT frame_no, xy_data FROM frames WHERE use_frame=1 AND (levels & ?) != 0 ORDER BY frame_no" + limit + ";", (level_bit(level),)):
+        x, y = trail_file.unpack_point(xy_data)
         range_x.track(x, frame_no)
         range_y.track(y, frame_no)
         all_frames.append(FrameInfo(frame_no, x, y))
@@ -606,53 +1082,123 @@ def smooth_frames(db, test_mode=False):
     for i, frame in enumerate(all_frames):
         if frame.frame_no not in keep:
             frame.dist = cache.get_dist(db, all_frames[i-1], all_frames[i+1])
-            frame.diff = cache.get_diff(db, frame, all_frames[i+1])
+            frame.diff = cache.get_diff(db, frame, all_frames[i+1], level)
+            frame.level = level
     cache.flush_diff(db)
 
+    # Link the frames together, and queue up all of the ones that could be removed.  The queue
+    # is ordered by diff, then frame number, the same order a scan of the list would find them.
+    # Entries aren't removed when a frame changes, instead a new one is added, and stale
+    # ones are skipped when they come off the queue
+    for a, b in zip(all_frames, all_frames[1:]):
+        a.next, b.prev = b, a
+    def can_remove(frame):
+        return frame.dist <= 0.01 and frame.frame_no not in keep
+
+    # Coarse diffs aren't on the same scale as full size ones, so they're queued scaled by how
+    # full size diffs have compared to coarse ones so far
+    scale_sums = [0.0, 0.0]
+    def queue(frame):
+        if frame.level == 0:
+            frame.key = frame.diff
+        else:
+            frame.key = frame.diff * (scale_sums[0] / scale_sums[1] if scale_sums[1] > 0 else 1.0)
+        heapq.heappush(todo, (frame.key, frame.frame_no, frame))
+
+    def refine(frame):
+        # Replace a coarse diff with the full size one
+        coarse = frame.diff
+        frame.diff = cache.get_diff(db, frame, frame.next, 0)
+        frame.level = 0
+        scale_sums[0] += frame.diff
+        scale_sums[1] += coarse
+        queue(frame)
+
+    def is_valid(entry):
+        key, _, frame = entry
+        return not frame.removed and frame.key == key and can_remove(frame)
+
+    todo = []
+    for frame in all_frames:
+        if can_remove(frame):
+            frame.key = frame.diff
+            todo.append((frame.key, frame.frame_no, frame))
+    heapq.heapify(todo)
+    frames_left = len(all_frames)
+
     next_msg = datetime.now(UTC).replace(tzinfo=None)
     slow_down = next_msg + timedelta(minutes=5)
     updates = []
-    while len(all_frames) > FINAL_FRAME_COUNT:
-        # hq = [x for x in all_frames if x.dist <= 0.01 and x.frame_no not in keep]
-        # heapq.heapify(hq)
-        # best_frame = heapq.heappop(hq)
-        # best = all_frames.index(best_frame)
-        # best_diff = best_frame.diff
-
-        # best_frame, best = min(((x, i) for i, x in enumerate(all_frames) if x.dist <= 0.01 and x.frame_no not in keep), key=lambda x: x[0].diff)
-        # best_diff = best_frame.diff
-
-        best, best_diff = None, 1 << 64
-        for i, frame in enumerate(all_frames):
-            if frame.dist <= 0.01 and frame.diff < best_diff and frame.frame_no not in keep:
-                best_diff, best = frame.diff, i
+    while frames_left > FINAL_FRAME_COUNT:
+        # Find the frame with the smallest diff that's still valid.  With the pyramid option
+        # only full size diffs can be removed, so a coarse diff at the front gets refined and
+        # requeued, as does any coarse diff close enough behind that it might really be smaller
+        best = None
+        while len(todo) > 0:
+            entry = heapq.heappop(todo)
+            if not is_valid(entry):
+                continue
+            best = entry[2]
+            if best.level != 0:
+                refine(best)
+                best = None
+                continue
+            while len(todo) > 0 and not is_valid(todo[0]):
+                heapq.heappop(todo)
+            if len(todo) > 0 and todo[0][2].level != 0 and todo[0][0] <= best.key * (1 + PYRAMID_MARGIN):
+                rival = heapq.heappop(todo)[2]
+                heapq.heappush(todo, entry)
+                refine(rival)
+                best = None
+                continue
+            break
+        if best is None:
+            show_msg("No more frames can be removed")
+            break
 
         if _save_history:
             with open("history.csv", "at") as f:
                 def calc_vals(vals):
                     return min(vals), max(vals), sum(vals) / len(vals), statistics.stdev(vals)
-                min_diff, max_diff, avg_diff, stddev_diff = calc_vals([x.diff for x in all_frames])
-                min_dist, max_dist, avg_dist, stddev_dist = calc_vals([x.dist for x in all_frames])
-                f.write(f"{len(all_frames)},{min_diff},{max_diff},{avg_diff},{stddev_diff},{min_dist},{max_dist},{avg_dist},{stddev_dist}\n")
+                frames, frame = [], all_frames[0]
+                while frame is not None:
+                    frames.append(frame)
+                    frame = frame.next
+                min_diff, max_diff, avg_diff, stddev_diff = calc_vals([x.diff for x in frames])
+                min_dist, max_dist, avg_dist, stddev_dist = calc_vals([x.dist for x in frames])
+                f.write(f"{frames_left},{min_diff},{max_diff},{avg_diff},{stddev_diff},{min_dist},{max_dist},{avg_dist},{stddev_dist}\n")
 
         if not test_mode:
-            updates.append((all_frames[best].frame_no,))
+            updates.append((best.frame_no,))
             if len(updates) >= 10_000:
                 db.executemany("UPDATE frames SET use_frame=0 WHERE frame_no=?;", updates)
                 cache.flush_diff(db)
                 db.commit()
                 updates = []
-        all_frames.pop(best)
-        removed.append(best_diff)
-        for i in range(max(0, best-1), min(len(all_frames)-2,best+1)+1):
-            all_frames[i].diff = cache.get_diff(db, all_frames[i], all_frames[i+1])
-        for i in range(max(1, best-1), min(len(all_frames)-2,best+1)+1):
-            all_frames[i].dist = cache.get_dist(db, all_frames[i-1], all_frames[i+1])
+
+        # Unlink the frame, the first and last frames are always kept, so it has both neighbors
+        before, after = best.prev, best.next
+        before.next, after.prev = after, before
+        best.removed = True
+        frames_left -= 1
+        removed.append(best.diff)
+
+        # Only the frame before this one has a new diff, and only the frames
+        # on either side have a new distance
+        before.diff = cache.get_diff(db, before, after, level)
+        before.level = level
+        if before.prev is not None:
+            before.dist = cache.get_dist(db, before.prev, after)
+        if after.next is not None:
+            after.dist = cache.get_dist(db, before, after.next)
+        for frame in [before, after]:
+            if can_remove(frame):
+                queue(frame)
 
         if datetime.now(UTC).replace(tzinfo=None) >= next_msg:
             avg = sum(removed) / len(removed)
-            perc = (1 - (len(all_frames) - FINAL_FRAME_COUNT) / (starting_frames - FINAL_FRAME_COUNT)) * 100
-            show_msg(f"Removed {len(removed):4d}, {int(min(removed)):7d} -> {int(avg):7d} -> {int(max(removed)):7d}, {len(all_frames):,} left, {perc:.2f}% done")
+            perc = (1 - (frames_left - FINAL_FRAME_COUNT) / (starting_frames - FINAL_FRAME_COUNT)) * 100
+            show_msg(f"Removed {len(removed):4d}, {int(min(removed)):7d} -> {int(avg):7d} -> {int(max(removed)):7d}, {frames_left:,} left, {perc:.2f}% done")
             removed = []
             while datetime.now(UTC).replace(tzinfo=None) >= next_msg:
                 if datetime.now(UTC).replace(tzinfo=None) >= slow_down:
@@ -701,11 +1247,23 @@ def test():
 def write_final(db):
     with open(OUTPUT_FILE, "wb") as f:
         data = []
-        for xy_data, in db.execute("SELECT xy_data FROM frames WHERE use_frame=1 AND has_frame_data = 1 ORDER BY frame_no;"):
-            data.append(pickle.loads(xy_data))
+        for xy_data, in db.execute("SELECT xy_data FROM frames WHERE use_frame=1 AND levels != 0 ORDER BY frame_no;"):
+            data.append(tuple(trail_file.unpack_point(xy_data)))
         pickle.dump(data, f)
         show_msg(f"Created data file of {len(data):,} frames")
 
+@opt("Convert a pickled trail to the columnar trail format")
+def to_trail(source, dest):
+    data = trail_file.read_trail(source)
+    trail_file.write_trail(dest, data)
+    show_msg(f"Wrote {len(data):,} points to {dest}")
+
+@opt("Convert a columnar trail back to a pickled list")
+def to_pickle(source, dest):
+    data = trail_file.read_trail(source)
+    trail_file.write_pickle(dest, data)
+    show_msg(f"Wrote {len(data):,} points to {dest}")
+
 @opt("Perform all work to find smooth trail")
 def do_work():
     if os.path.isfile("abort.txt"):
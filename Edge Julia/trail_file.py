@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import os
+import pickle
+import struct
+
+# Trails are stored as a fixed size header, followed by all of the x values, then all
+# of the y values, both as little endian float64.  Everything is 8 byte aligned so
+# the columns can be memory mapped straight into numpy arrays
+MAGIC = b"EJTRAIL\x00"
+VERSION = 1
+# Magic, version, count, border_iter, scan_size, frame_spacing, padded out to 64 bytes
+HEADER = struct.Struct("<8sIqqqd20x")
+# A single point, as stored in the smooth_trails database
+POINT = struct.Struct("<dd")
+
+class Trail:
+    # A list of (x, y) points backed by two float64 columns, along with what is
+    # known about how the trail was made.  Unknown values are None
+    def __init__(self, x, y, border_iter=None, scan_size=None, frame_spacing=None):
+        self.x = x
+        self.y = y
+        self.border_iter = border_iter
+        self.scan_size = scan_size
+        self.frame_spacing = frame_spacing
+
+    def __len__(self):
+        return len(self.x)
+
+    def __iter__(self):
+        return zip(self.x.tolist(), self.y.tolist())
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return Trail(self.x[index], self.y[index], self.border_iter, self.scan_size, self.frame_spacing)
+        return float(self.x[index]), float(self.y[index])
+
+    def points(self):
+        # The trail as a plain list of tuples, the same as the old pickle files held
+        return list(self)
+
+def from_points(points, border_iter=None, scan_size=None, frame_spacing=None):
+    # Build a Trail from anything that gives (x, y) pairs
+    if isinstance(points, Trail):
+        return points
+    xy = np.array(list(points), dtype=np.float64).reshape(-1, 2)
+    return Trail(np.ascontiguousarray(xy[:, 0]), np.ascontiguousarray(xy[:, 1]), border_iter, scan_size, frame_spacing)
+
+def is_trail_file(fn):
+    with open(fn, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+def write_trail(fn, points, border_iter=None, scan_size=None, frame_spacing=None):
+    # Write a trail out in the columnar format, the file is only replaced once it's complete
+    # Anything not passed in is taken from the trail itself, if it's already a Trail
+    trail = from_points(points)
+    border_iter = trail.border_iter if border_iter is None else border_iter
+    scan_size = trail.scan_size if scan_size is None else scan_size
+    frame_spacing = trail.frame_spacing if frame_spacing is None else frame_spacing
+    header = HEADER.pack(
+        MAGIC, VERSION, len(trail),
+        -1 if border_iter is None else border_iter,
+        -1 if scan_size is None else scan_size,
+        float("nan") if frame_spacing is None else frame_spacing,
+    )
+    with open(fn + ".tmp", "wb") as f:
+        f.write(header)
+        f.write(np.asarray(trail.x, dtype="<f8").tobytes())
+        f.write(np.asarray(trail.y, dtype="<f8").tobytes())
+    os.replace(fn + ".tmp", fn)
+
+def read_trail(fn, mmap=True):
+    # Load a trail, either in the columnar format, or one of the older pickled lists of tuples.
+    # Columnar files are memory mapped unless mmap is False
+    if not is_trail_file(fn):
+        with open(fn, "rb") as f:
+            return from_points(pickle.load(f))
+
+    with open(fn, "rb") as f:
+        magic, version, count, border_iter, scan_size, frame_spacing = HEADER.unpack(f.read(HEADER.size))
+    if version != VERSION:
+        raise Exception(f"Unknown trail file version {version} in {fn}")
+    if mmap and count > 0:
+        x = np.memmap(fn, dtype="<f8", mode="r", offset=HEADER.size, shape=(count,))
+        y = np.memmap(fn, dtype="<f8", mode="r", offset=HEADER.size + count * 8, shape=(count,))
+    else:
+        data = np.fromfile(fn, dtype="<f8", offset=HEADER.size, count=count * 2)
+        x, y = data[:count], data[count:]
+    return Trail(
+        x, y,
+        None if border_iter < 0 else border_iter,
+        None if scan_size < 0 else scan_size,
+        None if frame_spacing != frame_spacing else frame_spacing,
+    )
+
+def write_pickle(fn, points):
+    # Write a trail out in the older format, a pickled list of tuples
+    with open(fn, "wb") as f:
+        pickle.dump(from_points(points).points(), f)
+
+def arc_length(points):
+    # Cumulative distance along the trail at each point, the first point is at 0
+    trail = from_points(points)
+    steps = np.hypot(np.diff(trail.x), np.diff(trail.y))
+    return np.concatenate([[0.0], np.cumsum(steps)])
+
+def turn_angles(points):
+    # How much the trail turns at each point, in radians, 0 at the two ends
+    trail = from_points(points)
+    heading = np.arctan2(np.diff(trail.y), np.diff(trail.x))
+    turns = np.abs((np.diff(heading) + np.pi) % (2 * np.pi) - np.pi)
+    return np.concatenate([[0.0], turns, [0.0]])
+
+def resample(points, count, curvature=0.0):
+    # Spread count points evenly along the trail, always keeping the first and last point.
+    # With curvature above 0, distance through tight turns counts for more, so more points end
+    # up where the trail twists around.  New points are placed on the straight line between
+    # the two trail points around them, so exactly count points come back, even if the trail
+    # has fewer points than that
+    if count < 2:
+        raise Exception(f"Can't resample a trail to {count} points, it needs at least the first and last")
+    trail = from_points(points)
+    if len(trail) < 2:
+        raise Exception(f"Can't resample a trail of {len(trail)} points, it needs at least two")
+    if curvature > 0:
+        steps = np.hypot(np.diff(trail.x), np.diff(trail.y))
+        turns = turn_angles(trail)[:-1]
+        mean_turn = turns.mean()
+        if mean_turn > 0:
+            steps = steps * (1 + curvature * turns / mean_turn)
+        dist = np.concatenate([[0.0], np.cumsum(steps)])
+    else:
+        dist = arc_length(trail)
+
+    targets = np.linspace(0.0, dist[-1], count)
+    x, y = np.interp(targets, dist, trail.x), np.interp(targets, dist, trail.y)
+    x[0], y[0], x[-1], y[-1] = trail.x[0], trail.y[0], trail.x[-1], trail.y[-1]
+    return Trail(x, y, trail.border_iter, trail.scan_size, trail.frame_spacing)
+
+def spacing_for(points, count):
+    # The distance along the trail between neighbors if it's resampled to count points without
+    # curvature.  This is the even spacing resample uses, it's not a frame_spacing to hand to
+    # the greedy spacing in find_edge, which measures straight across and would give more points
+    return arc_length(points)[-1] / max(count - 1, 1)
+
+def pack_point(x, y):
+    return POINT.pack(x, y)
+
+def unpack_point(data):
+    # Points used to be stored as pickled tuples, so handle those too
+    if len(data) == POINT.size:
+        return POINT.unpack(data)
+    return pickle.loads(data)
+
+if __name__ == "__main__":
+    print("This module is not meant to be run directly")
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+
+import frame_store
+import socket
+import struct
+
+# The smooth_trails client and server talk over a plain TCP connection that's kept open for
+# as long as the client runs.  Every message is a type byte and a payload length, followed by
+# the payload.  The first message each way is a hello, which checks the version and settles on
+# the capabilities both sides have
+MAGIC = b"EJWP"
+VERSION = 2
+MESSAGE = struct.Struct("<BI")
+# Magic, version, capabilities, followed by the name of the client or server
+HELLO = struct.Struct("<4sHI")
+# Job status, then count, followed by that many jobs: frame number, x, y, pyramid level
+JOBS = struct.Struct("<BI")
+JOB = struct.Struct("<qddB")
+# If the client wants more work, then count, then the seconds spent calculating the results,
+# followed by that many results: frame number, data size, then the encoded frame
+SUBMIT = struct.Struct("<BId")
+RESULT = struct.Struct("<qI")
+COUNT = struct.Struct("<I")
+# Frames given back without results follow a count
+FRAME = struct.Struct("<q")
+# Nothing sane is this big, so anything that is means the stream is broken
+MAX_PAYLOAD = 1 << 30
+
+MSG_HELLO = 1
+MSG_GET = 2
+MSG_JOBS = 3
+MSG_SUBMIT = 4
+MSG_FLUSH = 5
+MSG_FLUSHED = 6
+MSG_ERROR = 7
+MSG_RELEASE = 8
+MSG_RELEASED = 9
+
+JOBS_READY = 0
+# Everything left is handed out to someone else, check back later
+JOBS_WAIT = 1
+JOBS_DONE = 2
+
+# Frames can be sent zstd compressed
+CAP_ZSTD = 1
+
+def local_caps():
+    # The capabilities this side has
+    return CAP_ZSTD if frame_store.zstandard is not None else 0
+
+def send_message(sock, msg_type, payload=b""):
+    sock.sendall(MESSAGE.pack(msg_type, len(payload)) + payload)
+
+def recv_exact(sock, size):
+    buf = bytearray(size)
+    view = memoryview(buf)
+    while len(view) > 0:
+        read = sock.recv_into(view)
+        if read == 0:
+            raise ConnectionError("Connection closed")
+        view = view[read:]
+    return bytes(buf)
+
+def recv_message(sock):
+    # Returns (msg_type, payload)
+    msg_type, size = MESSAGE.unpack(recv_exact(sock, MESSAGE.size))
+    if size > MAX_PAYLOAD:
+        raise Exception(f"Message of {size:,} bytes is too large")
+    return msg_type, recv_exact(sock, size)
+
+def pack_hello(caps, name):
+    return HELLO.pack(MAGIC, VERSION, caps) + name.encode("utf-8")
+
+def unpack_hello(payload):
+    # Returns (version, caps, name)
+    magic, version, caps = HELLO.unpack_from(payload, 0)
+    if magic != MAGIC:
+        raise Exception("Not a work protocol hello")
+    return version, caps, payload[HELLO.size:].decode("utf-8")
+
+def pack_jobs(status, jobs):
+    # Jobs are (frame_no, x, y, level)
+    return JOBS.pack(status, len(jobs)) + b"".join(JOB.pack(*job) for job in jobs)
+
+def unpack_jobs(payload):
+    # Returns (status, jobs)
+    status, count = JOBS.unpack_from(payload, 0)
+    return status, [JOB.unpack_from(payload, JOBS.size + i * JOB.size) for i in range(count)]
+
+def pack_submit(results, want_more, secs=0.0):
+    # Results are (frame_no, data), secs is how long they took to calculate
+    parts = [SUBMIT.pack(1 if want_more else 0, len(results), secs)]
+    for frame_no, data in results:
+        parts.append(RESULT.pack(frame_no, len(data)))
+        parts.append(data)
+    return b"".join(parts)
+
+def unpack_submit(payload):
+    # Returns (want_more, secs, results)
+    want_more, count, secs = SUBMIT.unpack_from(payload, 0)
+    offset = SUBMIT.size
+    results = []
+    for _ in range(count):
+        frame_no, size = RESULT.unpack_from(payload, offset)
+        offset += RESULT.size
+        results.append((frame_no, payload[offset:offset + size]))
+        offset += size
+    return want_more != 0, secs, results
+
+def pack_release(frame_nos):
+    return COUNT.pack(len(frame_nos)) + b"".join(FRAME.pack(frame_no) for frame_no in frame_nos)
+
+def unpack_release(payload):
+    # Returns the frame numbers
+    count, = COUNT.unpack_from(payload, 0)
+    return [FRAME.unpack_from(payload, COUNT.size + i * FRAME.size)[0] for i in range(count)]
+
+def configure_socket(sock):
+    # Batches are small, don't let them sit waiting for more data, and notice dead peers
+    if sock.family in (socket.AF_INET, socket.AF_INET6):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+def describe_address(address):
+    # Addresses are (host, port), or the path of a Unix socket
+    if isinstance(address, str):
+        return f"unix:{address}"
+    return f"{address[0]}:{address[1]}"
+
+def connect(address, timeout):
+    if isinstance(address, str):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        try:
+            sock.connect(address)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+    return socket.create_connection(address, timeout=timeout)
+
+class Connection:
+    # The client side of a connection.  Network errors come out as OSError, anything the
+    # server objects to comes out as an Exception
+    def __init__(self, address, name, timeout=300):
+        self.sock = connect(address, timeout)
+        configure_socket(self.sock)
+        reply = self._request(MSG_HELLO, pack_hello(local_caps(), name), MSG_HELLO)
+        version, self.caps, self.server_name = unpack_hello(reply)
+        if version != VERSION:
+            self.close()
+            raise Exception(f"Server speaks version {version}, not {VERSION}")
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def _request(self, msg_type, payload, reply_type):
+        send_message(self.sock, msg_type, payload)
+        got_type, reply = recv_message(self.sock)
+        if got_type == MSG_ERROR:
+            raise Exception(f"Server error: {reply.decode('utf-8')}")
+        if got_type != reply_type:
+            raise Exception(f"Expected message {reply_type}, got {got_type}")
+        return reply
+
+    def get(self):
+        # Returns (status, jobs)
+        return unpack_jobs(self._request(MSG_GET, b"", MSG_JOBS))
+
+    def submit(self, results, want_more=True, secs=0.0):
+        # Send results, and get the next batch of work in the same round trip.  Returns (status, jobs)
+        return unpack_jobs(self._request(MSG_SUBMIT, pack_submit(results, want_more, secs), MSG_JOBS))
+
+    def release(self, frame_nos):
+        # Give back frames that won't be calculated, so they're handed out again right away.
+        # Returns the number the server still had leased out
+        return COUNT.unpack(self._request(MSG_RELEASE, pack_release(frame_nos), MSG_RELEASED))[0]
+
+    def flush(self):
+        # Ask the server to write everything to disk, returns the number of results written
+        return COUNT.unpack(self._request(MSG_FLUSH, b"", MSG_FLUSHED))[0]
+
+if __name__ == "__main__":
+    print("This module is not meant to be run directly")